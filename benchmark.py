@@ -1,15 +1,272 @@
+# Measures run time and peak memory of loading, decoding, saving and rendering maps
+# e.g. python3 benchmark.py --faces 1000 4000 16000 --output results.json
+# or python3 benchmark.py --map pball/maps/beta/oddball_b1.bsp --pball pball --baseline results.json
+import argparse
+import itertools
+import json
 import os
-import timeit
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import colored_radar_image as cl
+from Q2BSP import Q2BSP
+from bsp_arrays import get_face_arrays, get_lightmap_extents, get_pvs_array
+from bsp_importer.mesh_buffers import build_mesh_buffers, fill_mesh
 from radar_image import create_image
+from synthetic_bsp import create_synthetic_bsp
 
+# private decoders of Q2BSP which are run by its constructor, name without the _Q2BSP__get_ prefix
+DECODERS = ["vis", "leaf_faces", "faces", "tex_info", "models", "vertices", "edges", "face_edges",
+            "vertices_of_faces", "bsp_leafs", "entities", "bsp_nodes", "planes", "brushes", "lightmaps"]
 
-pball_path = os.path.abspath('./pball')
 
+@dataclass
+class BenchmarkResult:
+    name: str
+    # fastest of all repetitions
+    seconds: float
+    # most memory allocated at once during a separate run, tracemalloc slows down the code so it isn't timed
+    peak_bytes: int
+    baseline_seconds: Optional[float] = None
+    baseline_peak_bytes: Optional[int] = None
+    # seconds / baseline_seconds, above 1 means slower than the baseline
+    ratio: Optional[float] = None
 
-def render_solid_perspective():
-    create_image(pball_path, "/maps/beta/oddball_b1.bsp", "all", 0, "mode0.png", max_resolution=1024)
 
+class StubCollection:
+    """
+    Stands in for the vertex, loop and polygon collections of a blender mesh, foreach_set copies the values like
+    blender does
+    """
+    def __init__(self):
+        self.length = 0
+        self.attributes: Dict[str, np.ndarray] = dict()
 
-time_perspective = timeit.timeit("render_solid_perspective()", globals=locals(), number=1)
+    def add(self, count: int) -> None:
+        self.length += count
 
-print(f'solid_perspective {time_perspective}s')
\ No newline at end of file
+    def foreach_set(self, attribute: str, values: np.ndarray) -> None:
+        self.attributes[attribute] = np.array(values)
+
+
+class StubMesh:
+    """
+    Has the parts of bpy.types.Mesh that mesh_buffers.fill_mesh writes to
+    """
+    def __init__(self):
+        self.vertices = StubCollection()
+        self.loops = StubCollection()
+        self.polygons = StubCollection()
+        self.uv_layers = SimpleNamespace(new=lambda name: SimpleNamespace(name=name, data=StubCollection()))
+
+
+def measure(function: Callable, repeat: int = 3) -> Tuple[float, int]:
+    """
+    :param function: function without parameters
+    :param repeat: number of timed runs
+    :return: fastest run time in seconds, peak of allocated memory in bytes
+    """
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def get_cases(map_path: str, pball_path: str, work_dir: str,
+              selected: Optional[List[str]] = None) -> Dict[str, Callable]:
+    """
+    Prepares the benchmarked functions for a map, loaded maps and polygons are only prepared for selected cases
+    :param map_path: full path to map
+    :param pball_path: path to pball / game media directory, textures are looked up there, can be empty
+    :param work_dir: directory for saved maps and rendered images
+    :param selected: only cases whose name starts with one of these, all cases if None
+    :return: dict of case name -> function without parameters, in the order they should run
+    """
+    saved_path = os.path.join(work_dir, "saved.bsp")
+    fixtures = dict()
+
+    def bsp() -> Q2BSP:
+        return fixtures["bsp"]
+
+    def saved() -> Q2BSP:
+        # saving changes the binary lumps, which must not affect the decoders
+        return fixtures["saved"]
+
+    def load_saved() -> Q2BSP:
+        shutil.copyfile(map_path, saved_path)
+        return Q2BSP(map_path)
+
+    # prepared once before any case is timed, in this order
+    fixture_loaders = {
+        "bsp": lambda: Q2BSP(map_path),
+        "saved": load_saved,
+        "buffers": lambda: build_mesh_buffers(fixtures["bsp"]),
+        "polys": lambda: cl.get_polygons(map_path, pball_path)[0],
+        "packed": lambda: cl.load_packed_polygons(map_path, pball_path),
+    }
+
+    # case name -> function, fixtures it needs
+    cases: Dict[str, Tuple[Callable, Tuple[str, ...]]] = {"load": (lambda: Q2BSP(map_path), ())}
+    for decoder in DECODERS:
+        cases["decode_" + decoder] = (lambda decoder=decoder: getattr(bsp(), "_Q2BSP__get_" + decoder)(), ("bsp",))
+    cases.update({
+        "face_arrays": (lambda: get_face_arrays(bsp()), ("bsp",)),
+        "lightmap_extents": (lambda: get_lightmap_extents(bsp()), ("bsp",)),
+        "vis_decompress": (lambda: [(x.get_pvs(), x.get_phs()) for x in bsp().clusters], ("bsp",)),
+        "vis_pvs_arrays": (lambda: [get_pvs_array(bsp(), x) for x in range(bsp().n_clusters)], ("bsp",)),
+        "save_vis": (lambda: saved().save_vis(saved().clusters), ("saved",)),
+        "save_tex_info": (lambda: saved().save_tex_info(saved().tex_infos), ("saved",)),
+        "save_bsp_leaves": (lambda: saved().save_bsp_leaves(saved().bsp_leaves), ("saved",)),
+        "save_models": (lambda: saved().save_models(saved().models), ("saved",)),
+        "save_leaf_faces": (lambda: saved().save_leaf_faces(saved().leaf_faces), ("saved",)),
+        "save_brushes": (lambda: saved().save_brushes(saved().brushes), ("saved",)),
+        "save_faces": (lambda: saved().save_faces(saved().faces), ("saved",)),
+        "save_entities": (lambda: saved().save_entities(saved().worldspawn, saved().entities), ("saved",)),
+        "save_planes": (lambda: saved().save_planes(saved().planes), ("saved",)),
+        "save_lightmaps": (lambda: saved().save_lightmaps(saved().lightmaps), ("saved",)),
+        "update_lump_sizes": (lambda: saved().update_lump_sizes(), ("saved",)),
+        "save_map": (lambda: saved().save_map(saved_path, "_saved"), ("saved",)),
+        "build_mesh_buffers": (lambda: build_mesh_buffers(bsp()), ("bsp",)),
+        "fill_mesh": (lambda: fill_mesh(StubMesh(), fixtures["buffers"]), ("bsp", "buffers")),
+        "get_polygons": (lambda: cl.get_polygons(map_path, pball_path), ()),
+        "rotate_polygons": (lambda: cl.get_rot_polys(fixtures["polys"], 30, 20, 40), ("polys",)),
+        "sort_polygons": (lambda: cl.sort_by_axis(fixtures["polys"], 0), ("polys",)),
+        "load_packed_polygons": (lambda: cl.load_packed_polygons(map_path, pball_path), ()),
+        "project_packed_polygons": (lambda: cl.project_packed_polygons(fixtures["packed"], 30, 20, 40, True),
+                                    ("packed",)),
+    })
+
+    # create_image expects the map path relative to the game media directory
+    if pball_path and os.path.abspath(map_path).startswith(os.path.abspath(pball_path) + os.sep):
+        render_args = (os.path.abspath(pball_path), os.path.abspath(map_path)[len(os.path.abspath(pball_path)):])
+    else:
+        render_args = ("", os.path.abspath(map_path))
+    for mode in range(4):
+        image_path = os.path.join(work_dir, f"mode{mode}.png")
+        cases[f"render_mode{mode}"] = \
+            (lambda mode=mode, image_path=image_path: create_image(*render_args, "all", mode, image_path,
+                                                                   max_resolution=1024), ())
+
+    cases = {name: case for name, case in cases.items() if not selected or any(name.startswith(x) for x in selected)}
+    required = set(x for _, needed in cases.values() for x in needed)
+    for name, loader in fixture_loaders.items():
+        if name in required:
+            fixtures[name] = loader()
+    return {name: function for name, (function, _) in cases.items()}
+
+
+def run_benchmarks(map_path: str, pball_path: str, work_dir: str, repeat: int = 3,
+                   selected: Optional[List[str]] = None) -> List[BenchmarkResult]:
+    """
+    :param map_path: full path to map
+    :param pball_path: path to pball / game media directory, can be empty
+    :param work_dir: directory for saved maps and rendered images
+    :param repeat: number of timed runs per case
+    :param selected: only run cases whose name starts with one of these, all cases if None
+    :return: list of BenchmarkResult objects
+    """
+    results = list()
+    for name, function in get_cases(map_path, pball_path, work_dir, selected).items():
+        seconds, peak = measure(function, repeat)
+        results.append(BenchmarkResult(name, seconds, peak))
+    return results
+
+
+def compare_to_baseline(fixtures: List[dict], baseline: dict, tolerance: float = 0.1) -> List[str]:
+    """
+    Adds baseline values and ratios to the results of all fixtures which are in the baseline as well
+    :param fixtures: fixtures of the current run, results are changed in place
+    :param baseline: content of a json file written by an earlier run
+    :param tolerance: cases slower than baseline by more than this fraction are reported
+    :return: list of messages for cases that got slower
+    """
+    baseline_results = {(fixture["name"], result["name"]): result
+                        for fixture in baseline.get("fixtures", []) for result in fixture["results"]}
+    regressions = list()
+    for fixture in fixtures:
+        for result in fixture["results"]:
+            old = baseline_results.get((fixture["name"], result["name"]))
+            if not old or not old["seconds"]:
+                continue
+            result["baseline_seconds"] = old["seconds"]
+            result["baseline_peak_bytes"] = old["peak_bytes"]
+            result["ratio"] = result["seconds"] / old["seconds"]
+            if result["ratio"] > 1 + tolerance:
+                regressions.append(f"{fixture['name']} {result['name']}: {old['seconds']:.4f}s -> "
+                                   f"{result['seconds']:.4f}s ({result['ratio']:.2f}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks map loading, saving and rendering on real maps or "
+                                                 "synthetic maps of any size. Several values per synthetic map "
+                                                 "parameter create one map per combination.")
+    parser.add_argument("--map", nargs="*", default=[], help="real maps to benchmark, no synthetic maps if set")
+    parser.add_argument("--pball", default="", help="game media directory for textures of real maps")
+    parser.add_argument("--faces", nargs="+", type=int, default=[2000])
+    parser.add_argument("--leaves", nargs="+", type=int, default=[64])
+    parser.add_argument("--clusters", nargs="+", type=int, default=[32])
+    parser.add_argument("--lightmap-size", nargs="+", type=int, default=[5], help="lightmap texels per face side")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the fastest one is reported")
+    parser.add_argument("--cases", nargs="*", help="only run cases starting with these names, e.g. decode_ render_")
+    parser.add_argument("--output", default="benchmark.json", help="json file for the results")
+    parser.add_argument("--baseline", help="json file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown reported as regression")
+    args = parser.parse_args()
+
+    fixtures = list()
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.map:
+            maps = [(os.path.basename(x), os.path.abspath(x), dict()) for x in args.map]
+        else:
+            maps = list()
+            for faces, leaves, clusters, lightmap_size in itertools.product(args.faces, args.leaves, args.clusters,
+                                                                           args.lightmap_size):
+                parameters = {"faces": faces, "leaves": leaves, "clusters": clusters, "lightmap_size": lightmap_size}
+                name = "synthetic " + " ".join(f"{key}={value}" for key, value in parameters.items())
+                path = os.path.join(work_dir, f"synthetic_{len(maps)}.bsp")
+                parameters["generated"] = create_synthetic_bsp(path, faces, leaves, clusters, lightmap_size)
+                if parameters["generated"] is None:
+                    continue
+                maps.append((name, path, parameters))
+
+        for name, path, parameters in maps:
+            case_dir = os.path.join(work_dir, f"fixture_{len(fixtures)}")
+            os.mkdir(case_dir)
+            results = run_benchmarks(path, args.pball, case_dir, args.repeat, args.cases)
+            fixtures.append({"name": name, "parameters": parameters, "file_size": os.path.getsize(path),
+                             "results": [asdict(x) for x in results]})
+
+    regressions = list()
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(fixtures, json.load(f), args.tolerance)
+
+    for fixture in fixtures:
+        print(fixture["name"])
+        for result in fixture["results"]:
+            ratio = f" {result['ratio']:.2f}x" if result["ratio"] is not None else ""
+            print(f"  {result['name']:<26} {result['seconds']:10.4f}s {result['peak_bytes'] / 2 ** 20:9.1f} MiB"
+                  f"{ratio}")
+    for regression in regressions:
+        print(f"Info: slower than baseline: {regression}")
+
+    with open(args.output, "w") as f:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(), "repeat": args.repeat,
+                   "fixtures": fixtures}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
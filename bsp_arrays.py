@@ -0,0 +1,239 @@
+# Packed NumPy views on the lumps of a Q2BSP object. In contrast to the lists of objects created by the Q2BSP class,
+# these arrays are built with a few vectorized operations directly from the binary lumps
+from dataclasses import dataclass
+import numpy as np
+
+# record layouts as described in the Quake 2 BSP file format, all values are little endian
+FACE_DTYPE = np.dtype([("plane", "<u2"), ("plane_side", "<u2"), ("first_edge", "<u4"), ("num_edges", "<u2"),
+                       ("texture_info", "<u2"), ("lightmap_styles", "u1", (4,)), ("lightmap_offset", "<u4")])
+PLANE_DTYPE = np.dtype([("normal", "<f4", (3,)), ("distance", "<f4"), ("type", "<u4")])
+NODE_DTYPE = np.dtype([("plane", "<u4"), ("front_child", "<i4"), ("back_child", "<i4"), ("bbox_min", "<i2", (3,)),
+                       ("bbox_max", "<i2", (3,)), ("first_face", "<u2"), ("num_faces", "<u2")])
+LEAF_DTYPE = np.dtype([("contents", "<u4"), ("cluster", "<i2"), ("area", "<u2"), ("bbox_min", "<i2", (3,)),
+                       ("bbox_max", "<i2", (3,)), ("first_leaf_face", "<u2"), ("num_leaf_faces", "<u2"),
+                       ("first_leaf_brush", "<u2"), ("num_leaf_brushes", "<u2")])
+MODEL_DTYPE = np.dtype([("bbox_min", "<f4", (3,)), ("bbox_max", "<f4", (3,)), ("origin", "<f4", (3,)),
+                        ("head_node", "<u4"), ("first_face", "<u4"), ("num_faces", "<u4")])
+TEX_INFO_DTYPE = np.dtype([("u_axis", "<f4", (3,)), ("u_offset", "<f4"), ("v_axis", "<f4", (3,)),
+                           ("v_offset", "<f4"), ("flags", "<u4"), ("value", "<u4"), ("texture_name", "S32"),
+                           ("next_texinfo", "<u4")])
+
+# surface flags stored in texture information
+SURF_LIGHT = 0x1
+SURF_SLICK = 0x2
+SURF_SKY = 0x4
+SURF_WARP = 0x8
+SURF_TRANS33 = 0x10
+SURF_TRANS66 = 0x20
+SURF_FLOWING = 0x40
+SURF_NODRAW = 0x80
+SURF_HINT = 0x100
+SURF_SKIP = 0x200
+
+
+def get_lump_array(bsp, lump: int, dtype: np.dtype) -> np.ndarray:
+    """
+    Interprets a binary lump as array of records, no data is copied
+    :param bsp: Q2BSP object
+    :param lump: index of the lump
+    :param dtype: record layout
+    :return: read-only structured array
+    """
+    lump_bytes = bsp.binary_lumps[lump]
+    return np.frombuffer(lump_bytes, dtype=dtype, count=len(lump_bytes) // dtype.itemsize)
+
+
+def get_vertex_array(bsp) -> np.ndarray:
+    """
+    :param bsp: Q2BSP object
+    :return: (n_vertices, 3) float32 array of all vertex positions
+    """
+    return get_lump_array(bsp, 2, np.dtype("<f4")).reshape(-1, 3)
+
+
+def get_lightmap_array(bsp) -> np.ndarray:
+    """
+    Mutable view on the lightmap lump, changes are stored by save_map without calling save_lightmaps
+    bsp.lightmaps isn't updated, save_lightmaps with the old list would undo the changes
+    :param bsp: Q2BSP object
+    :return: (n_texels, 3) uint8 array of RGB lightmap texels
+    """
+    if not isinstance(bsp.binary_lumps[7], bytearray):
+        # bytes objects are read-only, the lump is copied once into a mutable buffer
+        bsp.binary_lumps[7] = bytearray(bsp.binary_lumps[7])
+    lump_bytes = bsp.binary_lumps[7]
+    return np.frombuffer(lump_bytes, dtype=np.uint8, count=len(lump_bytes) // 3 * 3).reshape(-1, 3)
+
+
+@dataclass
+class FaceArrays:
+    # vertex index for every corner of every face, faces are stored one after another
+    loop_vertices: np.ndarray
+    # index of first corner and number of corners per face, like blender's loop_start and loop_total
+    loop_start: np.ndarray
+    loop_total: np.ndarray
+    texture_info: np.ndarray
+    # face normals, already flipped for faces on the back side of their plane
+    normals: np.ndarray
+    lightmap_styles: np.ndarray
+    lightmap_offsets: np.ndarray
+
+
+def get_face_arrays(bsp) -> FaceArrays:
+    """
+    Resolves edges and face edges of all faces at once
+    :param bsp: Q2BSP object
+    :return: FaceArrays object
+    """
+    faces = get_lump_array(bsp, 6, FACE_DTYPE)
+    edges = get_lump_array(bsp, 11, np.dtype("<u2")).reshape(-1, 2)
+    face_edges = get_lump_array(bsp, 12, np.dtype("<i4"))
+    planes = get_lump_array(bsp, 1, PLANE_DTYPE)
+
+    loop_total = faces["num_edges"].astype(np.int64)
+    loop_start = np.zeros(len(faces), dtype=np.int64)
+    np.cumsum(loop_total[:-1], out=loop_start[1:])
+    # position of every corner inside its face, added to the first face edge of the face
+    corner = np.arange(loop_total.sum()) - np.repeat(loop_start, loop_total)
+    face_edge_indices = face_edges[np.repeat(faces["first_edge"].astype(np.int64), loop_total) + corner]
+    # negative face edges are traversed backwards, so the second vertex is the first one of the corner
+    loop_vertices = np.where(face_edge_indices >= 0, edges[np.abs(face_edge_indices), 0],
+                             edges[np.abs(face_edge_indices), 1]).astype(np.int64)
+
+    normals = planes["normal"][faces["plane"]].astype(np.float64)
+    normals[faces["plane_side"] != 0] *= -1
+
+    return FaceArrays(loop_vertices, loop_start, loop_total, faces["texture_info"].astype(np.int64), normals,
+                      faces["lightmap_styles"], faces["lightmap_offset"])
+
+
+@dataclass
+class LightmapExtents:
+    # texture coordinates of the first texel divided by 16 (one lightmap texel covers 16×16 texture pixels)
+    texture_mins: np.ndarray
+    # (n_faces, 2) width and height of the lightmap of each face in texels
+    sizes: np.ndarray
+    # number of lightmaps (one per light style) stored one after another per face, 0 for faces without lightmap
+    n_styles: np.ndarray
+    # index of the first texel of each face in get_lightmap_array, -1 for faces without lightmap
+    first_texel: np.ndarray
+
+
+def get_lightmap_extents(bsp, face_arrays: FaceArrays = None) -> LightmapExtents:
+    """
+    Calculates lightmap size and position of all faces at once, the way the engine does it from the texture
+    coordinates of the face vertices
+    :param bsp: Q2BSP object
+    :param face_arrays: FaceArrays object, created if missing
+    :return: LightmapExtents object
+    """
+    if face_arrays is None:
+        face_arrays = get_face_arrays(bsp)
+    tex_infos = get_lump_array(bsp, 5, TEX_INFO_DTYPE)[face_arrays.texture_info]
+    corner_tex_infos = np.repeat(tex_infos, face_arrays.loop_total)
+    # the engine calculates texture coordinates in single precision
+    positions = get_vertex_array(bsp)[face_arrays.loop_vertices]
+    coordinates = np.stack([np.einsum("ij,ij->i", positions, corner_tex_infos[axis]) + corner_tex_infos[offset]
+                            for axis, offset in (("u_axis", "u_offset"), ("v_axis", "v_offset"))], axis=1)
+    texture_mins = np.floor(np.minimum.reduceat(coordinates, face_arrays.loop_start, axis=0) / 16).astype(np.int64)
+    texture_maxs = np.ceil(np.maximum.reduceat(coordinates, face_arrays.loop_start, axis=0) / 16).astype(np.int64)
+    sizes = texture_maxs - texture_mins + 1
+
+    # sky and warping surfaces (water, lava, ...) have no lightmap, neither do faces of unlit maps
+    lit = (face_arrays.lightmap_styles[:, 0] != 255) & (face_arrays.lightmap_offsets != 0xFFFFFFFF) & \
+        ((tex_infos["flags"] & (SURF_SKY | SURF_WARP)) == 0) & (len(bsp.binary_lumps[7]) > 0)
+    n_styles = np.where(lit, (face_arrays.lightmap_styles != 255).sum(axis=1), 0)
+    first_texel = np.where(lit, face_arrays.lightmap_offsets.astype(np.int64) // 3, -1)
+    return LightmapExtents(texture_mins, sizes, n_styles, first_texel)
+
+
+def get_face_brightness(bsp, extents: LightmapExtents = None) -> np.ndarray:
+    """
+    Mean luminance of the first light style's lightmap of all faces, one cumulative sum over the lightmap lump instead
+    of a loop over faces
+    :param bsp: Q2BSP object
+    :param extents: LightmapExtents object, calculated if missing
+    :return: brightness in 0..255 per face, NaN for faces without lightmap
+    """
+    if extents is None:
+        extents = get_lightmap_extents(bsp)
+    luminance = get_lightmap_array(bsp) @ np.array([0.2989, 0.5870, 0.1140])
+    cumulative = np.concatenate(([0], np.cumsum(luminance)))
+    lit = extents.first_texel >= 0
+    texels = np.prod(extents.sizes, axis=1)
+    start = np.where(lit, extents.first_texel, 0)
+    end = np.where(lit, np.minimum(start + texels, len(luminance)), 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        brightness = (cumulative[end] - cumulative[start]) / (end - start)
+    brightness[~lit | (end <= start)] = np.nan
+    return brightness
+
+
+def get_face_lightmap(lightmap: np.ndarray, extents: LightmapExtents, face: int, style: int = 0) -> np.ndarray:
+    """
+    :param lightmap: (n_texels, 3) array as returned by get_lightmap_array
+    :param extents: LightmapExtents object
+    :param face: face index
+    :param style: index of the light style of the face (not the light style number)
+    :return: (height, width, 3) view on the lightmap of the face, changes are written to lightmap
+    """
+    width, height = extents.sizes[face]
+    start = extents.first_texel[face] + style * width * height
+    return lightmap[start:start + width * height].reshape(height, width, 3)
+
+
+def get_face_bounds(vertices: np.ndarray, face_arrays: FaceArrays):
+    """
+    Axis aligned bounding boxes and centers of all faces
+    :param vertices: (n, 3) array of vertex positions
+    :param face_arrays: FaceArrays object
+    :return: (n_faces, 3) arrays of minimum, maximum and mean vertex positions
+    """
+    loop_positions = vertices[face_arrays.loop_vertices]
+    bbox_min = np.minimum.reduceat(loop_positions, face_arrays.loop_start, axis=0)
+    bbox_max = np.maximum.reduceat(loop_positions, face_arrays.loop_start, axis=0)
+    centers = np.add.reduceat(loop_positions, face_arrays.loop_start, axis=0) / face_arrays.loop_total[:, None]
+    return bbox_min, bbox_max, centers
+
+
+def get_texture_flags(bsp) -> np.ndarray:
+    """
+    :param bsp: Q2BSP object
+    :return: surface flag bit field per texture information entry
+    """
+    return get_lump_array(bsp, 5, TEX_INFO_DTYPE)["flags"]
+
+
+def get_pvs_array(bsp, cluster: int) -> np.ndarray:
+    """
+    Decompresses potentially visible set of a cluster
+    :param bsp: Q2BSP object
+    :param cluster: cluster index, -1 (camera outside of the map) or unvised maps mark all clusters visible
+    :return: bool array, True for each cluster that is potentially visible from cluster
+    """
+    if cluster < 0 or cluster >= bsp.n_clusters:
+        return np.ones(max(bsp.n_clusters, 1), dtype=bool)
+    pvs = np.array(bsp.clusters[cluster].get_pvs(), dtype=np.uint8)
+    visible = np.unpackbits(pvs, bitorder="little").astype(bool)
+    if len(visible) < bsp.n_clusters:
+        visible = np.concatenate((visible, np.zeros(bsp.n_clusters - len(visible), dtype=bool)))
+    return visible[:bsp.n_clusters]
+
+
+def find_leaf(bsp, point) -> int:
+    """
+    Walks down the bsp tree to the leaf containing a point
+    :param bsp: Q2BSP object
+    :param point: x, y, z position
+    :return: leaf index
+    """
+    nodes = get_lump_array(bsp, 4, NODE_DTYPE)
+    planes = get_lump_array(bsp, 1, PLANE_DTYPE)
+    # the first model's head node is the root of the world's bsp tree
+    node = int(get_lump_array(bsp, 13, MODEL_DTYPE)["head_node"][0]) if len(bsp.binary_lumps[13]) else 0
+    while node >= 0:
+        plane = planes[nodes["plane"][node]]
+        distance = float(np.dot(plane["normal"], point)) - float(plane["distance"])
+        node = int(nodes["front_child"][node] if distance >= 0 else nodes["back_child"][node])
+    # leaves are referenced as -(leaf index + 1)
+    return -node - 1
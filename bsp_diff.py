@@ -0,0 +1,158 @@
+# Patches that turn one map file into a modified variant of it, storing only the lumps (or parts of lumps) that differ
+import hashlib
+import struct
+import zlib
+from typing import List, Tuple
+from bsp_patching import get_changed_ranges
+
+PATCH_MAGIC = b"BSPP"
+PATCH_VERSION = 1
+# header is magic + version, then offset and length of the 19 lumps
+BSP_HEADER_SIZE = 8 + 8 * 19
+
+# record types of the patch body
+RECORD_RANGES = 0  # lump of the source with some byte ranges replaced
+RECORD_DATA = 1  # lump stored completely
+RECORD_GAP = 2  # bytes of the target file that don't belong to any lump (padding, unused space)
+
+
+def get_lump_positions(data: bytes) -> List[Tuple[int, int]]:
+    """
+    :param data: content of a bsp file
+    :return: offset and length of all 19 lumps as stored in the header
+    """
+    return [struct.unpack_from("<II", data, 8 + 8 * lump) for lump in range(19)]
+
+
+def create_patch(source_path: str, target_path: str, patch_path: str) -> int:
+    """
+    Stores the differences between two maps lump by lump, apply_patch recreates the target from source and patch
+    Lumps of the same length are stored as changed byte ranges, others completely, everything is compressed
+    :param source_path: full path to the original map
+    :param target_path: full path to the modified map
+    :param patch_path: full path of the patch file
+    :return: size of the patch file in bytes
+    """
+    with open(source_path, "rb") as f:
+        source = f.read()
+    with open(target_path, "rb") as f:
+        target = f.read()
+    source_positions = get_lump_positions(source)
+    target_positions = get_lump_positions(target)
+
+    body = [target[:BSP_HEADER_SIZE]]
+    covered = [(0, BSP_HEADER_SIZE)]
+    for lump, (offset, length) in enumerate(target_positions):
+        covered.append((offset, offset + length))
+        source_offset, source_length = source_positions[lump]
+        if source_length == length:
+            ranges = get_changed_ranges(source[source_offset:source_offset + length], target[offset:offset + length])
+            body.append(struct.pack("<BBI", RECORD_RANGES, lump, len(ranges)))
+            for start, end in ranges:
+                body.append(struct.pack("<II", start, end - start) + target[offset + start:offset + end])
+        else:
+            body.append(struct.pack("<BBI", RECORD_DATA, lump, length) + target[offset:offset + length])
+
+    # everything not covered by the header or a lump, usually a few padding bytes after each lump
+    position = 0
+    for start, end in sorted(covered):
+        if start > position:
+            body.append(struct.pack("<BII", RECORD_GAP, position, start - position) + target[position:start])
+        position = max(position, end)
+    if position < len(target):
+        body.append(struct.pack("<BII", RECORD_GAP, position, len(target) - position) + target[position:])
+
+    with open(patch_path, "wb") as f:
+        f.write(PATCH_MAGIC + struct.pack("<II", PATCH_VERSION, len(target)))
+        f.write(hashlib.sha256(source).digest() + hashlib.sha256(target).digest())
+        f.write(zlib.compress(b"".join(body), 9))
+        return f.tell()
+
+
+def _apply_records(source: bytes, body: bytes, target_size: int) -> bytearray:
+    """
+    Builds the target file from the decompressed patch body
+    :param source: content of the original map
+    :param body: decompressed patch body, header of the target followed by records
+    :param target_size: size of the target file in bytes
+    :return: content of the target file
+    :raises ValueError: if a record points outside of the body, the source or the target
+    """
+    def check(condition: bool, message: str) -> None:
+        if not condition:
+            raise ValueError(message)
+
+    check(len(body) >= BSP_HEADER_SIZE and target_size >= BSP_HEADER_SIZE, "no bsp header")
+    target = bytearray(target_size)
+    target[:BSP_HEADER_SIZE] = body[:BSP_HEADER_SIZE]
+    target_positions = get_lump_positions(target)
+    source_positions = get_lump_positions(source)
+    position = BSP_HEADER_SIZE
+    while position < len(body):
+        record_type = body[position]
+        if record_type == RECORD_GAP:
+            offset, length = struct.unpack_from("<II", body, position + 1)
+            position += 9
+            check(offset + length <= target_size, "gap outside of the map")
+            check(position + length <= len(body), "gap data is cut off")
+            target[offset:offset + length] = body[position:position + length]
+            position += length
+            continue
+        check(record_type in [RECORD_RANGES, RECORD_DATA], f"unknown record type {record_type}")
+        lump, count = struct.unpack_from("<BI", body, position + 1)
+        position += 6
+        check(lump < 19, f"lump {lump} doesn't exist")
+        offset, length = target_positions[lump]
+        check(offset + length <= target_size, f"lump {lump} outside of the map")
+        if record_type == RECORD_DATA:
+            check(count == length and position + length <= len(body), f"data of lump {lump} is cut off")
+            target[offset:offset + length] = body[position:position + length]
+            position += length
+        else:
+            source_offset, source_length = source_positions[lump]
+            check(source_length == length and source_offset + length <= len(source),
+                  f"lump {lump} has another size in the source")
+            target[offset:offset + length] = source[source_offset:source_offset + length]
+            for _ in range(count):
+                start, range_length = struct.unpack_from("<II", body, position)
+                position += 8
+                check(start + range_length <= length, f"changed range outside of lump {lump}")
+                check(position + range_length <= len(body), f"changed range of lump {lump} is cut off")
+                target[offset + start:offset + start + range_length] = body[position:position + range_length]
+                position += range_length
+    return target
+
+
+def apply_patch(source_path: str, patch_path: str, output_path: str) -> bool:
+    """
+    Recreates the modified map a patch was created from, byte for byte
+    :param source_path: full path to the original map the patch was created from
+    :param patch_path: full path to patch file created by create_patch
+    :param output_path: full path of the recreated map
+    :return: True if the map was recreated, False if patch and source don't match
+    """
+    with open(source_path, "rb") as f:
+        source = f.read()
+    with open(patch_path, "rb") as f:
+        patch = f.read()
+    # magic, version, target size and two sha256 hashes
+    if len(patch) < 76 or not patch[:4] == PATCH_MAGIC or not struct.unpack_from("<I", patch, 4)[0] == PATCH_VERSION:
+        print(f"Error: {patch_path} is no map patch of version {PATCH_VERSION}")
+        return False
+    target_size = struct.unpack_from("<I", patch, 8)[0]
+    source_hash, target_hash = patch[12:44], patch[44:76]
+    if not hashlib.sha256(source).digest() == source_hash:
+        print(f"Error: {patch_path} was created for another map than {source_path}")
+        return False
+    try:
+        target = _apply_records(source, zlib.decompress(patch[76:]), target_size)
+    except (zlib.error, struct.error, IndexError, ValueError) as e:
+        print(f"Error: {patch_path} is truncated or corrupt ({e})")
+        return False
+
+    if not hashlib.sha256(target).digest() == target_hash:
+        print(f"Error: map recreated from {patch_path} differs from the original one")
+        return False
+    with open(output_path, "wb") as f:
+        f.write(target)
+    return True
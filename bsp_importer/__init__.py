@@ -7,9 +7,15 @@ bl_info = {
     "category": "Import-Export"
 }
 
+try:
+    import bpy
+except ImportError:
+    # outside of blender only the modules without bpy, e.g. mesh_buffers for tests and benchmarks, are imported
+    bpy = None
+
 # To support reload properly, try to access a package var,
 # if it's there, reload everything
-if "bpy" in locals():
+if "mesh_buffers" in locals():
     import importlib
     try:
         # relative import in release
@@ -18,10 +24,14 @@ if "bpy" in locals():
         # absolute import in development
         import Q2BSP
         importlib.reload(Q2BSP)
-    importlib.reload(blender_load_bsp)
+    importlib.reload(mesh_buffers)
+    if bpy:
+        importlib.reload(blender_load_bsp)
     print("Reloaded multifiles")
 else:
-    from . import blender_load_bsp
+    from . import mesh_buffers
+    if bpy:
+        from . import blender_load_bsp
     print("Imported multifiles")
 
 """
@@ -31,54 +41,67 @@ Code is taken from Templates > Python > Operator File Import in Text Editor
 The code here calls blender_load_bsp
 """
 
-# ImportHelper is a helper class, defines filename and
-# invoke() function which calls the file selector.
-import bpy
-from bpy_extras.io_utils import ImportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
-from bpy.types import Operator
+if bpy:
+    # ImportHelper is a helper class, defines filename and
+    # invoke() function which calls the file selector.
+    from bpy_extras.io_utils import ImportHelper
+    from bpy.props import StringProperty, BoolProperty, EnumProperty
+    from bpy.types import Operator
+
+
+    class ImportSomeData(Operator, ImportHelper):
+        """Loads a Quake 2 BSP File"""
+        bl_idname = "import_bsp.some_data"  # important since its how bpy.ops.import_test.some_data is constructed
+        bl_label = "Import BSP"
+
+        ## ImportHelper mixin class uses this
+        # filename_ext = ".bsp"
 
+        filter_glob: StringProperty(
+            default="*.*",  # only shows bsp files in opening screen
+            options={'HIDDEN'},
+            maxlen=255,  # Max internal buffer length, longer would be clamped.
+        )
 
-class ImportSomeData(Operator, ImportHelper):
-    """Loads a Quake 2 BSP File"""
-    bl_idname = "import_bsp.some_data"  # important since its how bpy.ops.import_test.some_data is constructed
-    bl_label = "Import BSP"
+        # List of operator properties, the attributes will be assigned
+        # to the class instance from the operator settings before calling.
+        displayed_name: StringProperty(name="Displayed name",
+                                                 description="What this model should be named in the outliner\ngood for default file names like tris.md2",
+                                                 default="",
+                                                 maxlen=1024)
 
-    ## ImportHelper mixin class uses this
-    # filename_ext = ".bsp"
+        split_models: BoolProperty(name="Split by model",
+                                   description="One object per brush model (world, doors, platforms, ...)",
+                                   default=False)
 
-    filter_glob: StringProperty(
-        default="*.*",  # only shows bsp files in opening screen
-        options={'HIDDEN'},
-        maxlen=255,  # Max internal buffer length, longer would be clamped.
-    )
+        split_textures: BoolProperty(name="Split by texture",
+                                     description="One object per texture",
+                                     default=False)
 
-    # List of operator properties, the attributes will be assigned
-    # to the class instance from the operator settings before calling.
-    displayed_name: StringProperty(name="Displayed name",
-                                             description="What this model should be named in the outliner\ngood for default file names like tris.md2",
-                                             default="",
-                                             maxlen=1024)
+        skip_tool_faces: BoolProperty(name="Skip invisible faces",
+                                      description="Leave out faces with nodraw, sky, skip and hint textures",
+                                      default=True)
 
-    def execute(self, context):
-        return blender_load_bsp.blender_load_bsp(self.filepath, self.displayed_name)
+        def execute(self, context):
+            return blender_load_bsp.blender_load_bsp(self.filepath, self.displayed_name, self.split_models,
+                                                     self.split_textures, self.skip_tool_faces)
 
 
-# Only needed if you want to add into a dynamic menu
-def menu_func_import(self, context):
-    self.layout.operator(ImportSomeData.bl_idname, text="WIP Quake 2 Level Import (.bsp)")
+    # Only needed if you want to add into a dynamic menu
+    def menu_func_import(self, context):
+        self.layout.operator(ImportSomeData.bl_idname, text="WIP Quake 2 Level Import (.bsp)")
 
 
-# called when addon is activated (adds script to File > Import
-def register():
-    bpy.utils.register_class(ImportSomeData)
-    bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    # called when addon is activated (adds script to File > Import
+    def register():
+        bpy.utils.register_class(ImportSomeData)
+        bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
 
 
-# called when addon is deactivated (removed script from menu)
-def unregister():
-    bpy.utils.unregister_class(ImportSomeData)
-    bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+    # called when addon is deactivated (removed script from menu)
+    def unregister():
+        bpy.utils.unregister_class(ImportSomeData)
+        bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
 
 
 if __name__ == "__main__":
@@ -4,11 +4,12 @@ try:
 except ImportError:
     # absolute import for development
     import Q2BSP
+from . import mesh_buffers
 import os
 import bpy
 
 
-def blender_load_bsp(object_path, displayed_name):
+def blender_load_bsp(object_path, displayed_name, split_models=False, split_textures=False, skip_tool_faces=True):
     """ Create Q2BSP dataclass object """
     # A class containing (most) information stored in a .bsp file
     my_map = Q2BSP.Q2BSP(object_path)
@@ -23,24 +24,37 @@ def blender_load_bsp(object_path, displayed_name):
         print(displayed_name)
         object_name = displayed_name
 
-    """ Lots of code (copy and pasted) that creates a mesh and adds it to the scene collection/outlines """
-    mesh = bpy.data.meshes.new(object_name)  # add the new mesh, * extracts string from list
-    obj = bpy.data.objects.new(mesh.name, mesh)
-    col = bpy.data.collections.get("Collection")
-    col.objects.link(obj)
-    bpy.context.view_layer.objects.active = obj
-
-    edges = [my_map.edge_list[x] if x >= 0 else my_map.edge_list[-x][::-1] for x in my_map.face_edges]
-
-    faces_verts = []
-    for face in my_map.faces:
-        face_verts = []
-        face_verts.append(edges[face.first_edge][0])
-        for offset in range(1, face.num_edges):
-            face_verts.append(edges[face.first_edge + offset][0])
-        faces_verts.append(face_verts)
+    # texture sizes are only needed for scaling texture coordinates, they are read from the texture file headers
+    texture_dir = mesh_buffers.find_texture_dir(object_path)
+    texture_sizes = mesh_buffers.get_texture_sizes(
+        texture_dir, list(set(mesh_buffers.get_texture_names(my_map)))) if texture_dir else dict()
 
-    mesh.from_pydata(my_map.vertices, [], faces_verts)
+    col = bpy.data.collections.get("Collection")
+    if split_models or split_textures:
+        # all parts of the map in their own collection
+        parent = col
+        col = bpy.data.collections.new(object_name)
+        parent.children.link(col)
+
+    # parts with identical geometry (e.g. copies of the same door) share one mesh
+    meshes = dict()
+    parts = mesh_buffers.get_object_parts(my_map, object_name, split_models, split_textures,
+                                          mesh_buffers.TOOL_FACE_FLAGS if skip_tool_faces else 0)
+    for part in parts:
+        buffers = mesh_buffers.build_mesh_buffers(my_map, part.faces, texture_sizes, part.pivot)
+        key = mesh_buffers.get_geometry_key(buffers)
+        if key not in meshes:
+            mesh = bpy.data.meshes.new(part.name)
+            # one material per texture, shared by all imports using the same texture
+            for name in buffers.materials:
+                mesh.materials.append(bpy.data.materials.get(name) or bpy.data.materials.new(name))
+            mesh_buffers.fill_mesh(mesh, buffers, bpy.app.version < (4, 0, 0))
+            mesh.validate()
+            mesh.update(calc_edges=True)
+            meshes[key] = mesh
+        obj = bpy.data.objects.new(part.name, meshes[key])
+        obj.location = part.location.tolist()
+        col.objects.link(obj)
+        bpy.context.view_layer.objects.active = obj
+    print(f"Imported {len(parts)} objects with {len(meshes)} meshes")
     return {'FINISHED'}  # no idea, seems to be necessary for the UI
-
-
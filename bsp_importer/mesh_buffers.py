@@ -0,0 +1,262 @@
+"""
+Builds flat NumPy buffers for blender meshes from the lumps of a bsp file
+Doesn't depend on bpy, fill_mesh only uses the mesh attributes it writes to
+"""
+try:
+    # same directory import in released version
+    from . import bsp_arrays, texture_index
+except ImportError:
+    # absolute import for development
+    import bsp_arrays
+    import texture_index
+try:
+    from PIL import Image
+except ImportError:
+    # blender doesn't ship with pillow, only .png and .wal sizes are read then
+    Image = None
+import hashlib
+import os
+import struct
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+# size assumed for textures that can't be found, quake 2 textures are usually 64×64 or larger
+DEFAULT_TEXTURE_SIZE = (64, 64)
+# faces with these surface flags are never visible in game
+TOOL_FACE_FLAGS = bsp_arrays.SURF_NODRAW | bsp_arrays.SURF_SKY | bsp_arrays.SURF_SKIP | bsp_arrays.SURF_HINT
+
+
+@dataclass
+class MeshBuffers:
+    # (n_vertices, 3) positions of the vertices used by the faces
+    vertices: np.ndarray
+    # vertex index of every corner (loop) of every face, faces are stored one after another
+    loop_vertices: np.ndarray
+    # index of first loop and number of loops per face
+    loop_start: np.ndarray
+    loop_total: np.ndarray
+    # (n_loops, 2) texture coordinates of every loop, scaled by the texture size, v pointing up like in blender
+    uvs: np.ndarray
+    # index into materials per face
+    material_indices: np.ndarray
+    # texture names used by the faces, ordered by their first texture information entry
+    materials: List[str]
+
+
+def find_texture_dir(map_path: str) -> Optional[str]:
+    """
+    Looks for the textures directory of the game media folder the map is stored in, e.g. pball/maps/beta/x.bsp
+    -> pball/textures
+    :param map_path: full path to bsp file
+    :return: path to textures directory, None if there is none
+    """
+    directory = os.path.dirname(os.path.abspath(map_path))
+    while True:
+        if os.path.isdir(os.path.join(directory, "textures")):
+            return os.path.join(directory, "textures")
+        if os.path.dirname(directory) == directory:
+            return None
+        directory = os.path.dirname(directory)
+
+
+def get_texture_sizes(texture_dir: str, texture_names: List[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    Reads width and height of textures, only the file headers are read
+    Files are looked up like the renderers do, case insensitive and with texture_index.EXTENSION_PRIORITY
+    :param texture_dir: path to the textures directory of the game media folder
+    :param texture_names: texture names the way they are stored in the bsp file
+    :return: dict of texture name -> width, height for all textures that were found
+    """
+    index = texture_index.TextureIndex(texture_dir)
+    sizes = dict()
+    for name in texture_names:
+        texture_file = index.find(name)
+        if not texture_file:
+            continue
+        extension = os.path.splitext(texture_file.path)[1].lower()
+        if extension == ".wal":
+            with open(texture_file.path, "rb") as f:
+                header = f.read(40)
+            # 32 byte texture name, then width and height
+            if len(header) >= 40:
+                sizes[name] = struct.unpack("<II", header[32:40])
+        elif Image:
+            try:
+                # opening only parses the header, pixels are decoded on first access
+                with Image.open(texture_file.path) as image:
+                    sizes[name] = image.size
+            except OSError:
+                print(f"Error: can't read size of {texture_file.path}")
+        elif extension == ".png":
+            with open(texture_file.path, "rb") as f:
+                header = f.read(24)
+            # IHDR chunk directly follows the 8 byte signature
+            if len(header) >= 24:
+                sizes[name] = struct.unpack(">II", header[16:24])
+    return sizes
+
+
+def get_texture_names(bsp) -> List[str]:
+    """
+    :param bsp: Q2BSP object
+    :return: texture name per texture information entry, without anything after the terminating zero byte
+    """
+    return [x.split(b"\x00")[0].decode("ascii", "ignore")
+            for x in bsp_arrays.get_lump_array(bsp, 5, bsp_arrays.TEX_INFO_DTYPE)["texture_name"]]
+
+
+def build_mesh_buffers(bsp, faces: Optional[np.ndarray] = None,
+                       texture_sizes: Optional[Dict[str, Tuple[int, int]]] = None,
+                       origin: Optional[np.ndarray] = None) -> MeshBuffers:
+    """
+    Resolves all faces into flat vertex, loop and polygon arrays at once
+    :param bsp: Q2BSP object
+    :param faces: indices of the faces to include, all faces if None
+    :param texture_sizes: width and height per texture name for the texture coordinates,
+    DEFAULT_TEXTURE_SIZE for missing textures
+    :param origin: subtracted from all vertex positions, texture coordinates stay the same
+    :return: MeshBuffers object, only vertices used by the faces are included
+    """
+    face_arrays = bsp_arrays.get_face_arrays(bsp)
+    if faces is None:
+        faces = np.arange(len(face_arrays.loop_total))
+    loop_total = face_arrays.loop_total[faces]
+    loop_start = np.cumsum(loop_total) - loop_total
+    loops = np.repeat(face_arrays.loop_start[faces], loop_total) + np.arange(loop_total.sum()) - \
+        np.repeat(loop_start, loop_total)
+    used_vertices, loop_vertices = np.unique(face_arrays.loop_vertices[loops], return_inverse=True)
+    vertices = bsp_arrays.get_vertex_array(bsp)[used_vertices]
+
+    # texture information of every loop, u and v in texture pixels divided by the texture size
+    tex_infos = bsp_arrays.get_lump_array(bsp, 5, bsp_arrays.TEX_INFO_DTYPE)
+    texture_names = get_texture_names(bsp)
+    texture_sizes = texture_sizes or dict()
+    tex_info_sizes = np.array([texture_sizes.get(x, DEFAULT_TEXTURE_SIZE) for x in texture_names],
+                              dtype=np.float64).reshape(-1, 2)
+    loop_tex_infos = np.repeat(face_arrays.texture_info[faces], loop_total)
+    positions = vertices[loop_vertices].astype(np.float64)
+    u = np.einsum("ij,ij->i", positions, tex_infos["u_axis"][loop_tex_infos]) + tex_infos["u_offset"][loop_tex_infos]
+    v = np.einsum("ij,ij->i", positions, tex_infos["v_axis"][loop_tex_infos]) + tex_infos["v_offset"][loop_tex_infos]
+    uvs = np.stack((u / tex_info_sizes[loop_tex_infos, 0], -v / tex_info_sizes[loop_tex_infos, 1]), axis=1)
+
+    # one material per texture name, several texture information entries can use the same texture
+    materials = list()
+    material_ids = dict()
+    tex_info_materials = np.zeros(len(texture_names), dtype=np.int64)
+    for idx in np.unique(face_arrays.texture_info[faces]):
+        name = texture_names[idx]
+        if name not in material_ids:
+            material_ids[name] = len(materials)
+            materials.append(name)
+        tex_info_materials[idx] = material_ids[name]
+
+    if origin is not None:
+        vertices = vertices - origin
+    return MeshBuffers(vertices.astype(np.float32), loop_vertices.reshape(-1).astype(np.int32),
+                       loop_start.astype(np.int32), loop_total.astype(np.int32), uvs.astype(np.float32),
+                       tex_info_materials[face_arrays.texture_info[faces]].astype(np.int32), materials)
+
+
+@dataclass
+class ObjectPart:
+    name: str
+    # face indices of this part
+    faces: np.ndarray
+    # subtracted from the vertex positions
+    pivot: np.ndarray
+    # object location, differs from pivot for models whose vertices are already stored relative to their origin
+    location: np.ndarray
+
+
+def get_object_parts(bsp, name: str, split_models: bool = False, split_textures: bool = False,
+                     skip_flags: int = TOOL_FACE_FLAGS) -> List[ObjectPart]:
+    """
+    Groups faces into separate objects
+    :param bsp: Q2BSP object
+    :param name: object name of the whole map, prefix of all part names
+    :param split_models: one object per model (world, doors, platforms, ...), named <name>/*<model index> like the
+    model references of entities, placed at the "origin" of their entity or the center of their bounding box if it has
+    none (except for the world model *0)
+    :param split_textures: one object per texture, within each model if split_models is set
+    :param skip_flags: faces whose texture information has any of these surface flags are left out
+    :return: list of ObjectPart objects, parts without faces are left out
+    """
+    face_arrays = bsp_arrays.get_face_arrays(bsp)
+    drawn = (bsp_arrays.get_texture_flags(bsp)[face_arrays.texture_info] & skip_flags) == 0
+    models = bsp_arrays.get_lump_array(bsp, 13, bsp_arrays.MODEL_DTYPE)
+    if split_models:
+        # compilers leave the origin of models at 0, vertices of brush entities with an origin brush are stored
+        # relative to the "origin" key of the entity instead
+        entity_origins = dict()
+        for entity in bsp.entities:
+            if "model" in entity and "origin" in entity:
+                try:
+                    entity_origins[entity["model"]] = np.array([float(x) for x in entity["origin"].split()[:3]])
+                except ValueError:
+                    print(f"Error: invalid origin of {entity['model']}: {entity['origin']}")
+        model_faces = list()
+        for idx, model in enumerate(models):
+            model_name = "*" + str(idx)
+            faces = np.arange(model["first_face"], model["first_face"] + model["num_faces"])
+            if model_name in entity_origins and len(entity_origins[model_name]) == 3:
+                model_faces.append((model_name, faces, np.zeros(3), entity_origins[model_name]))
+            else:
+                pivot = np.zeros(3) if idx == 0 else (model["bbox_min"].astype(np.float64) + model["bbox_max"]) / 2
+                model_faces.append((model_name, faces, pivot, pivot))
+    else:
+        model_faces = [("", np.arange(len(face_arrays.loop_total)), np.zeros(3), np.zeros(3))]
+
+    texture_names = get_texture_names(bsp)
+    parts = list()
+    for model_name, faces, pivot, location in model_faces:
+        faces = faces[drawn[faces]]
+        prefix = "/".join(x for x in [name, model_name] if x)
+        if not split_textures:
+            if len(faces):
+                parts.append(ObjectPart(prefix, faces, pivot, location))
+            continue
+        face_textures = np.array([texture_names[x] for x in face_arrays.texture_info[faces]], dtype=object)
+        for texture in dict.fromkeys(face_textures):
+            parts.append(ObjectPart(prefix + "/" + texture, faces[face_textures == texture], pivot, location))
+    return parts
+
+
+def get_geometry_key(buffers: MeshBuffers) -> str:
+    """
+    Hash of everything stored in a mesh, parts with the same key can share one mesh
+    Texture coordinates are compared without whole texture repetitions, which don't change the look
+    :param buffers: MeshBuffers object
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    # adding 0 turns -0.0 into 0.0, which have different bytes
+    sha.update((np.round(buffers.vertices, 3) + 0.0).tobytes())
+    uvs = buffers.uvs - np.floor(buffers.uvs.min(axis=0))
+    sha.update((np.round(uvs, 4) + 0.0).tobytes())
+    for array in [buffers.loop_vertices, buffers.loop_start, buffers.material_indices]:
+        sha.update(array.tobytes())
+    sha.update("\x00".join(buffers.materials).encode())
+    return sha.hexdigest()
+
+
+def fill_mesh(mesh, buffers: MeshBuffers, set_loop_total: bool = True) -> None:
+    """
+    Writes the buffers into an empty mesh with foreach_set instead of creating Python lists per face
+    Materials have to be appended to mesh.materials in the order of buffers.materials
+    :param mesh: empty bpy.types.Mesh or an object with the same collections
+    :param buffers: MeshBuffers object
+    :param set_loop_total: blender 4.0 and later derive loop_total from loop_start, it's read-only there
+    :return: None
+    """
+    mesh.vertices.add(len(buffers.vertices))
+    mesh.vertices.foreach_set("co", buffers.vertices.reshape(-1))
+    mesh.loops.add(len(buffers.loop_vertices))
+    mesh.loops.foreach_set("vertex_index", buffers.loop_vertices)
+    mesh.polygons.add(len(buffers.loop_start))
+    mesh.polygons.foreach_set("loop_start", buffers.loop_start)
+    if set_loop_total:
+        mesh.polygons.foreach_set("loop_total", buffers.loop_total)
+    mesh.polygons.foreach_set("material_index", buffers.material_indices)
+    uv_layer = mesh.uv_layers.new(name="UVMap")
+    uv_layer.data.foreach_set("uv", buffers.uvs.reshape(-1))
@@ -0,0 +1,82 @@
+# Writes edited lumps into existing map files instead of rewriting the whole file
+import mmap
+import os
+import shutil
+import struct
+from typing import Callable, Dict, Iterable, List, Tuple
+import numpy as np
+
+# save methods of the lumps Q2BSP.update_lump_sizes serializes from their decoded objects, all other lumps
+# (e.g. lightmaps edited through bsp_arrays.get_lightmap_array) are stored in binary_lumps directly
+LUMP_SAVERS: Dict[int, Callable] = {
+    0: lambda bsp: bsp.save_entities(bsp.worldspawn, bsp.entities),
+    1: lambda bsp: bsp.save_planes(bsp.planes),
+    3: lambda bsp: bsp.save_vis(bsp.clusters),
+    5: lambda bsp: bsp.save_tex_info(bsp.tex_infos),
+    6: lambda bsp: bsp.save_faces(bsp.faces),
+    8: lambda bsp: bsp.save_bsp_leaves(bsp.bsp_leaves),
+    9: lambda bsp: bsp.save_leaf_faces(bsp.leaf_faces),
+    13: lambda bsp: bsp.save_models(bsp.models),
+    14: lambda bsp: bsp.save_brushes(bsp.brushes),
+}
+
+
+def get_changed_ranges(old: bytes, new: bytes, min_gap: int = 64) -> List[Tuple[int, int]]:
+    """
+    Finds the byte ranges in which two buffers of the same length differ
+    :param old: original bytes
+    :param new: changed bytes, same length as old
+    :param min_gap: ranges closer to each other than this are merged, fewer but slightly larger writes
+    :return: list of (start, end) ranges
+    """
+    changed = np.nonzero(np.frombuffer(old, dtype=np.uint8) != np.frombuffer(new, dtype=np.uint8))[0]
+    if not len(changed):
+        return []
+    # a new range starts wherever the distance to the previous changed byte is at least min_gap
+    breaks = np.nonzero(np.diff(changed) >= min_gap)[0]
+    starts = np.concatenate(([changed[0]], changed[breaks + 1]))
+    ends = np.concatenate((changed[breaks], [changed[-1]])) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def patch_map(bsp, path: str, suffix: str = "", lumps: Iterable[int] = range(19)) -> int:
+    """
+    Stores the lumps of an edited map by writing only changed byte ranges into the map file through mmap
+    Only the given lumps are serialized and compared, so patching a single lump doesn't cost a whole save
+    Only possible if none of them changed its length, otherwise all lumps are serialized with update_lump_sizes and
+    the whole file is written like save_map does
+    e.g. after temp_map.tex_infos[0].set_texture_name("new/name"): patch_map(temp_map, map_path, "_new", [5])
+    :param bsp: Q2BSP object loaded from path
+    :param path: full path to the map file bsp was loaded from
+    :param suffix: if set, the map is copied to a file with this suffix (like save_map does) which is then patched
+    :param lumps: indices of lumps that may have changed, other lumps aren't serialized, read or compared
+    :return: number of written bytes, the size of the whole file if it had to be rewritten
+    """
+    lumps = list(lumps)
+    for lump in lumps:
+        if lump in LUMP_SAVERS:
+            LUMP_SAVERS[lump](bsp)
+    target = path.replace(".bsp", suffix + ".bsp")
+    if not os.path.abspath(target) == os.path.abspath(path):
+        shutil.copyfile(path, target)
+    n_bytes = 0
+    with open(target, "r+b") as f:
+        header = f.read(8 + 8 * 19)
+        positions = [struct.unpack_from("<II", header, 8 + 8 * lump) for lump in range(19)]
+        same_size = header[:4] == bsp.magic.encode() and \
+            all(positions[lump][1] == len(bsp.binary_lumps[lump]) for lump in lumps)
+        if same_size:
+            with mmap.mmap(f.fileno(), 0) as mapped:
+                for lump in lumps:
+                    offset, length = positions[lump]
+                    new = bytes(bsp.binary_lumps[lump])
+                    for start, end in get_changed_ranges(mapped[offset:offset + length], new):
+                        mapped[offset + start:offset + end] = new[start:end]
+                        n_bytes += end - start
+                mapped.flush()
+    if not same_size:
+        # lump sizes changed, offsets of the following lumps change as well
+        bsp.update_lump_sizes()
+        bsp.save_map(path, suffix)
+        return os.path.getsize(target)
+    return n_bytes
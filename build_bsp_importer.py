@@ -4,8 +4,11 @@ import shutil
 # files to include in the output zip file
 files = [
     "Q2BSP.py",
+    "bsp_arrays.py",
+    "texture_index.py",
     "bsp_importer/__init__.py",
-    "bsp_importer/blender_load_bsp.py"
+    "bsp_importer/blender_load_bsp.py",
+    "bsp_importer/mesh_buffers.py"
 ]
 
 # intermediary location for the directory to be zipped
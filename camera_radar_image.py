@@ -0,0 +1,247 @@
+import math
+from dataclasses import dataclass
+from typing import Tuple
+import numpy as np
+from PIL import Image, ImageDraw
+from Q2BSP import Q2BSP
+from bsp_arrays import FaceArrays, get_lump_array, get_vertex_array, get_face_arrays, get_face_bounds, \
+    get_texture_flags, get_pvs_array, find_leaf, NODE_DTYPE, LEAF_DTYPE, MODEL_DTYPE, SURF_SKY, SURF_NODRAW, \
+    SURF_HINT, SURF_SKIP
+from colored_radar_image import get_texture_colors
+
+
+@dataclass
+class CameraScene:
+    bsp: Q2BSP
+    vertices: np.ndarray
+    face_arrays: FaceArrays
+    face_min: np.ndarray
+    face_max: np.ndarray
+    # RGBA color per face, faces with drawable == False are never rendered (sky, nodraw, tool textures)
+    face_colors: np.ndarray
+    drawable: np.ndarray
+    nodes: np.ndarray
+    leaves: np.ndarray
+    leaf_faces: np.ndarray
+    models: np.ndarray
+
+
+def load_camera_scene(path: str, pball_path: str) -> CameraScene:
+    """
+    Loads geometry, bsp tree and face colors once so that any number of views can be rendered from it
+    :param path: full path to map
+    :param pball_path: path to pball / game media directory, needed to get full texture path
+    :return: CameraScene object
+    """
+    temp_map = Q2BSP(path)
+    vertices = get_vertex_array(temp_map).astype(np.float64)
+    face_arrays = get_face_arrays(temp_map)
+    face_min, face_max, _ = get_face_bounds(vertices, face_arrays)
+
+    # mean texture color per texture information entry, then per face
+    texture_list, average_colors = get_texture_colors(temp_map, pball_path)
+    # rgb colors get full opacity, tool textures keep their (0,0,0,0)
+    texture_colors = {texture: (*color, 255)[:4] for texture, color in zip(texture_list, average_colors)}
+    tex_info_colors = np.array([texture_colors[x.get_texture_name()] for x in temp_map.tex_infos],
+                               dtype=np.uint8).reshape(-1, 4)
+    face_colors = tex_info_colors[face_arrays.texture_info]
+    skip_flags = SURF_SKY | SURF_NODRAW | SURF_HINT | SURF_SKIP
+    drawable = ((get_texture_flags(temp_map)[face_arrays.texture_info] & skip_flags) == 0) & (face_colors[:, 3] > 0)
+
+    return CameraScene(temp_map, vertices, face_arrays, face_min, face_max, face_colors, drawable,
+                       get_lump_array(temp_map, 4, NODE_DTYPE), get_lump_array(temp_map, 8, LEAF_DTYPE),
+                       get_lump_array(temp_map, 9, np.dtype("<u2")).astype(np.int64),
+                       get_lump_array(temp_map, 13, MODEL_DTYPE))
+
+
+def get_camera_axes(angles: Tuple[float, float, float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts view angles to camera axes the same way Quake 2 does
+    :param angles: pitch (positive looks down), yaw, roll in degrees
+    :return: forward, right and up vectors
+    """
+    pitch, yaw, roll = [math.radians(x) for x in angles]
+    sp, cp = math.sin(pitch), math.cos(pitch)
+    sy, cy = math.sin(yaw), math.cos(yaw)
+    sr, cr = math.sin(roll), math.cos(roll)
+    forward = np.array([cp * cy, cp * sy, -sp])
+    right = np.array([-sr * sp * cy + cr * sy, -sr * sp * sy - cr * cy, -sr * cp])
+    up = np.array([cr * sp * cy + sr * sy, cr * sp * sy - sr * cy, cr * cp])
+    return forward, right, up
+
+
+def get_frustum_planes(position, angles: Tuple[float, float, float], fov: float, aspect: float,
+                       near: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the planes enclosing everything the camera can see, normals point to the inside
+    :param position: camera position
+    :param angles: pitch, yaw, roll in degrees
+    :param fov: horizontal field of view in degrees
+    :param aspect: image height divided by image width
+    :param near: distance of the near clipping plane
+    :return: (5, 3) plane normals, (5,) plane distances (point p is inside if normal · p >= distance)
+    """
+    forward, right, up = get_camera_axes(angles)
+    tan_x = math.tan(math.radians(fov) / 2)
+    tan_y = tan_x * aspect
+    normals = np.array([forward,
+                        tan_x * forward - right,
+                        tan_x * forward + right,
+                        tan_y * forward - up,
+                        tan_y * forward + up])
+    distances = normals @ np.asarray(position, dtype=np.float64)
+    distances[0] += near
+    return normals, distances
+
+
+def boxes_in_frustum(bbox_min: np.ndarray, bbox_max: np.ndarray, normals: np.ndarray,
+                     distances: np.ndarray) -> np.ndarray:
+    """
+    Conservative test which axis aligned boxes intersect the frustum
+    :param bbox_min: (n, 3) minimum corners
+    :param bbox_max: (n, 3) maximum corners
+    :param normals: frustum plane normals
+    :param distances: frustum plane distances
+    :return: (n,) bool array, False only for boxes that are completely outside of the frustum
+    """
+    centers = (bbox_min + bbox_max) / 2
+    half_sizes = (bbox_max - bbox_min) / 2
+    # distance of the box corner furthest into the inside direction of each plane
+    reach = centers @ normals.T + half_sizes @ np.abs(normals).T
+    return np.all(reach >= distances, axis=1)
+
+
+def get_visible_faces(scene: CameraScene, position, angles: Tuple[float, float, float], fov: float = 90,
+                      aspect: float = 0.75, near: float = 4.0) -> np.ndarray:
+    """
+    Culls faces by the potentially visible set of the camera's cluster, by the view frustum (bsp nodes, then leaves,
+    then faces) and by facing direction
+    :param scene: CameraScene object
+    :param position: camera position
+    :param angles: pitch, yaw, roll in degrees
+    :param fov: horizontal field of view in degrees
+    :param aspect: image height divided by image width
+    :param near: distance of the near clipping plane
+    :return: indices of potentially visible faces
+    """
+    position = np.asarray(position, dtype=np.float64)
+    normals, distances = get_frustum_planes(position, angles, fov, aspect, near)
+
+    # walk down the bsp tree one level at a time, subtrees outside of the frustum are skipped entirely
+    nodes = scene.nodes
+    frontier = np.array([scene.models["head_node"][0] if len(scene.models) else 0], dtype=np.int64)
+    leaf_list = list()
+    while len(frontier):
+        frontier = frontier[boxes_in_frustum(nodes["bbox_min"][frontier].astype(np.float64),
+                                             nodes["bbox_max"][frontier].astype(np.float64), normals, distances)]
+        children = np.concatenate((nodes["front_child"][frontier], nodes["back_child"][frontier])).astype(np.int64)
+        leaf_list.append(-children[children < 0] - 1)
+        frontier = children[children >= 0]
+    leaves = np.concatenate(leaf_list) if leaf_list else np.zeros(0, dtype=np.int64)
+
+    # only leaves in clusters visible from the camera's cluster, solid leaves have no cluster
+    pvs = get_pvs_array(scene.bsp, int(scene.leaves["cluster"][find_leaf(scene.bsp, position)]))
+    clusters = scene.leaves["cluster"][leaves].astype(np.int64)
+    leaves = leaves[(clusters >= 0) & pvs[np.clip(clusters, 0, len(pvs) - 1)]]
+    leaves = leaves[boxes_in_frustum(scene.leaves["bbox_min"][leaves].astype(np.float64),
+                                     scene.leaves["bbox_max"][leaves].astype(np.float64), normals, distances)]
+
+    # faces of the remaining leaves from the leaf face table
+    first = scene.leaves["first_leaf_face"][leaves].astype(np.int64)
+    total = scene.leaves["num_leaf_faces"][leaves].astype(np.int64)
+    offsets = np.arange(total.sum()) - np.repeat(np.cumsum(total) - total, total)
+    faces = scene.leaf_faces[np.repeat(first, total) + offsets]
+
+    # brush models (doors, platforms, ...) aren't part of the leaves, they are culled by their bounding box
+    models = scene.models[1:]
+    models = models[boxes_in_frustum(models["bbox_min"].astype(np.float64), models["bbox_max"].astype(np.float64),
+                                     normals, distances)]
+    model_faces = [np.arange(x["first_face"], x["first_face"] + x["num_faces"]) for x in models]
+    faces = np.unique(np.concatenate([faces] + model_faces).astype(np.int64))
+
+    faces = faces[scene.drawable[faces]]
+    faces = faces[boxes_in_frustum(scene.face_min[faces], scene.face_max[faces], normals, distances)]
+    # faces are planar, so any vertex tells on which side of the face the camera is
+    first_vertices = scene.vertices[scene.face_arrays.loop_vertices[scene.face_arrays.loop_start[faces]]]
+    facing = np.einsum("ij,ij->i", scene.face_arrays.normals[faces], position - first_vertices) > 0
+    return faces[facing]
+
+
+def clip_near(points: np.ndarray, near: float) -> np.ndarray:
+    """
+    Clips polygon in camera space against the near plane (Sutherland-Hodgman)
+    :param points: (n, 3) corners as right, up, depth coordinates
+    :param near: distance of the near clipping plane
+    :return: (m, 3) corners of the part in front of the near plane
+    """
+    clipped = list()
+    for idx in range(len(points)):
+        current, following = points[idx], points[(idx + 1) % len(points)]
+        if current[2] >= near:
+            clipped.append(current)
+        if (current[2] >= near) != (following[2] >= near):
+            t = (near - current[2]) / (following[2] - current[2])
+            clipped.append(current + t * (following - current))
+    return np.array(clipped).reshape(-1, 3)
+
+
+def render_camera_view(scene: CameraScene, position, angles: Tuple[float, float, float], fov: float = 90,
+                       size: Tuple[int, int] = (1024, 768), near: float = 4.0) -> Image.Image:
+    """
+    Renders the map from a camera position, only potentially visible faces are projected and drawn
+    :param scene: CameraScene object
+    :param position: camera position, e.g. player origin + 22 units view height
+    :param angles: pitch (positive looks down), yaw, roll in degrees
+    :param fov: horizontal field of view in degrees
+    :param size: image width and height
+    :param near: distance of the near clipping plane
+    :return: RGBA Image object
+    """
+    width, height = size
+    position = np.asarray(position, dtype=np.float64)
+    faces = get_visible_faces(scene, position, angles, fov, height / width, near)
+
+    # camera space coordinates of all corners of the visible faces
+    forward, right, up = get_camera_axes(angles)
+    face_arrays = scene.face_arrays
+    totals = face_arrays.loop_total[faces]
+    starts = np.cumsum(totals) - totals
+    loops = np.repeat(face_arrays.loop_start[faces], totals) + np.arange(totals.sum()) - np.repeat(starts, totals)
+    relative = scene.vertices[face_arrays.loop_vertices[loops]] - position
+    camera_space = np.stack((relative @ right, relative @ up, relative @ forward), axis=1)
+
+    # painter's algorithm: the further away the face, the earlier it is drawn
+    depths = np.add.reduceat(camera_space[:, 2], starts) / totals if len(faces) else np.zeros(0)
+    order = np.argsort(-depths, kind="stable")
+
+    focal = width / 2 / math.tan(math.radians(fov) / 2)
+    img = Image.new("RGBA", (width, height), (255, 255, 255, 100))
+    draw = ImageDraw.Draw(img, "RGBA")
+    for idx in order:
+        points = camera_space[starts[idx]:starts[idx] + totals[idx]]
+        if points[:, 2].min() < near:
+            points = clip_near(points, near)
+            if len(points) < 3:
+                continue
+        screen_x = width / 2 + points[:, 0] * focal / points[:, 2]
+        screen_y = height / 2 - points[:, 1] * focal / points[:, 2]
+        draw.polygon(list(zip(screen_x, screen_y)), fill=tuple(int(x) for x in scene.face_colors[faces[idx]]),
+                     outline=(0, 0, 0))
+    return img
+
+
+def create_camera_image(path: str, pball_path: str, position, angles: Tuple[float, float, float], image_path: str,
+                        fov: float = 90, size: Tuple[int, int] = (1024, 768)) -> None:
+    """
+    Renders the map from a player's perspective and stores the image
+    :param path: full path to map
+    :param pball_path: path to pball / game media directory
+    :param position: camera position
+    :param angles: pitch, yaw, roll in degrees
+    :param image_path: path to store image to
+    :param fov: horizontal field of view in degrees
+    :param size: image width and height
+    :return: None
+    """
+    scene = load_camera_scene(path, pball_path)
+    render_camera_view(scene, position, angles, fov, size).save(image_path)
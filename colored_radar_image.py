@@ -1,10 +1,18 @@
 import copy
+import math
 import os
-from typing import Optional
+import operator
+from dataclasses import dataclass, astuple
+from statistics import mean
+from typing import Dict, List, Optional, Tuple
 import numpy as np
-from PIL import WalImageFile
-from Q2BSP import *
-import matplotlib.pyplot as plt
+from PIL import Image, ImageDraw
+from Q2BSP import Q2BSP, point3f
+from bsp_arrays import get_face_arrays, get_face_brightness, get_texture_flags, get_vertex_array, SURF_HINT, \
+    SURF_NODRAW, SURF_SKY, SURF_SKIP
+from texture_colors import get_mean_color, save_color_cache
+from svg_output import write_svg
+from texture_index import get_texture_index
 
 
 @dataclass
@@ -17,73 +25,40 @@ class Polygon:
         return iter(astuple(self))
 
 
-def get_polygons(path: str, pball_path: str) -> Tuple[List[Polygon], List[Tuple[int]]]:
+def get_texture_colors(temp_map: Q2BSP, pball_path: str) -> Tuple[List[str], List[Tuple[int]]]:
     """
-    Converts information from Q2BSP object into List of Polygon objects
-    Calculates mean color of all used textures and builds list of all unique colors
-    :param path: full path to map
+    Calculates mean color of all textures used by the map
+    :param temp_map: Q2BSP object
     :param pball_path: path to pball / game media directory, needed to get full texture path
-    :return: list of Polygon objects, list of RGB colors
+    :return: list of unique texture names, list of RGB colors in the same order ((0,0,0,0) for tool textures)
     """
-    # instead of directly reading all information from file, the Q2BSP class is used for reading
-    temp_map = Q2BSP(path)
-
-
     # get a list of unique texture names (which are stored without an extension -> multiple ones must be tested)
     texture_list = [x.get_texture_name() for x in temp_map.tex_infos]
     texture_list_cleaned = list(dict.fromkeys(texture_list))
     # iterate through texture list, look which one exists, load, rescale to 1×1 pixel = color is mean color
     average_colors = list()
-    skip_faces = list()
 
+    # texture files are looked up in an index of the texture directory instead of listing directories per texture
+    texture_index = get_texture_index(pball_path)
     for texture in texture_list_cleaned:
         color = (0, 0, 0)
-        if not os.path.exists(pball_path+"/textures/"+"/".join(texture.lower().split("/")[:-1])):
+        if not texture_index.has_directory("/".join(texture.lower().split("/")[:-1])):
             print(f"Info: no such path {pball_path+'/textures/'+'/'.join(texture.lower().split('/')[:-1])}")
             # sets (0,0,0) as default color for missing textures
             average_colors.append((0,0,0))
             continue
 
-        # list of all files in stored subdirectory
-        texture_options = os.listdir(pball_path+"/textures/"+"/".join(texture.lower().split("/")[:-1]))
-        texture_path = ""
-        # iterate through texture options until one name matches stored texture name
-        for idx, tex_option in enumerate(texture_options):
-            if texture.split("/")[-1].lower() == os.path.splitext(tex_option)[0]:
-                texture_path = "/".join(texture.lower().split("/")[:-1]) + "/" + tex_option
-                break
-
+        texture_file = texture_index.find(texture)
         # texture was not found in specified subdirectory
-        if not texture_path:
+        if not texture_file:
             print("Missing texture: ", texture)
             average_colors.append((0, 0, 0))
             continue
 
-        if os.path.splitext(texture_path)[1] in [".png", ".jpg", ".tga"]:
-            img = Image.open(pball_path + "/textures/" + texture_path)
-            img2 = img.resize((1, 1))
-            img2 = img2.convert("RGBA")
-            img2 = img2.load()
-            color = img2[0, 0]
-
-        elif os.path.splitext(texture_path)[1] == ".wal":
-            # wal files are 8 bit and require a palette
-            with open("pb2e.pal", "r") as pal:
-                conts = (pal.read().split("\n")[3:])
-                conts = [b.split(" ") for b in conts]
-                conts = [c for b in conts for c in b]
-                conts.pop(len(conts) - 1)
-                conts = list(map(int, conts))
-                img3 = WalImageFile.open(pball_path + "/textures/" + texture_path)
-                img3.putpalette(conts)
-                img3 = img3.convert("RGBA")
-
-                img2 = img3.resize((1, 1))
-
-                color = img2.getpixel((0, 0))
-        else:
-            print(f"Error: unsupported format {os.path.splitext(texture_path)[1]} in {texture_path}"
-                  f"\nsupported formats are .png, .jpg, .tga, .wal")
+        # mean color is only calculated once per texture file and then read from the texture color cache
+        color = get_mean_color(texture_file.path)
+        if color is None:
+            color = (0, 0, 0)
 
         color_rgb = color[:3]
         if color_rgb == (0, 0, 0):
@@ -92,6 +67,23 @@ def get_polygons(path: str, pball_path: str) -> Tuple[List[Polygon], List[Tuple[
             print(texture)
             color_rgb = (0,0,0,0)  # actually rgba
         average_colors.append(color_rgb)
+    save_color_cache()
+
+    return texture_list_cleaned, average_colors
+
+
+def get_polygons(path: str, pball_path: str) -> Tuple[List[Polygon], List[Tuple[int]]]:
+    """
+    Converts information from Q2BSP object into List of Polygon objects
+    Calculates mean color of all used textures and builds list of all unique colors
+    :param path: full path to map
+    :param pball_path: path to pball / game media directory, needed to get full texture path
+    :return: list of Polygon objects, list of RGB colors
+    """
+    # instead of directly reading all information from file, the Q2BSP class is used for reading
+    temp_map = Q2BSP(path)
+    texture_list = [x.get_texture_name() for x in temp_map.tex_infos]
+    texture_list_cleaned, average_colors = get_texture_colors(temp_map, pball_path)
 
     # instead of storing face color directly in the Polygon object, store an index so that you can easily change one
     # color for all faces using the same one
@@ -242,7 +234,7 @@ def get_rot_polys(polys: List[Polygon], x_angle: float, y_angle: float, z_angle:
     return faces
 
 
-def create_poly_image(polys: List[Polygon], ax: plt.axes, average_colors: List[Tuple[int]], perspective: bool,
+def create_poly_image(polys: List[Polygon], ax: "matplotlib.axes.Axes", average_colors: List[Tuple[int]], perspective: bool,
                       max_resolution: int = 2048, fov: int = 50) -> Optional[Image.Image]:
     """
     Draws radar image and assigns it to axes or returns it
@@ -330,4 +322,213 @@ def create_poly_image(polys: List[Polygon], ax: plt.axes, average_colors: List[T
         return img
     else:
         ax.axis("off")
-        ax.imshow(img)
\ No newline at end of file
+        ax.imshow(img)
+
+@dataclass
+class PackedPolygons:
+    # corners of all faces stored one after another, face i has corners loop_start[i]:loop_start[i]+loop_total[i]
+    vertices: np.ndarray
+    loop_start: np.ndarray
+    loop_total: np.ndarray
+    normals: np.ndarray
+    # RGBA per face, alpha 0 for faces that aren't drawn (tool textures) but still count for the image bounds
+    colors: np.ndarray
+
+
+@dataclass
+class ProjectedPolygons:
+    # projected x and y coordinate of each corner, NaN for corners behind the camera
+    points: np.ndarray
+    loop_start: np.ndarray
+    loop_total: np.ndarray
+    # indices of faces to draw, ordered back to front
+    order: np.ndarray
+    colors: np.ndarray
+    # bounds of the projected coordinates, used to scale them to pixels
+    pmin_x: int
+    pmin_y: int
+    pmax_x: int
+    pmax_y: int
+
+
+# lightmap shading factor per face of each map file, only recalculated when size or modification time change
+_lightmap_shadings: Dict[str, Tuple[int, int, np.ndarray]] = dict()
+
+
+def get_lightmap_shading(path: str, temp_map: Q2BSP) -> np.ndarray:
+    """
+    Factor for the color of each face, mean lightmap brightness relative to the brightest faces of the map
+    :param path: full path to map, used as cache key
+    :param temp_map: Q2BSP object loaded from path
+    :return: factor in 0..1 per face, 1 for faces without lightmap (sky, water, unlit maps)
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if key in _lightmap_shadings and _lightmap_shadings[key][:2] == (stat.st_size, stat.st_mtime_ns):
+        return _lightmap_shadings[key][2]
+    brightness = get_face_brightness(temp_map)
+    lit = ~np.isnan(brightness)
+    # relative to the 99th percentile so that few very bright faces don't darken everything else
+    reference = max(np.percentile(brightness[lit], 99), 1) if lit.any() else 1
+    shading = np.where(lit, np.clip(np.nan_to_num(brightness) / reference, 0, 1), 1)
+    _lightmap_shadings[key] = (stat.st_size, stat.st_mtime_ns, shading)
+    return shading
+
+
+def load_packed_polygons(path: str, pball_path: str, lightmap_shading: bool = False) -> PackedPolygons:
+    """
+    Loads geometry and colors into packed arrays, the same faces and colors as get_polygons
+    Intended for rendering many views of the same map, e.g. animations
+    :param path: full path to map
+    :param pball_path: path to pball / game media directory, needed to get full texture path
+    :param lightmap_shading: darken face colors by their mean lightmap brightness, shows dark areas of the map
+    :return: PackedPolygons object
+    """
+    temp_map = Q2BSP(path)
+    texture_list, average_colors = get_texture_colors(temp_map, pball_path)
+    texture_colors = {texture: (*color, 255)[:4] for texture, color in zip(texture_list, average_colors)}
+    tex_info_colors = np.array([texture_colors[x.get_texture_name()] for x in temp_map.tex_infos],
+                               dtype=np.uint8).reshape(-1, 4)
+
+    face_arrays = get_face_arrays(temp_map)
+    skip_flags = SURF_HINT | SURF_NODRAW | SURF_SKY | SURF_SKIP
+    faces = np.nonzero((get_texture_flags(temp_map)[face_arrays.texture_info] & skip_flags) == 0)[0]
+
+    loop_total = face_arrays.loop_total[faces]
+    loop_start = np.cumsum(loop_total) - loop_total
+    loops = np.repeat(face_arrays.loop_start[faces], loop_total) + np.arange(loop_total.sum()) - \
+        np.repeat(loop_start, loop_total)
+    vertices = get_vertex_array(temp_map).astype(np.float64)[face_arrays.loop_vertices[loops]]
+    colors = tex_info_colors[face_arrays.texture_info[faces]]
+    if lightmap_shading:
+        colors[:, :3] = colors[:, :3] * get_lightmap_shading(path, temp_map)[faces, None]
+    return PackedPolygons(vertices, loop_start, loop_total, face_arrays.normals[faces], colors)
+
+
+def get_rotation_matrix(x_angle: float, y_angle: float, z_angle: float) -> np.ndarray:
+    """
+    Rotation by z, y, x axis in this order, like get_rot_polys
+    :param x_angle: rotation angle in degrees
+    :param y_angle: rotation angle in degrees
+    :param z_angle: rotation angle in degrees
+    :return: 3×3 matrix that is multiplied with column vectors
+    """
+    x, y, z = [math.radians(a) for a in (x_angle, y_angle, z_angle)]
+    rot_x = np.array([[1, 0, 0], [0, math.cos(x), -math.sin(x)], [0, math.sin(x), math.cos(x)]])
+    rot_y = np.array([[math.cos(y), 0, math.sin(y)], [0, 1, 0], [-math.sin(y), 0, math.cos(y)]])
+    rot_z = np.array([[math.cos(z), -math.sin(z), 0], [math.sin(z), math.cos(z), 0], [0, 0, 1]])
+    return rot_x @ rot_y @ rot_z
+
+
+def project_packed_polygons(packed: PackedPolygons, x_angle: float, y_angle: float, z_angle: float,
+                            perspective: bool, fov: int = 50) -> ProjectedPolygons:
+    """
+    Vectorized equivalent of get_rot_polys followed by the sorting, projection and culling of create_poly_image
+    :param packed: PackedPolygons object
+    :param x_angle: rotation angle in degrees
+    :param y_angle: rotation angle in degrees
+    :param z_angle: rotation angle in degrees
+    :param perspective: perspective projection if True, orthographic otherwise
+    :param fov: field of view for perspective projection
+    :return: ProjectedPolygons object
+    """
+    rotation = get_rotation_matrix(x_angle, y_angle, z_angle)
+    verts = packed.vertices @ rotation.T
+    verts -= verts.min(axis=0)
+    normals = packed.normals @ rotation.T
+    # depth is the 0th coordinate, image x and y are the 1st and 2nd one
+    depth, x, y = verts[:, 0].copy(), verts[:, 1].copy(), verts[:, 2].copy()
+
+    # sorted descending because the bigger the depth value the further away the polygon is from camera
+    order = np.argsort(-(np.add.reduceat(depth, packed.loop_start) / packed.loop_total), kind="stable")
+
+    max_x = round(x.max())
+    max_y = round(y.max())
+    if perspective:
+        # shifts all vertices on depth axis to render all with set fov
+        shift = max(max(x / np.tan(math.radians(fov)) - depth), max(y / np.tan(math.radians(fov)) - depth))
+        depth += shift if shift > 0 else 0
+        # for not rendering anything in front of the near clipping plane
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = np.where(depth >= 1, (x - max_x / 2) / depth * max(max_x, max_y) + max_x / 2, np.nan)
+            y = np.where(depth >= 1, (y - max_y / 2) / depth * max(max_x, max_y) + max_y / 2, np.nan)
+
+    # faces showing away from the camera (center of mass to camera vs normal) and invisible faces aren't drawn
+    mean_vertex = np.stack((depth, x - max_x / 2, y - max_y / 2), axis=1)
+    mean_vertex = np.add.reduceat(mean_vertex, packed.loop_start) / packed.loop_total[:, None]
+    facing = np.einsum("ij,ij->i", mean_vertex, normals) <= 0
+    visible = facing & (packed.colors[:, 3] > 0) & ~np.isnan(np.add.reduceat(x + y, packed.loop_start))
+
+    return ProjectedPolygons(np.stack((x, y), axis=1), packed.loop_start, packed.loop_total,
+                             order[visible[order]], packed.colors, round(np.nanmin(x)), round(np.nanmin(y)),
+                             round(np.nanmax(x)), round(np.nanmax(y)))
+
+
+def get_pixel_coordinates(projected: ProjectedPolygons, max_resolution: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Scales projected coordinates to pixels the way create_poly_image does, polygons end up upside down
+    :param projected: ProjectedPolygons object
+    :param max_resolution: size of the longer image side in pixels
+    :return: (n_corners, 2) pixel positions of all corners, image width and height
+    """
+    scale = max(projected.pmax_x - projected.pmin_x, projected.pmax_y - projected.pmin_y)
+    size = (int((projected.pmax_x - projected.pmin_x) / scale * max_resolution),
+            int((projected.pmax_y - projected.pmin_y) / scale * max_resolution))
+    pixels = (np.array([projected.pmax_x, projected.pmax_y]) - projected.points) / scale * max_resolution
+    return pixels, size
+
+
+def draw_projected_polygons(projected: ProjectedPolygons, max_resolution: int = 2048) -> Image.Image:
+    """
+    Draws projected polygons the way create_poly_image does
+    :param projected: ProjectedPolygons object
+    :param max_resolution: size of the longer image side in pixels
+    :return: RGBA Image object
+    """
+    pixels, size = get_pixel_coordinates(projected, max_resolution)
+    img = Image.new("RGBA", size, (255, 255, 255, 100))
+    draw = ImageDraw.Draw(img, "RGBA")
+    for idx in projected.order:
+        start = projected.loop_start[idx]
+        draw.polygon(list(map(tuple, pixels[start:start + projected.loop_total[idx]])),
+                     fill=tuple(int(x) for x in projected.colors[idx]), outline=(0, 0, 0))
+    return img
+
+
+def create_packed_image(packed: PackedPolygons, x_angle: float, y_angle: float, z_angle: float, perspective: bool,
+                        max_resolution: int = 2048, fov: int = 50) -> Image.Image:
+    """
+    Renders a rotated view from packed polygons, only transformation and rasterization happen per call
+    :param packed: PackedPolygons object
+    :param x_angle: rotation angle in degrees
+    :param y_angle: rotation angle in degrees
+    :param z_angle: rotation angle in degrees
+    :param perspective: perspective projection if True, orthographic otherwise
+    :param max_resolution: size of the longer image side in pixels
+    :param fov: field of view for perspective projection
+    :return: RGBA Image object
+    """
+    projected = project_packed_polygons(packed, x_angle, y_angle, z_angle, perspective, fov)
+    return draw_projected_polygons(projected, max_resolution)
+
+
+def create_svg_image(packed: PackedPolygons, x_angle: float, y_angle: float, z_angle: float, perspective: bool,
+                     image_path: str, max_resolution: int = 2048, fov: int = 50) -> Tuple[int, int]:
+    """
+    Writes a rotated view as svg file, polygons are streamed to the file in drawing order without rasterizing them
+    :param packed: PackedPolygons object
+    :param x_angle: rotation angle in degrees
+    :param y_angle: rotation angle in degrees
+    :param z_angle: rotation angle in degrees
+    :param perspective: perspective projection if True, orthographic otherwise
+    :param image_path: path of .svg file
+    :param max_resolution: size of the longer image side in pixels, coordinates are written with one decimal place
+    :param fov: field of view for perspective projection
+    :return: width and height of the image
+    """
+    projected = project_packed_polygons(packed, x_angle, y_angle, z_angle, perspective, fov)
+    pixels, size = get_pixel_coordinates(projected, max_resolution)
+    polygons = ((pixels[projected.loop_start[idx]:projected.loop_start[idx] + projected.loop_total[idx]],
+                 projected.colors[idx]) for idx in projected.order)
+    write_svg(image_path, size, polygons)
+    return size
@@ -1,134 +1,51 @@
-import struct
-import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
 import math
 from statistics import mean
 import copy
-import os
-from PIL import Image
-from PIL import WalImageFile
+import numpy as np
+from Q2BSP import Q2BSP
+from bsp_arrays import TEX_INFO_DTYPE, get_face_arrays, get_lump_array, get_texture_flags, get_vertex_array, \
+    SURF_HINT, SURF_NODRAW, SURF_SKY, SURF_SKIP
+from rasterization import accumulate_polygons
+from svg_output import write_svg
+from texture_colors import get_mean_color, save_color_cache
+from texture_index import get_texture_index
 
 
 def get_polys(path, pball_path):
-    with open(path, "rb") as f:  # bsps are binary files
-        bytes1 = f.read()  # stores all bytes in bytes1 variable (named like that to not interfere with builtin names
-        # get offset (position of entity block begin) and length of entity block -> see bsp quake 2 format documentation
-        offset_faces = int.from_bytes(bytes1[56:60], byteorder='little', signed=False)
-        length_faces = int.from_bytes(bytes1[60:64], byteorder='little', signed=False)
-
-        offset_verts = int.from_bytes(bytes1[24:28], byteorder='little', signed=False)
-        length_verts = int.from_bytes(bytes1[28:32], byteorder='little', signed=False)
-        vertices = list()
-        for i in range(int(length_verts / 12)):
-            (vert_x,) = struct.unpack('<f', (bytes1[offset_verts + 12 * i + 0:offset_verts + 12 * i + 4]))
-            (vert_y,) = struct.unpack('<f', (bytes1[offset_verts + 12 * i + 4:offset_verts + 12 * i + 8]))
-            (vert_z,) = struct.unpack('<f', (bytes1[offset_verts + 12 * i + 8:offset_verts + 12 * i + 12]))
-            vertices.append([vert_x, vert_y, vert_z])
-            # print(f"{vert_x} - {vert_y} - {vert_z}")
-
-        offset_edges = int.from_bytes(bytes1[96:100], byteorder='little', signed=False)
-        length_edges = int.from_bytes(bytes1[100:104], byteorder='little', signed=False)
-        edges = list()
-        for i in range(int(length_edges / 4)):  # texture information lump is 76 bytes large
-            vert_1 = int.from_bytes(bytes1[offset_edges + 4 * i + 0:offset_edges + 4 * i + 2], byteorder='little', signed=False)
-            vert_2 = int.from_bytes(bytes1[offset_edges + 4 * i + 2:offset_edges + 4 * i + 4], byteorder='little', signed=False)
-            edges.append([vertices[vert_1], vertices[vert_2]])
-
-        offset_face_edges = int.from_bytes(bytes1[104:108], byteorder='little', signed=False)
-        length_face_edges = int.from_bytes(bytes1[108:112], byteorder='little', signed=False)
-        face_edges = list()
-        for i in range(int(length_face_edges / 4)):  # texture information lump is 76 bytes large
-            edge_index = int.from_bytes(bytes1[offset_face_edges + 4 * i + 0:offset_face_edges + 4 * i + 4], byteorder='little', signed=True)
-            if edge_index > 0:
-                face_edges.append([edges[abs(edge_index)][0], edges[abs(edge_index)][1]])
-            elif edge_index < 0:
-                face_edges.append([edges[abs(edge_index)][1], edges[abs(edge_index)][0]])
-
-        offset_textures = int.from_bytes(bytes1[48:52], byteorder='little', signed=False)
-        length_textures = int.from_bytes(bytes1[52:56], byteorder='little', signed=False)
-        texture_list = list()
-        for i in range(int(length_textures/76)):
-            tex = (bytes1[offset_textures+76*i+40:offset_textures+76*i+72])
-            tex = [x for x in tex if x]
-            tex_name = struct.pack("b" * len(tex), *tex).decode('ascii', "ignore")
-            print(tex_name)
-            texture_list.append(tex_name)
-
-        faces = list()
-        tex_ids = list()
-        texture_list_cleaned=list(dict.fromkeys(texture_list))
-
-        average_colors=list()
-        for texture in texture_list_cleaned:
-            color = (0, 0, 0)
-            if os.path.isfile(pball_path+"/textures/"+texture+".png"):
-                img = Image.open((pball_path+"/textures/"+texture+".png"))
-                img2 = img.resize((1, 1))
-
-                color = img2.getpixel((0, 0))
-
-            elif os.path.isfile(pball_path+"/textures/"+texture+".jpg"):
-                img = Image.open((pball_path+"/textures/"+texture+".jpg"))
-                img.save("1.png")
-                img2 = img.resize((1, 1))
-                # break
-
-                color = img2.getpixel((0, 0))
-                # print(f"texture: {texture} - color: {color}")
-
-            elif os.path.isfile(pball_path + "/textures/" + texture + ".tga"):
-                img = Image.open((pball_path + "/textures/" + texture + ".tga"))
-                img2 = img.resize((1, 1))
-
-                color = img2.getpixel((0, 0))
-                # print(f"texture: {texture} - color: {color}")
-
-            elif os.path.isfile(pball_path+"/textures/"+texture+".wal"):
-                with open("pb2e.pal", "r") as pal:
-                    conts = (pal.read().split("\n")[3:])
-                    conts = [b.split(" ") for b in conts]
-                    conts = [c for b in conts for c in b]
-                    conts.pop(len(conts)-1)
-                    conts=list(map(int, conts))
-                    img3 = WalImageFile.open((pball_path+"/textures/"+texture+".wal"))
-                    img3.putpalette(conts)
-                    img3=img3.convert("RGBA")
-                    print(img3.mode)
-
-                    img2 = img3.resize((1, 1))
-
-                    color = img2.getpixel((0, 0))
-            print(f"texture: {texture} - color: {color}")
-            color_rgb = color[:3]
-            average_colors.append(color_rgb)
-
-        for i in range(int(length_faces / 20)):  # texture information lump is 76 bytes large
-            # get sum of flags / transform flag bit field to uint32
-            first_edge = (bytes1[offset_faces + 20 * i + 4:offset_faces + 20 * i + 8])
-            (num_edges,) = struct.unpack('<H', (bytes1[offset_faces + 20 * i + 8:offset_faces + 20 * i + 10]))
-            (tex_index,) = struct.unpack('<H', (bytes1[offset_faces + 20 * i + 10:offset_faces + 20 * i + 12]))
-            print(tex_index)
-            tex_ids.append(texture_list_cleaned.index(texture_list[tex_index]))
-            print(tex_ids[len(tex_ids)-1])
-            first_edge = int.from_bytes(first_edge, byteorder='little', signed=True)
-            next_edges = list()
-            for j in range(num_edges):
-                if face_edges[first_edge+j][0] not in next_edges:
-                    next_edges.append(face_edges[first_edge+j][0])
-
-                if face_edges[first_edge + j][1] not in next_edges:
-                    next_edges.append(face_edges[first_edge + j][1])
-            faces.append(next_edges)
-
-        print(texture_list_cleaned)
-        print(tex_ids)
-        print(average_colors)
-
-        min_x = min([p for i in [[vertex[0] for vertex in edge] for edge in faces] for p in i])
-        min_y = min([p for i in [[vertex[1] for vertex in edge] for edge in faces] for p in i])
-        min_z = min([p for i in [[vertex[2] for vertex in edge] for edge in faces] for p in i])
-
-        return [[[round(vertex[0]-min_x), round(vertex[1]-min_y), round(vertex[2]-min_z)] for vertex in edge] for edge in faces], tex_ids, average_colors
+    """
+    Loads faces with vertex positions moved to >= 0 and rounded, and the mean color of each texture
+    :param path: full path to map
+    :param pball_path: path to pball / game media directory, needed to get full texture path
+    :return: list of faces (lists of [x, y, z] vertices), index into average_colors per face, list of RGB colors
+    """
+    temp_map = Q2BSP(path)
+    face_arrays = get_face_arrays(temp_map)
+    corners = get_vertex_array(temp_map)[face_arrays.loop_vertices].astype(np.float64)
+    corners = np.round(corners - corners.min(axis=0)).astype(np.int64)
+
+    # unique texture names in order of first use, each texture information entry is mapped to its unique texture
+    texture_names = np.char.decode(get_lump_array(temp_map, 5, TEX_INFO_DTYPE)["texture_name"], "ascii", "ignore")
+    _, first_use, tex_info_ids = np.unique(texture_names, return_index=True, return_inverse=True)
+    order = np.argsort(first_use)
+    unique_ids = np.empty(len(order), dtype=np.int64)
+    unique_ids[order] = np.arange(len(order))
+    tex_ids = unique_ids[tex_info_ids.reshape(-1)][face_arrays.texture_info]
+    texture_list_cleaned = texture_names[first_use[order]]
+
+    average_colors = list()
+    texture_index = get_texture_index(pball_path)
+    for texture in texture_list_cleaned:
+        color = (0, 0, 0)
+        # mean color is read from the shared texture color cache
+        texture_file = texture_index.find(str(texture))
+        if texture_file:
+            color = get_mean_color(texture_file.path) or color
+        average_colors.append(tuple(color[:3]))
+    save_color_cache()
+
+    faces = np.split(corners, face_arrays.loop_start[1:]) if len(corners) else []
+    return [face.tolist() for face in faces], tex_ids.tolist(), average_colors
 
 
 def sort_by_z(faces):
@@ -198,7 +115,6 @@ def create_poly_image(polys, ax, opacity=-1, x=0, y=1, title="", ids=None, avera
         colors = (max(0, col-255), 0, max(0, 255-col), opacity)
         if ids and average_colors:
             col_a, col_b, col_c = average_colors[ids[idx]]
-            print(average_colors[ids[idx]])
             colors = (col_a, col_b, col_c,opacity)
         draw.polygon([(vert[x], max_y-vert[y]) for vert in edge], fill=colors, outline=(255,255,255,10))
     if not ax:
@@ -207,3 +123,114 @@ def create_poly_image(polys, ax, opacity=-1, x=0, y=1, title="", ids=None, avera
         ax.axis("off")
         ax.imshow(img)
         ax.set_title(title)
+
+
+def create_svg_image(polys, image_path, opacity=-1, x=0, y=1, ids=None, average_colors=None):
+    """
+    Writes the image create_poly_image draws as svg file, polygons are streamed to the file without rasterizing them
+    :param polys: faces of the bsp
+    :param image_path: path of .svg file
+    :param opacity: opacity of individual faces
+    :param x: coordinate that will be drawn as x value
+    :param y: coordinate that will be drawn as y value
+    :param ids: index into average_colors per face
+    :param average_colors: RGB color per texture, faces are colored by height if missing
+    :return: width and height of the image
+    """
+    z = 3-(x+y)
+    max_x = max(vertex[x] for edge in polys for vertex in edge)
+    max_y = max(vertex[y] for edge in polys for vertex in edge)
+    max_z = max(max(vertex[z] for edge in polys for vertex in edge), 1)
+    size = (round(max_x), round(max_y))
+
+    def get_polygons():
+        face_opacity = opacity
+        for idx, edge in enumerate(polys):
+            mean_z = sum([vert[z] for vert in edge])/len(edge)
+            # like in create_poly_image, the first face decides the opacity of all faces
+            if face_opacity == -1:
+                face_opacity = min(255, int(180*(1-mean_z/max_z)))
+            col = int(510 * mean_z / max_z)
+            colors = (max(0, col-255), 0, max(0, 255-col), face_opacity)
+            if ids and average_colors:
+                colors = (*average_colors[ids[idx]], face_opacity)
+            yield [(vert[x], max_y-vert[y]) for vert in edge], colors
+
+    write_svg(image_path, size, get_polygons(), background=(255, 255, 255, 255), outline=(255, 255, 255, 10))
+    return size
+
+
+# faces whose normal has at least this z component can be walked on (same threshold as the game's movement code)
+WALKABLE_NORMAL_Z = 0.7
+
+
+def get_face_points(path):
+    """
+    Loads all drawn faces as packed arrays for the density heatmap
+    :param path: full path to map
+    :return: (n_corners, 3) corner positions moved to >= 0, index of first corner and number of corners per face,
+    (n_faces, 3) unit normals
+    """
+    temp_map = Q2BSP(path)
+    face_arrays = get_face_arrays(temp_map)
+    skip_flags = SURF_HINT | SURF_NODRAW | SURF_SKY | SURF_SKIP
+    faces = np.nonzero((get_texture_flags(temp_map)[face_arrays.texture_info] & skip_flags) == 0)[0]
+    loop_total = face_arrays.loop_total[faces]
+    loop_start = np.cumsum(loop_total) - loop_total
+    loops = np.repeat(face_arrays.loop_start[faces], loop_total) + np.arange(loop_total.sum()) - \
+        np.repeat(loop_start, loop_total)
+    corners = get_vertex_array(temp_map)[face_arrays.loop_vertices[loops]].astype(np.float64)
+    return corners - corners.min(axis=0), loop_start, loop_total, face_arrays.normals[faces]
+
+
+def create_density_image(path, weighting="height", x=0, y=1, max_resolution=2048, colormap="inferno"):
+    """
+    Renders a heatmap by accumulating all faces in a buffer instead of drawing semi-transparent polygons
+    :param path: full path to map
+    :param weighting: "height": mean height of all faces covering a pixel,
+    "count": number of faces covering a pixel,
+    "area": surface area per pixel (steep faces count more than flat ones),
+    "walkable": number of walkable floors (faces with normal z >= WALKABLE_NORMAL_Z) covering a pixel
+    :param x: coordinate that will be drawn as x value
+    :param y: coordinate that will be drawn as y value, the remaining coordinate is the height
+    :param max_resolution: size of the longer image side in pixels
+    :param colormap: name of a matplotlib colormap
+    :return: RGB Image object, pixels without faces are white
+    """
+    corners, loop_start, loop_total, normals = get_face_points(path)
+    z = 3 - (x + y)
+    scale = max_resolution / max(corners[:, x].max(), corners[:, y].max(), 1)
+    size = (max(1, int(corners[:, x].max() * scale)), max(1, int(corners[:, y].max() * scale)))
+    # upside down like create_poly_image
+    points = np.stack((corners[:, x] * scale, (corners[:, y].max() - corners[:, y]) * scale), axis=1)
+
+    coverage = accumulate_polygons(points, loop_start, loop_total, np.ones(len(loop_total)), size)
+    if weighting == "height":
+        heights = np.add.reduceat(corners[:, z], loop_start) / loop_total
+        values = accumulate_polygons(points, loop_start, loop_total, heights / max(heights.max(), 1), size)
+        values = np.divide(values, coverage, out=np.zeros_like(values), where=coverage > 0)
+    elif weighting == "count":
+        values = coverage
+    elif weighting == "area":
+        # surface area divided by projected area spreads each face's area over the pixels it covers
+        normal_z = np.abs(normals[:, z])
+        values = accumulate_polygons(points, loop_start, loop_total, 1 / np.maximum(normal_z, 0.05), size)
+    elif weighting == "walkable":
+        walkable = normals[:, 2] >= WALKABLE_NORMAL_Z
+        values = accumulate_polygons(points, loop_start, loop_total, walkable.astype(np.float64), size)
+        coverage = values
+    else:
+        print("Error: No such weighting", weighting, "\n pick one of height, count, area, walkable")
+        return None
+
+    # tone mapping: normalize (ignoring the hottest pixels), then look up colors for all pixels at once
+    covered = coverage > 0
+    if weighting == "height":
+        normalized = values
+    else:
+        normalized = values / max(np.percentile(values[covered], 99.5) if covered.any() else 1, 1e-6)
+    from matplotlib import colormaps
+    lookup = (colormaps[colormap](np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+    pixels = lookup[np.clip(normalized * 255, 0, 255).astype(np.uint8)]
+    pixels[~covered] = 255
+    return Image.fromarray(pixels, "RGB")
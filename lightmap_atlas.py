@@ -0,0 +1,69 @@
+# Packs the lightmaps of all faces into one image, e.g. for previews or as texture for imported meshes
+from dataclasses import dataclass
+import numpy as np
+from PIL import Image
+from bsp_arrays import LightmapExtents, get_lightmap_array, get_lightmap_extents
+
+
+@dataclass
+class LightmapAtlas:
+    image: Image.Image
+    # (n_faces, 4) x, y, width, height of each face's lightmap in the atlas in pixels, -1 for faces without lightmap
+    rects: np.ndarray
+    # (n_faces, 4) u_min, v_min, u_max, v_max of each face's lightmap in 0..1 texture coordinates, v points down
+    uv_rects: np.ndarray
+
+
+def pack_rects(sizes: np.ndarray, width: int, padding: int = 1) -> np.ndarray:
+    """
+    Shelf packing: rects are placed in rows from left to right, highest first
+    :param sizes: (n, 2) width and height of each rect
+    :param width: width of the area rects are placed in, has to be at least the widest rect plus padding
+    :param padding: space between rects
+    :return: (n, 2) x, y position of each rect
+    """
+    positions = np.zeros((len(sizes), 2), dtype=np.int64)
+    x, y, row_height = 0, 0, 0
+    for idx in np.argsort(-sizes[:, 1], kind="stable"):
+        rect_width, rect_height = sizes[idx]
+        if x + rect_width + padding > width:
+            x, y, row_height = 0, y + row_height, 0
+        positions[idx] = x, y
+        x += rect_width + padding
+        row_height = max(row_height, rect_height + padding)
+    return positions
+
+
+def create_lightmap_atlas(bsp, style: int = 0, padding: int = 1, extents: LightmapExtents = None) -> LightmapAtlas:
+    """
+    Copies the lightmaps of all faces into one RGB image at once
+    :param bsp: Q2BSP object
+    :param style: index of the light style per face (not the light style number), faces with less styles are left out
+    :param padding: black pixels between face lightmaps
+    :param extents: LightmapExtents object, calculated if missing
+    :return: LightmapAtlas object
+    """
+    if extents is None:
+        extents = get_lightmap_extents(bsp)
+    faces = np.nonzero(extents.n_styles > style)[0]
+    sizes = extents.sizes[faces]
+    # square atlas with some space left for the rows that aren't filled completely
+    width = int(max(np.sqrt((np.prod(sizes + padding, axis=1)).sum() * 1.1), sizes[:, 0].max(initial=0) + padding, 1))
+    positions = pack_rects(sizes, width, padding)
+    height = int(max((positions[:, 1] + sizes[:, 1]).max(initial=0), 1))
+
+    # destination and source index of every texel of every face
+    texels = np.prod(sizes, axis=1)
+    texel = np.arange(texels.sum()) - np.repeat(np.cumsum(texels) - texels, texels)
+    face_widths = np.repeat(sizes[:, 0], texels)
+    pixel_x = np.repeat(positions[:, 0], texels) + texel % face_widths
+    pixel_y = np.repeat(positions[:, 1], texels) + texel // face_widths
+    source = np.repeat(extents.first_texel[faces] + style * texels, texels) + texel
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    pixels[pixel_y, pixel_x] = get_lightmap_array(bsp)[source]
+
+    rects = np.full((len(extents.sizes), 4), -1, dtype=np.int64)
+    rects[faces] = np.concatenate((positions, sizes), axis=1)
+    uv_rects = np.full((len(extents.sizes), 4), -1.0)
+    uv_rects[faces] = np.concatenate((positions, positions + sizes), axis=1) / np.array([width, height] * 2)
+    return LightmapAtlas(Image.fromarray(pixels, "RGB"), rects, uv_rects)
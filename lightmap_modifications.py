@@ -1,17 +1,123 @@
+from typing import Iterable, Optional, Tuple
+import numpy as np
 from Q2BSP import *
+from bsp_arrays import LightmapExtents, get_face_lightmap, get_lightmap_array, get_lightmap_extents
 import os
 
+# intensity = 0.2989*r + 0.5870*g + 0.1140*b for each channel
+GRAYSCALE_MATRIX = np.array([[0.2989, 0.5870, 0.1140]] * 3)
 
-def make_lightmap_grayscale(map_path: str, affix: str) -> None:
+
+def transform_lightmap(lightmap: np.ndarray, matrix: Optional[np.ndarray] = None, brightness: float = 0.0,
+                       contrast: float = 1.0, gamma: float = 1.0, clamp: Tuple[int, int] = (0, 255),
+                       lut: Optional[np.ndarray] = None) -> np.ndarray:
     """
-    Turns each lightmap texel into grayscale
+    Changes all lightmap texels in one vectorized pass, in this order:
+    color matrix, contrast around 128 and brightness, gamma, clamping, lookup table
+    Results are truncated to integers like int() does
+    :param lightmap: (n_texels, 3) uint8 array as returned by get_lightmap_array, changed in place
+    :param matrix: 3×3 matrix that is multiplied with each RGB texel as column vector
+    :param brightness: added to all channels
+    :param contrast: factor for the distance of all channels from 128
+    :param gamma: channels are mapped to 255 * (value / 255) ** (1 / gamma), values > 1 brighten dark texels
+    :param clamp: lowest and highest value of all channels
+    :param lut: (256,) or (3, 256) uint8 array mapping old to new values for all channels or per channel
+    :return: the changed lightmap array
+    """
+    if matrix is not None or not brightness == 0 or not contrast == 1 or not gamma == 1 or not tuple(clamp) == (0, 255):
+        values = lightmap.astype(np.float64)
+        if matrix is not None:
+            values = values @ np.asarray(matrix, dtype=np.float64).T
+        if not contrast == 1 or not brightness == 0:
+            values = (values - 128) * contrast + 128 + brightness
+        if not gamma == 1:
+            values = 255 * (np.clip(values, 0, 255) / 255) ** (1 / gamma)
+        lightmap[:] = np.clip(values, max(clamp[0], 0), min(clamp[1], 255)).astype(np.uint8)
+    if lut is not None:
+        lut = np.asarray(lut, dtype=np.uint8)
+        if lut.ndim == 1:
+            lightmap[:] = lut[lightmap]
+        else:
+            lightmap[:] = lut[np.arange(3), lightmap]
+    return lightmap
+
+
+def get_face_texels(extents: LightmapExtents, faces: Iterable[int]) -> np.ndarray:
+    """
+    :param extents: LightmapExtents object
+    :param faces: face indices, faces without lightmap are left out
+    :return: indices into get_lightmap_array of all texels of all light styles of the faces
+    """
+    faces = np.asarray(list(faces), dtype=np.int64)
+    faces = faces[extents.n_styles[faces] > 0]
+    counts = np.prod(extents.sizes[faces], axis=1) * extents.n_styles[faces]
+    return np.repeat(extents.first_texel[faces], counts) + np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def transform_face_lightmaps(bsp, faces: Iterable[int], extents: Optional[LightmapExtents] = None,
+                             **transform) -> None:
+    """
+    Changes only the lightmaps of some faces, e.g. transform_face_lightmaps(temp_map, [1, 2], brightness=30)
+    :param bsp: Q2BSP object, the lightmap lump is changed in place
+    :param faces: face indices
+    :param extents: LightmapExtents object, calculated if missing
+    :param transform: keyword arguments of transform_lightmap
+    :return: None
+    """
+    if extents is None:
+        extents = get_lightmap_extents(bsp)
+    lightmap = get_lightmap_array(bsp)
+    texels = get_face_texels(extents, faces)
+    lightmap[texels] = transform_lightmap(lightmap[texels], **transform)
+
+
+def blur_face_lightmaps(bsp, faces: Iterable[int], radius: int = 1, extents: Optional[LightmapExtents] = None) -> None:
+    """
+    Box blur within the lightmap of each face, light doesn't bleed into other faces
+    :param bsp: Q2BSP object, the lightmap lump is changed in place
+    :param faces: face indices
+    :param radius: texels in each direction that are averaged
+    :param extents: LightmapExtents object, calculated if missing
+    :return: None
+    """
+    if extents is None:
+        extents = get_lightmap_extents(bsp)
+    lightmap = get_lightmap_array(bsp)
+    size = 2 * radius + 1
+    for face in faces:
+        for style in range(extents.n_styles[face]):
+            texels = get_face_lightmap(lightmap, extents, face, style)
+            # border texels are repeated, sums of all windows from cumulative sums along both axes
+            padded = np.pad(texels.astype(np.int64), ((radius + 1, radius), (radius + 1, radius), (0, 0)), "edge")
+            padded[0], padded[:, 0] = 0, 0
+            sums = padded.cumsum(axis=0).cumsum(axis=1)
+            window = sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]
+            texels[:] = window // (size * size)
+
+
+def modify_lightmap(map_path: str, affix: str, message: str = "", **transform) -> None:
+    """
+    Stores a map copy with changed lightmap, see transform_lightmap for possible changes
+    e.g. modify_lightmap(map_path, "bright", brightness=40, gamma=1.5)
     :param map_path: absolute path to map
+    :param affix: suffix of map copy
+    :param message: added to the map name in the worldspawn message, no change if empty
+    :param transform: keyword arguments of transform_lightmap
     :return: None
     """
     temp_map = Q2BSP(map_path)
-    for idx, color in enumerate(temp_map.lightmaps):
-        temp_map.lightmaps[idx] = RGBColor(*[int(0.2989*color.r + 0.5870*color.g + 0.1140*color.b)]*3)
-    temp_map.worldspawn["message"] = map_path.split("/")[-1]+"\ngrayscale lightmap version"
-    temp_map.save_lightmaps(temp_map.lightmaps)
+    transform_lightmap(get_lightmap_array(temp_map), **transform)
+    if message:
+        temp_map.worldspawn["message"] = map_path.split("/")[-1]+"\n"+message
     temp_map.update_lump_sizes()
     temp_map.save_map(map_path, "_" + affix)
+
+
+def make_lightmap_grayscale(map_path: str, affix: str) -> None:
+    """
+    Turns each lightmap texel into grayscale
+    :param map_path: absolute path to map
+    :return: None
+    """
+    modify_lightmap(map_path, affix, "grayscale lightmap version", matrix=GRAYSCALE_MATRIX)
@@ -1,42 +1,127 @@
-import wireframe_radar_image as wf
-import heatmap_radar_image as hm
-import colored_radar_image as cl
-import matplotlib.pyplot as plt
+# mode modules are imported where they are needed, so that rendering one mode doesn't load the others
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 import math
+from typing import List, Tuple
 
 
-def get_optimal_angle(polys):
-    # get angles with maximum information aka faces are least stacked
-    # approach: for z rotation, get diagonal on xy plane and take its angle, for x rotation accordingly
-    # not working well yet, best for this would be a real 3d angle
-    max_x = max([a for b in [x.vertices for x in polys] for a in b], key=lambda x: x[0])
-    max_y = max([a for b in [x.vertices for x in polys] for a in b], key=lambda x: x[1])
-    max_z = max([a for b in [x.vertices for x in polys] for a in b], key=lambda x: x[2])
-    maxs = [max_x[0], max_y[1], max_z[2]]
+def get_optimal_angle(vertices: np.ndarray, loop_start: np.ndarray = None, loop_total: np.ndarray = None,
+                      min_elevation: float = 30.0, max_elevation: float = 60.0) -> Tuple[float, float, float]:
+    """
+    Picks a rotated view from the principal axes of the map geometry, faces are least stacked when looking along the
+    axis of least extent, the axis of greatest extent then runs along the image
+    :param vertices: (n, 3) array of all corners, faces stored one after another
+    :param loop_start: index of first corner per face, if given with loop_total, corners are weighted by face area
+    instead of counting every corner equally (detailed geometry then doesn't dominate the view)
+    :param loop_total: number of corners per face
+    :param min_elevation: lower limit in degrees for how steep the camera looks down, keeps the view from being flat
+    :param max_elevation: upper limit in degrees, keeps walls visible instead of rendering a top view
+    :return: x, y, z rotation angles in degrees as used by create_image
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if loop_start is not None and loop_total is not None:
+        # vector area of each (planar) polygon is half the sum of cross products of consecutive corners
+        face_ids = np.repeat(np.arange(len(loop_total)), loop_total)
+        following = np.arange(len(vertices)) + 1
+        following[loop_start + loop_total - 1] = loop_start
+        cross = np.cross(vertices, vertices[following])
+        areas = np.linalg.norm(np.stack([np.bincount(face_ids, cross[:, i], len(loop_total)) for i in range(3)],
+                                        axis=1), axis=1) / 2
+        weights = (areas / np.maximum(loop_total, 1))[face_ids]
+    else:
+        weights = np.ones(len(vertices))
+    if not weights.sum() > 0:
+        weights = np.ones(len(vertices))
+    covariance = np.cov(vertices.T, aweights=weights)
+
+    # camera looks along the horizontal axis of least extent, so the longest horizontal axis spans the image width
+    _, horizontal_axes = np.linalg.eigh(covariance[:2, :2])
+    horizontal = horizontal_axes[:, 0]
+    # the steeper the axis of least extent in 3d, the flatter the map and the more the camera looks down
+    _, axes = np.linalg.eigh(covariance)
+    elevation = np.clip(np.degrees(np.arcsin(min(1.0, abs(axes[2, 0])))), min_elevation, max_elevation)
+
+    # with rotation z, then y, the viewing direction is (cos y cos z, -cos y sin z, sin y)
+    direction = np.append(horizontal * np.cos(np.radians(elevation)), -np.sin(np.radians(elevation)))
+    y_angle = math.degrees(math.asin(direction[2]))
+    z_angle = math.degrees(math.atan2(-direction[1], direction[0]))
+    return 0.0, y_angle, z_angle
+
+
+def get_polygon_arrays(polys) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param polys: list of Polygon objects
+    :return: (n, 3) array of all corners, index of first corner and number of corners per polygon
+    """
+    loop_total = np.array([len(x.vertices) for x in polys], dtype=np.int64)
+    vertices = np.array([vertex for poly in polys for vertex in poly.vertices], dtype=np.float64).reshape(-1, 3)
+    return vertices, np.cumsum(loop_total) - loop_total, loop_total
+
+
+def get_title_font(size: int) -> ImageFont.ImageFont:
+    """
+    :param size: font size in pixels
+    :return: PIL's default font at the given size, the fixed size bitmap font if scalable fonts aren't available
+    """
+    try:
+        return ImageFont.load_default(size)
+    except (TypeError, ImportError, OSError):
+        # PIL before 10.1 or without FreeType
+        return ImageFont.load_default()
+
+
+def compose_grid(images: List[Image.Image], titles: List[str], title: str) -> Image.Image:
+    """
+    Places four views in a 2×2 grid with titles, images are pasted pixel for pixel at their rendered size
+    Columns are as wide as their widest view and rows as high as their highest view, so no space is wasted
+    :param images: front, top, side and rotated view
+    :param titles: one title per image
+    :param title: title of the whole image
+    :return: RGBA Image object
+    """
+    widths = [max(images[column].width, images[column + 2].width) for column in range(2)]
+    heights = [max(images[2 * row].height, images[2 * row + 1].height) for row in range(2)]
+    # titles scale with the rendered views
+    font = get_title_font(max(12, max(widths + heights) // 40))
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    spacing = max(4, font.size // 3) if hasattr(font, "size") else 4
 
-    z_angle = -math.degrees(np.arctan(maxs[0] / maxs[1]))
-    y_angle = -math.degrees(np.arctan(maxs[0] / maxs[2]))
-    x_angle = 0.0
+    def text_height(text: str) -> int:
+        left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font=font, spacing=spacing)
+        return bottom + spacing
 
-    return x_angle, y_angle, z_angle
+    header = text_height(title) + spacing
+    title_heights = [max(text_height(titles[2 * row]), text_height(titles[2 * row + 1])) for row in range(2)]
+    grid = Image.new("RGBA", (sum(widths), header + sum(title_heights) + sum(heights)), (255, 255, 255, 255))
+    draw = ImageDraw.Draw(grid)
+    draw.multiline_text((grid.width // 2, spacing), title, fill=(0, 0, 0), font=font, anchor="ma", align="center",
+                        spacing=spacing)
+    for idx, (img, img_title) in enumerate(zip(images, titles)):
+        column, row = idx % 2, idx // 2
+        left = sum(widths[:column])
+        top = header + sum(title_heights[:row]) + sum(heights[:row])
+        draw.multiline_text((left + widths[column] // 2, top), img_title, fill=(0, 0, 0), font=font, anchor="ma",
+                            align="center", spacing=spacing)
+        grid.alpha_composite(img.convert("RGBA"), (left + (widths[column] - img.width) // 2, top + title_heights[row]))
+    return grid
 
 
 def create_image(path_to_pball: str, map_path: str, image_type: str, mode: int, image_path: str, dpi: int = 1700,
                  x_an: float = None, y_an: float = None, z_an: float = None, max_resolution: int = 2048,
-                 fov: int = 50) -> None:
+                 fov: int = 50, lightmap_shading: bool = False) -> None:
     """
     root function for creating radar images
     :param mode: 0: colored solid, 1: heatmap solid, 2: heatmap wireframe
     :param path_to_pball: path to pball directory / root directory for game media
     :param map_path: local path to map file including .bsp extension
     :param image_type: says if front side top or rotated view is to be rendered
-    :param image_path: path to store image to
-    :param dpi: image resolution, only relevant for image_type "all"
-    :param x_an: rotation angle in degrees
+    :param image_path: path to store image to, paths ending with .svg store single views of modes 0 to 2 as vector
+    image
+    :param dpi: no longer used, image_type "all" places the views at their rendered size
+    :param x_an: rotation angle in degrees, if any angle is None, get_optimal_angle picks the rotated view
     :param y_an: rotation angle in degrees
     :param z_an: rotation angle in degrees
+    :param lightmap_shading: modes 0 and 1 darken face colors by their mean lightmap brightness
     :return: None, images created here are stored to drive
     """
     # values are x,y values defining which coordinates PIL uses for drawing and in which order
@@ -59,56 +144,65 @@ def create_image(path_to_pball: str, map_path: str, image_type: str, mode: int,
     if image_type not in image_types_axes.keys() and image_type not in view_rotations.keys():
         print("Error: No such image type", image_type, "\n pick one of ", *image_types_axes.keys())
         return
-    if mode == 0 or mode == 1:  # true color solid
-        # load geometry and color information from bsp file
-        polys, mean_colors = cl.get_polygons(path_to_pball + map_path, path_to_pball)
-        if (image_type == "rotated" or image_type == "all") and (x_an is None or y_an is None or z_an is None):
-            view_rotations["rotated"] = get_optimal_angle(polys)
+    map_name = map_path.replace(".bsp", "").split("/")[len(map_path.split("/")) - 1]
+    # .svg paths get vector output, polygons are written to the file instead of being rasterized
+    vector_output = image_path.lower().endswith(".svg")
+    if vector_output and (image_type == "all" or mode == 3):
+        print("Error: svg output is only available for single views of modes 0, 1 and 2")
+        return
+    if (mode == 0 or mode == 1) and vector_output:
+        import colored_radar_image as cl
+        packed = cl.load_packed_polygons(path_to_pball + map_path, path_to_pball, lightmap_shading)
+        if image_type == "rotated" and (x_an is None or y_an is None or z_an is None):
+            view_rotations["rotated"] = get_optimal_angle(packed.vertices, packed.loop_start, packed.loop_total)
+        cl.create_svg_image(packed, *view_rotations[image_type], mode == 0, image_path, max_resolution, fov)
+    elif mode == 0 or mode == 1:  # true color solid
+        import colored_radar_image as cl
+        angles_missing = x_an is None or y_an is None or z_an is None
         if image_type == "all":
-            # render images and assign to a matplotlib axes, then save whole plot
-            fig_solid, ((s_ax1, s_ax2), (s_ax3, s_ax4)) = plt.subplots(nrows=2, ncols=2)
-            fig_solid.suptitle(map_path.replace(".bsp", "").split("/")[len(map_path.split("/")) - 1] +
-                               f"\n({'orthographic' if mode==1 else 'perspective'} projection)")
-
-            poly_list = cl.get_rot_polys(polys, *view_rotations["front"])  # x rot, roll/y rot, z rot
-            cl.create_poly_image(poly_list, s_ax1, mean_colors, mode == 0, max_resolution, fov)
-            poly_list = cl.get_rot_polys(polys, *view_rotations["top"])  # x rot, roll/y rot, z rot
-            cl.create_poly_image(poly_list, s_ax2, mean_colors, mode == 0, max_resolution, fov)
-            poly_list = cl.get_rot_polys(polys, *view_rotations["right"])  # x rot, roll/y rot, z rot
-            cl.create_poly_image(poly_list, s_ax3, mean_colors, mode == 0, max_resolution, fov)
-            poly_list = cl.get_rot_polys(polys, *view_rotations["rotated"])  # x rot, roll/y rot, z rot
-            cl.create_poly_image(poly_list, s_ax4, mean_colors, mode == 0, max_resolution, fov)
-            s_ax1.set_title("front view")
-            s_ax2.set_title("top view")
-            s_ax3.set_title("side view")
-            s_ax4.set_title(f"rotated view")
-            fig_solid.show()
-            fig_solid.savefig(image_path, dpi=dpi)
+            # geometry is packed once, then each view only costs one rotation, projection and drawing
+            packed = cl.load_packed_polygons(path_to_pball + map_path, path_to_pball, lightmap_shading)
+            if angles_missing:
+                view_rotations["rotated"] = get_optimal_angle(packed.vertices, packed.loop_start, packed.loop_total)
+            images = [cl.create_packed_image(packed, *view_rotations[view], mode == 0, max_resolution, fov)
+                      for view in ["front", "top", "right", "rotated"]]
+            compose_grid(images, ["front view", "top view", "side view", "rotated view"],
+                         map_name + f"\n({'orthographic' if mode==1 else 'perspective'} projection)").save(image_path)
+        elif lightmap_shading:
+            # per-face shading is only available for packed polygons
+            packed = cl.load_packed_polygons(path_to_pball + map_path, path_to_pball, lightmap_shading)
+            if image_type == "rotated" and angles_missing:
+                view_rotations["rotated"] = get_optimal_angle(packed.vertices, packed.loop_start, packed.loop_total)
+            cl.create_packed_image(packed, *view_rotations[image_type], mode == 0, max_resolution, fov).save(image_path)
         else:
+            # load geometry and color information from bsp file
+            polys, mean_colors = cl.get_polygons(path_to_pball + map_path, path_to_pball)
+            if image_type == "rotated" and angles_missing:
+                view_rotations["rotated"] = get_optimal_angle(*get_polygon_arrays(polys))
             # rotate polys and draw
             poly_rot = cl.get_rot_polys(polys, *view_rotations[image_type])
 
             img = cl.create_poly_image(poly_rot, None, mean_colors, mode == 0, max_resolution, fov)
             img.save(image_path)
     elif mode == 2:  # heatmap solid
+        import heatmap_radar_image as hm
         polys, texture_ids, mean_colors = hm.get_polys(path_to_pball + map_path, path_to_pball)
         poly_rot = hm.get_rot_polys(polys, 45, 0, 0) # fixed value rotation
         polys = hm.sort_by_z(polys)
-        if image_type == "all":
-            fig_solid, ((s_ax1, s_ax2), (s_ax3, s_ax4)) = hm.plt.subplots(nrows=2, ncols=2)
-            fig_solid.suptitle(map_path.replace(".bsp", "").split("/")[len(map_path.split("/")) - 1] + " solid")
-
+        if vector_output and image_type == "rotated":
+            hm.create_svg_image(poly_rot, image_path, x=0, y=2, ids=texture_ids, average_colors=mean_colors)
+        elif vector_output:
+            hm.create_svg_image(polys, image_path, opacity=50, x=image_types_axes[image_type][0],
+                                y=image_types_axes[image_type][1])
+        elif image_type == "all":
             # predefined opacity to also display underground ways (plus no proper depth testing here)
-            hm.create_poly_image(polys, s_ax1, opacity=50, x=1, y=2, title="front view")
-            hm.create_poly_image(polys, s_ax2, opacity=50, title="top view")
-            hm.create_poly_image(polys, s_ax3, opacity=50, x=0, y=2, title="side view")
-
-            # opacity is calculated based on distance to 'camera'
-            hm.create_poly_image(poly_rot, s_ax4, x=0, y=2, title="rotated view \n (orthographic)", ids=texture_ids,
-                                 average_colors=mean_colors)
-
-            fig_solid.show()
-            fig_solid.savefig(image_path, dpi=dpi)
+            images = [hm.create_poly_image(polys, None, opacity=50, x=1, y=2),
+                      hm.create_poly_image(polys, None, opacity=50),
+                      hm.create_poly_image(polys, None, opacity=50, x=0, y=2),
+                      # opacity is calculated based on distance to 'camera'
+                      hm.create_poly_image(poly_rot, None, x=0, y=2, ids=texture_ids, average_colors=mean_colors)]
+            compose_grid(images, ["front view", "top view", "side view", "rotated view \n (orthographic)"],
+                         map_name + " solid").save(image_path)
         # only difference here is that rotated polys are used
         # while for the rest just the coordinate positions are swapped
         elif image_type == "rotated":
@@ -119,21 +213,158 @@ def create_image(path_to_pball: str, map_path: str, image_type: str, mode: int,
                                  y=image_types_axes[image_type][1]).save(image_path)
 
     elif mode == 3:  # heatmap wireframe
-        lines = wf.get_line_coords(path_to_pball + map_path)
-        lines_rot = wf.get_rot_polys(lines, 10, 0, 70)
+        import wireframe_radar_image as wf
+        # edges of drawn faces, each one once, rasterized with NumPy instead of one ImageDraw.line call per edge
+        lines = wf.get_edge_array(path_to_pball + map_path)
+        rotation = (10, 0, 70)
         if image_type == "all":
-            fig_wireframe, ((s_ax1, s_ax2), (s_ax3, s_ax4)) = wf.plt.subplots(nrows=2, ncols=2)
-            fig_wireframe.suptitle(map_path.replace(".bsp", "").split("/")[len(map_path.split("/")) - 1] + " wireframe")
-
-            wf.create_line_image(lines, s_ax1, x=1, y=2, title="front view")
-            wf.create_line_image(lines, s_ax2, title="top view")
-            wf.create_line_image(lines, s_ax3, x=0, y=2, title="side view")
-            wf.create_line_image(lines_rot, s_ax4, x=0, y=2, title="rotated view \n (orthographic)")
-
-            fig_wireframe.show()
-            fig_wireframe.savefig(image_path, dpi=dpi)
+            images = [wf.create_edge_image(lines, None, x=1, y=2, max_resolution=max_resolution),
+                      wf.create_edge_image(lines, None, max_resolution=max_resolution),
+                      wf.create_edge_image(lines, None, x=0, y=2, max_resolution=max_resolution),
+                      wf.create_edge_image(lines, None, x=0, y=2, max_resolution=max_resolution, angles=rotation)]
+            compose_grid(images, ["front view", "top view", "side view", "rotated view \n (orthographic)"],
+                         map_name + " wireframe").save(image_path)
         elif image_type == "rotated":
-            wf.create_line_image(lines_rot, None, x=0, y=2, title="rotated view \n (orthographic)").save(image_path)
+            wf.create_edge_image(lines, None, x=0, y=2, title="rotated view \n (orthographic)",
+                                 max_resolution=max_resolution, angles=rotation).save(image_path)
         else:
-            wf.create_line_image(lines, None, x=image_types_axes[image_type][0],
-                                 y=image_types_axes[image_type][1]).save(image_path)
+            wf.create_edge_image(lines, None, x=image_types_axes[image_type][0], y=image_types_axes[image_type][1],
+                                 max_resolution=max_resolution).save(image_path)
+
+
+def save_frames(frames, output_path: str, duration: int = 100) -> int:
+    """
+    Stores rendered frames either one file per frame or as animated image
+    :param frames: iterable of PIL images, consumed one after another
+    :param output_path: path containing a format field like "frames/{:04d}.png" for one file per frame (each frame is
+    written as soon as it's rendered), otherwise path of an animated .gif, .webp or .png file
+    :param duration: display time per frame in milliseconds, only for animated images
+    :return: number of frames
+    """
+    frames = iter(frames)
+    if "{" in output_path:
+        n_frames = 0
+        for idx, frame in enumerate(frames):
+            frame.save(output_path.format(idx))
+            n_frames += 1
+        return n_frames
+    first_frame = next(frames, None)
+    if first_frame is None:
+        return 0
+    n_frames = 1
+
+    def remaining_frames():
+        # PIL pulls the remaining frames one by one while writing the animation
+        nonlocal n_frames
+        for frame in frames:
+            n_frames += 1
+            yield frame
+    first_frame.save(output_path, save_all=True, append_images=remaining_frames(), duration=duration, loop=0)
+    return n_frames
+
+
+def create_animation(path_to_pball: str, map_path: str, views, output_path: str, mode: int = 0,
+                     max_resolution: int = 1024, fov: int = 50, duration: int = 100) -> int:
+    """
+    Renders one rotated view per entry of views, geometry and colors are only loaded once
+    :param path_to_pball: path to pball directory / root directory for game media
+    :param map_path: local path to map file including .bsp extension
+    :param views: list of x, y, z rotation angles in degrees, one per frame
+    :param output_path: see save_frames
+    :param mode: 0: colored perspective, 1: colored orthographic
+    :param max_resolution: width and height of each frame, views are centered
+    :param fov: field of view for perspective projection
+    :param duration: display time per frame in milliseconds, only for animated images
+    :return: number of frames
+    """
+    if mode not in [0, 1]:
+        print("Error: animations are only supported for modes 0 and 1")
+        return 0
+    import colored_radar_image as cl
+    packed = cl.load_packed_polygons(path_to_pball + map_path, path_to_pball)
+
+    def render_frames():
+        for x_angle, y_angle, z_angle in views:
+            img = cl.create_packed_image(packed, x_angle, y_angle, z_angle, mode == 0, max_resolution, fov)
+            # views have different aspect ratios, frames need the same size
+            frame = Image.new("RGBA", (max_resolution, max_resolution), (255, 255, 255, 100))
+            frame.paste(img, ((max_resolution - img.width) // 2, (max_resolution - img.height) // 2))
+            yield frame
+    return save_frames(render_frames(), output_path, duration)
+
+
+def create_camera_animation(path_to_pball: str, map_path: str, poses, output_path: str, fov: float = 90,
+                            size=(1024, 768), duration: int = 100) -> int:
+    """
+    Renders one player perspective view per camera pose (fly-through), the map is only loaded once
+    :param path_to_pball: path to pball directory / root directory for game media
+    :param map_path: local path to map file including .bsp extension
+    :param poses: list of (position, (pitch, yaw, roll)) tuples, one per frame
+    :param output_path: see save_frames
+    :param fov: horizontal field of view in degrees
+    :param size: image width and height
+    :param duration: display time per frame in milliseconds, only for animated images
+    :return: number of frames
+    """
+    import camera_radar_image as cam
+    scene = cam.load_camera_scene(path_to_pball + map_path, path_to_pball)
+    return save_frames((cam.render_camera_view(scene, position, angles, fov, size) for position, angles in poses),
+                       output_path, duration)
+
+
+def create_tiled_image(path_to_pball: str, map_path: str, mode: int, output_path: str, x_an: float = None,
+                       y_an: float = None, z_an: float = None, max_resolution: int = 16384, fov: int = 50,
+                       tile_size: int = 1024, workers: int = 1) -> None:
+    """
+    Renders a rotated view in tiles, for print resolutions that don't fit into memory as one image
+    :param path_to_pball: path to pball directory / root directory for game media
+    :param map_path: local path to map file including .bsp extension
+    :param mode: 0: colored perspective, 1: colored orthographic
+    :param output_path: .png file or path with {x} and {y} format fields for one file per tile
+    :param x_an: rotation angle in degrees, optimal angle is used if any angle is missing
+    :param y_an: rotation angle in degrees
+    :param z_an: rotation angle in degrees
+    :param max_resolution: size of the longer image side in pixels
+    :param fov: field of view for perspective projection
+    :param tile_size: width and height of a tile in pixels
+    :param workers: number of processes rendering tiles in parallel
+    :return: None, image is stored to drive
+    """
+    if mode not in [0, 1]:
+        print("Error: tiled rendering is only supported for modes 0 and 1")
+        return
+    import colored_radar_image as cl
+    import tiled_radar_image as tl
+    packed = cl.load_packed_polygons(path_to_pball + map_path, path_to_pball)
+    if x_an is None or y_an is None or z_an is None:
+        x_an, y_an, z_an = get_optimal_angle(packed.vertices, packed.loop_start, packed.loop_total)
+    tl.create_tiled_image(packed, x_an, y_an, z_an, mode == 0, output_path, max_resolution, fov, tile_size, workers)
+
+
+def create_tile_pyramid(path_to_pball: str, map_path: str, mode: int, output_dir: str, x_an: float = None,
+                        y_an: float = None, z_an: float = None, max_zoom: int = 4, fov: int = 50,
+                        tile_size: int = 256, workers: int = 1) -> None:
+    """
+    Renders a rotated view as z/x/y tile pyramid (output_dir/zoom/x/y.png) for zoomable web viewers
+    :param path_to_pball: path to pball directory / root directory for game media
+    :param map_path: local path to map file including .bsp extension
+    :param mode: 0: colored perspective, 1: colored orthographic
+    :param output_dir: directory to store tiles to
+    :param x_an: rotation angle in degrees, optimal angle is used if any angle is missing
+    :param y_an: rotation angle in degrees
+    :param z_an: rotation angle in degrees
+    :param max_zoom: highest zoom level, zoom level 0 is a single tile
+    :param fov: field of view for perspective projection
+    :param tile_size: width and height of a tile in pixels
+    :param workers: number of processes rendering tiles in parallel
+    :return: None, tiles are stored to drive
+    """
+    if mode not in [0, 1]:
+        print("Error: tile pyramids are only supported for modes 0 and 1")
+        return
+    import colored_radar_image as cl
+    import tiled_radar_image as tl
+    packed = cl.load_packed_polygons(path_to_pball + map_path, path_to_pball)
+    if x_an is None or y_an is None or z_an is None:
+        x_an, y_an, z_an = get_optimal_angle(packed.vertices, packed.loop_start, packed.loop_total)
+    tl.create_tile_pyramid(packed, x_an, y_an, z_an, mode == 0, output_dir, max_zoom, fov, tile_size, workers)
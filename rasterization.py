@@ -0,0 +1,96 @@
+# Vectorized rasterization of many convex polygons into NumPy buffers, used where drawing polygon by polygon with PIL
+# is too slow or where values need to be accumulated instead of painted over
+import numpy as np
+
+
+def get_polygon_spans(points, loop_start, loop_total, size):
+    """
+    Cuts convex polygons into horizontal spans of pixels, all polygons at once
+    A pixel is covered if its center lies inside the polygon
+    :param points: (n_corners, 2) pixel positions
+    :param loop_start: index of first corner per polygon
+    :param loop_total: number of corners per polygon
+    :param size: width and height of the image, spans are clipped to it
+    :return: polygon index, row, first column and end column (exclusive) per span
+    """
+    width, height = size
+    face_ids = np.repeat(np.arange(len(loop_total)), loop_total)
+    following = np.arange(len(points)) + 1
+    following[loop_start + loop_total - 1] = loop_start
+    start, end = points, points[following]
+
+    # rows whose pixel center lies between both ends of the edge, lower end included
+    first_row = np.clip(np.ceil(np.minimum(start[:, 1], end[:, 1]) - 0.5), 0, height).astype(np.int64)
+    end_row = np.clip(np.ceil(np.maximum(start[:, 1], end[:, 1]) - 0.5), 0, height).astype(np.int64)
+    n_rows = np.maximum(end_row - first_row, 0)
+    edges = np.repeat(np.arange(len(points)), n_rows)
+    rows = np.repeat(first_row, n_rows) + np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    crossing = start[edges, 0] + (rows + 0.5 - start[edges, 1]) / (end[edges, 1] - start[edges, 1]) * \
+        (end[edges, 0] - start[edges, 0])
+
+    # a convex polygon covers one span per row, from its leftmost to its rightmost edge crossing
+    keys = face_ids[edges] * height + rows
+    sort = np.argsort(keys, kind="stable")
+    keys, crossing = keys[sort], crossing[sort]
+    span_keys, span_starts = np.unique(keys, return_index=True)
+    if not len(span_keys):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    left = np.clip(np.ceil(np.minimum.reduceat(crossing, span_starts) - 0.5), 0, width).astype(np.int64)
+    right = np.clip(np.ceil(np.maximum.reduceat(crossing, span_starts) - 0.5), 0, width).astype(np.int64)
+    return span_keys // height, span_keys % height, left, right
+
+
+def accumulate_polygons(points, loop_start, loop_total, weights, size):
+    """
+    Rasterizes convex polygons into an accumulation buffer, every covered pixel gets the weight of the polygon added
+    Spans are accumulated as differences along their row that are summed up afterwards
+    :param points: (n_corners, 2) pixel positions
+    :param loop_start: index of first corner per polygon
+    :param loop_total: number of corners per polygon
+    :param weights: value added per polygon
+    :param size: width and height of the buffer
+    :return: (height, width) float32 array
+    """
+    width, height = size
+    faces, rows, left, right = get_polygon_spans(points, loop_start, loop_total, size)
+    span_weights = np.asarray(weights, dtype=np.float64)[faces]
+    differences = np.bincount(np.concatenate((rows * (width + 1) + left, rows * (width + 1) + right)),
+                              np.concatenate((span_weights, -span_weights)), height * (width + 1))
+    return np.cumsum(differences.reshape(height, width + 1).astype(np.float32), axis=1)[:, :width]
+
+
+def paint_polygons(points, loop_start, loop_total, size):
+    """
+    Rasterizes convex polygons where later polygons cover earlier ones, like drawing them one after another
+    :param points: (n_corners, 2) pixel positions
+    :param loop_start: index of first corner per polygon
+    :param loop_total: number of corners per polygon
+    :param size: width and height of the buffer
+    :return: (height, width) int64 array of the index of the last polygon covering each pixel, -1 where none does
+    """
+    width, height = size
+    faces, rows, left, right = get_polygon_spans(points, loop_start, loop_total, size)
+    lengths = np.maximum(right - left, 0)
+    pixels = np.repeat(rows * width + left, lengths) + np.arange(lengths.sum()) - \
+        np.repeat(np.cumsum(lengths) - lengths, lengths)
+    top = np.full(width * height, -1, dtype=np.int64)
+    np.maximum.at(top, pixels, np.repeat(faces, lengths))
+    return top.reshape(height, width)
+
+
+def get_line_quads(starts, ends, thickness):
+    """
+    Converts lines to rectangles so that thick lines can be rasterized like polygons
+    :param starts: (n, 2) first end of each line in pixels
+    :param ends: (n, 2) second end of each line in pixels
+    :param thickness: line width in pixels
+    :return: (4 * n, 2) corners, loop_start and loop_total for get_polygon_spans
+    """
+    direction = ends - starts
+    length = np.linalg.norm(direction, axis=1)
+    # lines without length are drawn as squares
+    direction = np.where(length[:, None] > 0, direction / np.maximum(length, 1e-9)[:, None], [1.0, 0.0])
+    offset = np.stack((-direction[:, 1], direction[:, 0]), axis=1) * thickness / 2
+    corners = np.stack((starts + offset, ends + offset, ends - offset, starts - offset), axis=1).reshape(-1, 2)
+    return corners, np.arange(len(starts)) * 4, np.full(len(starts), 4)
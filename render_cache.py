@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import struct
+import time
+from typing import Dict, Optional, Tuple
+import numpy as np
+from bsp_arrays import TEX_INFO_DTYPE
+from texture_colors import get_mean_color, save_color_cache
+from texture_index import get_texture_index
+
+# increase whenever the renderers change their output, invalidates all cached images
+# 2: rotated views at principal axis angles, 3: vectorized wireframe, 4: "all" composed in PIL,
+# 5: "all" at exact pixel sizes, 6: translucent svg polygons written one by one
+RENDER_VERSION = 6
+# default directory for rendered images and the cache index
+CACHE_DIR = "render_cache"
+
+# content hashes of map files, only recalculated when size or modification time change
+_map_hashes: Dict[str, Tuple[int, int, str]] = dict()
+
+
+def get_map_hash(map_path: str) -> str:
+    """
+    :param map_path: full path to map file
+    :return: sha256 hex digest of the map file
+    """
+    stat = os.stat(map_path)
+    key = os.path.abspath(map_path)
+    if key in _map_hashes and _map_hashes[key][:2] == (stat.st_size, stat.st_mtime_ns):
+        return _map_hashes[key][2]
+    sha = hashlib.sha256()
+    with open(map_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    _map_hashes[key] = (stat.st_size, stat.st_mtime_ns, sha.hexdigest())
+    return sha.hexdigest()
+
+
+def get_texture_fingerprint(map_path: str, pball_path: str) -> str:
+    """
+    Hashes the mean colors of all textures used by a map, changes whenever a texture or the palette change
+    Only the texture information lump is read, colors come from the texture color cache
+    :param map_path: full path to map file
+    :param pball_path: path to pball / game media directory
+    :return: sha256 hex digest
+    """
+    with open(map_path, "rb") as f:
+        # header: magic, version, then offset and length of each lump, texture information is lump 5
+        f.seek(8 + 8 * 5)
+        offset, length = struct.unpack("<II", f.read(8))
+        f.seek(offset)
+        tex_infos = np.frombuffer(f.read(length), dtype=TEX_INFO_DTYPE)
+    texture_index = get_texture_index(pball_path)
+    colors = dict()
+    for texture in sorted(set(x.decode("ascii", "ignore") for x in tex_infos["texture_name"])):
+        texture_file = texture_index.find(texture)
+        colors[texture] = get_mean_color(texture_file.path) if texture_file else None
+    save_color_cache()
+    return hashlib.sha256(json.dumps(colors, sort_keys=True).encode()).hexdigest()
+
+
+def get_view_parameters(image_type: str, mode: int, dpi: int, x_an: Optional[float], y_an: Optional[float],
+                        z_an: Optional[float], max_resolution: int, fov: int, lightmap_shading: bool = False) -> dict:
+    """
+    Drops parameters that don't affect the image so that equivalent requests share one cache entry
+    dpi is accepted like create_image does but never part of the key, the renderers no longer use it
+    :return: dict of the parameters create_image uses for this image type and mode
+    """
+    parameters = {"image_type": image_type, "mode": mode, "max_resolution": max_resolution}
+    if image_type in ["rotated", "all"] and mode in [0, 1]:
+        # any missing angle makes create_image use the optimal angle
+        if x_an is None or y_an is None or z_an is None:
+            parameters["angles"] = None
+        else:
+            parameters["angles"] = [float(x_an) % 360, float(y_an) % 360, float(z_an) % 360]
+    if mode == 0:
+        parameters["fov"] = fov
+    if lightmap_shading and mode in [0, 1]:
+        # only added when set, so that keys of unshaded images stay the same
+        parameters["lightmap_shading"] = True
+    return parameters
+
+
+class RenderCache:
+    """
+    Stores rendered radar images under a key made of map content, texture colors and view parameters
+    Least recently used images are removed once max_entries or max_bytes are exceeded
+    """
+    def __init__(self, cache_dir: str = CACHE_DIR, max_entries: int = 500, max_bytes: int = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__index_path = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.__entries: Dict[str, dict] = dict()
+        if os.path.isfile(self.__index_path):
+            try:
+                with open(self.__index_path, "r") as f:
+                    self.__entries = json.load(f)
+            except (OSError, ValueError):
+                print(f"Info: could not read render cache index {self.__index_path}, starting with empty cache")
+        # entries whose image was deleted from outside
+        for key in [k for k, v in self.__entries.items() if not os.path.isfile(self.__get_path(v))]:
+            del self.__entries[key]
+
+    def __get_path(self, entry: dict) -> str:
+        return os.path.join(self.cache_dir, entry["file"])
+
+    def __save_index(self) -> None:
+        # write to temporary file first so that an interrupted write doesn't corrupt the index
+        with open(self.__index_path + ".tmp", "w") as f:
+            json.dump(self.__entries, f)
+        os.replace(self.__index_path + ".tmp", self.__index_path)
+
+    def __evict(self) -> None:
+        total_bytes = sum(x["size"] for x in self.__entries.values())
+        for key in sorted(self.__entries, key=lambda k: self.__entries[k]["last_access"]):
+            if len(self.__entries) <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            entry = self.__entries.pop(key)
+            total_bytes -= entry["size"]
+            if os.path.isfile(self.__get_path(entry)):
+                os.remove(self.__get_path(entry))
+
+    def get_image(self, path_to_pball: str, map_path: str, image_type: str, mode: int, dpi: int = 1700,
+                  x_an: float = None, y_an: float = None, z_an: float = None, max_resolution: int = 2048,
+                  fov: int = 50, extension: str = ".png", lightmap_shading: bool = False) -> Optional[str]:
+        """
+        Returns cached radar image, renders it with radar_image.create_image if it isn't cached yet
+        Parameters are the same as for create_image
+        :param extension: image format of the stored file
+        :return: path to image file inside the cache directory, None if rendering failed
+        """
+        full_map_path = path_to_pball + map_path
+        key_data = {"version": RENDER_VERSION, "map": get_map_hash(full_map_path),
+                    "textures": get_texture_fingerprint(full_map_path, path_to_pball),
+                    "view": get_view_parameters(image_type, mode, dpi, x_an, y_an, z_an, max_resolution, fov,
+                                                lightmap_shading),
+                    "extension": extension.lower()}
+        key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+        entry = self.__entries.get(key)
+        if entry and os.path.isfile(self.__get_path(entry)):
+            entry["last_access"] = time.time()
+            self.__save_index()
+            return self.__get_path(entry)
+
+        import radar_image
+        file_name = key + extension.lower()
+        # render to temporary file so that other processes never read a partially written image
+        temp_path = os.path.join(self.cache_dir, "tmp_" + file_name)
+        radar_image.create_image(path_to_pball, map_path, image_type, mode, temp_path, dpi, x_an, y_an, z_an,
+                                 max_resolution, fov, lightmap_shading)
+        if not os.path.isfile(temp_path):
+            return None
+        os.replace(temp_path, os.path.join(self.cache_dir, file_name))
+        self.__entries[key] = {"file": file_name, "size": os.path.getsize(os.path.join(self.cache_dir, file_name)),
+                               "last_access": time.time(), "map": os.path.abspath(full_map_path)}
+        self.__evict()
+        self.__save_index()
+        return self.__get_path(self.__entries[key]) if key in self.__entries else None
+
+    def invalidate(self, map_path: str = None) -> int:
+        """
+        Removes cached images, changed maps or textures don't need this as they lead to new keys anyway
+        :param map_path: full path to map file whose images are removed, None removes all images
+        :return: number of removed images
+        """
+        keys = [k for k, v in self.__entries.items()
+                if map_path is None or v["map"] == os.path.abspath(map_path)]
+        for key in keys:
+            entry = self.__entries.pop(key)
+            if os.path.isfile(self.__get_path(entry)):
+                os.remove(self.__get_path(entry))
+        self.__save_index()
+        return len(keys)
@@ -0,0 +1,67 @@
+# Writes radar images as svg files, polygons are written while they are produced instead of being rasterized first
+from typing import Iterable, Sequence, Tuple
+
+
+def _format_color(color: Sequence[int]) -> str:
+    # svg colors have no alpha channel, it's written as separate opacity
+    return f"#{int(color[0]):02x}{int(color[1]):02x}{int(color[2]):02x}"
+
+
+def _format_opacity(alpha: int) -> str:
+    return f"{int(alpha) / 255:.3g}"
+
+
+def write_svg(image_path: str, size: Tuple[int, int], polygons: Iterable[Tuple[Sequence, Sequence[int]]],
+              background: Sequence[int] = (255, 255, 255, 100), outline: Sequence[int] = (0, 0, 0),
+              outline_width: float = 1.0) -> int:
+    """
+    Streams polygons to an svg file in drawing order
+    Consecutive opaque polygons of the same color are merged into one path element, which keeps files small.
+    Their corners are put in the same winding order, with opposite ones overlapping parts would cancel out and leave
+    holes under the nonzero fill rule. Translucent polygons get one element each so that each one is blended.
+    :param image_path: path of .svg file
+    :param size: width and height of the image
+    :param polygons: iterable of (corner pixel positions, RGB or RGBA fill color), later polygons cover earlier ones
+    :param background: RGBA color of the image background
+    :param outline: RGB or RGBA color of polygon outlines
+    :param outline_width: width of polygon outlines in pixels
+    :return: number of path elements
+    """
+    width, height = size
+    n_paths = 0
+    with open(image_path, "w") as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+                f'viewBox="0 0 {width} {height}">\n')
+        f.write(f'<rect width="{width}" height="{height}" fill="{_format_color(background)}" '
+                f'fill-opacity="{_format_opacity(background[3])}"/>\n')
+        stroke = f'stroke="{_format_color(outline)}" stroke-width="{outline_width:g}" stroke-linejoin="round"'
+        if len(outline) > 3:
+            stroke += f' stroke-opacity="{_format_opacity(outline[3])}"'
+        f.write(f'<g {stroke}>\n')
+
+        current_color, subpaths = None, list()
+
+        def write_path() -> None:
+            f.write(f'<path fill="{_format_color(current_color)}"')
+            if len(current_color) > 3 and current_color[3] < 255:
+                f.write(f' fill-opacity="{_format_opacity(current_color[3])}"')
+            f.write(f' d="{"".join(subpaths)}"/>\n')
+
+        for points, color in polygons:
+            color = tuple(int(x) for x in color)
+            opaque = len(color) < 4 or color[3] == 255
+            if subpaths and (not color == current_color or not opaque):
+                write_path()
+                n_paths += 1
+                subpaths = list()
+            current_color = color
+            points = [(float(x), float(y)) for x, y in points]
+            # negative signed area (shoelace formula) means counterclockwise on screen, y points down in svg
+            if sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1])) < 0:
+                points.reverse()
+            subpaths.append("M" + "L".join(f"{x:.1f} {y:.1f}" for x, y in points) + "Z")
+        if subpaths:
+            write_path()
+            n_paths += 1
+        f.write("</g>\n</svg>\n")
+    return n_paths
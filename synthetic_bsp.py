@@ -0,0 +1,178 @@
+# Generates valid Quake 2 bsp files of any size, e.g. for measuring how run time scales with map size
+import math
+import struct
+from typing import List, Optional
+import numpy as np
+from bsp_arrays import FACE_DTYPE, LEAF_DTYPE, MODEL_DTYPE, NODE_DTYPE, PLANE_DTYPE, TEX_INFO_DTYPE
+
+BSP_VERSION = 38
+# plane types of the bsp format, planes along x, y, z and planes mostly facing along z
+PLANE_Y = 1
+PLANE_ANYZ = 5
+CONTENTS_SOLID = 1
+# leaf faces are referenced by 16 bit indices, edges by 16 bit vertex indices
+MAX_FACES = 65536
+
+
+def compress_vis_row(row: np.ndarray) -> bytes:
+    """
+    Run length encodes a row of the visibility matrix the way the vis tool does, runs of zero bytes are stored as
+    zero followed by the run length
+    :param row: uint8 array, one bit per cluster
+    :return: compressed bytes
+    """
+    compressed = bytearray()
+    idx = 0
+    while idx < len(row):
+        if row[idx]:
+            compressed.append(int(row[idx]))
+            idx += 1
+            continue
+        run = 0
+        while idx < len(row) and not row[idx] and run < 255:
+            run += 1
+            idx += 1
+        compressed += bytes([0, run])
+    return bytes(compressed)
+
+
+def get_vis_lump(n_clusters: int, visible_range: int) -> bytes:
+    """
+    :param n_clusters: number of clusters
+    :param visible_range: each cluster sees the clusters with up to this index distance
+    :return: visibility lump with identical potentially visible and hearable sets
+    """
+    if not n_clusters:
+        return b""
+    cluster = np.arange(n_clusters)
+    visible = np.abs(cluster[:, None] - cluster[None, :]) <= visible_range
+    rows = [compress_vis_row(np.packbits(x, bitorder="little")) for x in visible]
+    offsets = 4 + 8 * n_clusters + np.concatenate(([0], np.cumsum([len(x) for x in rows])))
+    header = struct.pack("<I", n_clusters) + b"".join(
+        struct.pack("<II", offsets[i], offsets[i] + offsets[-1] - offsets[0]) for i in range(n_clusters))
+    return header + b"".join(rows) * 2
+
+
+def create_synthetic_bsp(path: str, n_faces: int = 2000, n_leaves: int = 64, n_clusters: int = 32,
+                         lightmap_size: int = 5, n_textures: int = 8) -> Optional[dict]:
+    """
+    Writes a map of rolling terrain made of triangles, with one world model, a chain of bsp nodes, leaves with
+    contiguous faces, visibility data and a lightmap per face
+    Everything is derived from the parameters, the same parameters always produce the same file
+    :param path: path of the .bsp file
+    :param n_faces: approximate number of faces, rounded to two triangles per grid cell, at most MAX_FACES
+    :param n_leaves: number of non-solid leaves, at most the number of faces
+    :param n_clusters: number of vis clusters, 0 for an unvised map
+    :param lightmap_size: lightmap width and height of every face in texels, >= 2
+    :param n_textures: number of texture information entries
+    :return: dict of the actual counts of the generated map, None if nothing was written
+    """
+    if lightmap_size < 2:
+        print(f"Error: lightmap size {lightmap_size} is too small, faces span at least 2 texels")
+        return None
+    cells = max(1, int(math.sqrt(min(n_faces, MAX_FACES) / 2)))
+    # lightmap texels are 16 units apart, a cell spans lightmap_size texels if its corners are on texel boundaries
+    cell_size = 16 * (lightmap_size - 1)
+    n_faces = 2 * cells * cells
+    n_leaves = max(1, min(n_leaves, n_faces))
+    n_clusters = min(n_clusters, n_leaves)
+
+    # heightfield vertices, around the origin but on multiples of cell_size
+    grid = (np.arange(cells + 1) - cells // 2) * cell_size
+    x, y = np.meshgrid(grid, grid, indexing="ij")
+    z = np.round(96 * np.sin(x / 700) + 64 * np.cos(y / 530))
+    vertices = np.stack((x, y, z), axis=-1).reshape(-1, 3).astype(np.float32)
+
+    # two triangles per cell, wound clockwise when seen from above like quake 2 faces, ordered by descending y
+    i, j = np.meshgrid(np.arange(cells), np.arange(cells)[::-1], indexing="xy")
+    a = (i * (cells + 1) + j).reshape(-1)
+    b, c, d = a + cells + 1, a + cells + 2, a + 1
+    triangles = np.stack((np.stack((a, c, b), axis=1), np.stack((a, d, c), axis=1)), axis=1).reshape(-1, 3)
+
+    # every face has its own three edges, face edge i is edge i
+    edges = np.stack((triangles, np.roll(triangles, -1, axis=1)), axis=2).reshape(-1, 2)
+    face_edges = np.arange(3 * n_faces, dtype=np.int32)
+
+    corners = vertices[triangles].astype(np.float64)
+    normals = np.cross(corners[:, 2] - corners[:, 0], corners[:, 1] - corners[:, 0])
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    leaf_bounds = [int(x) for x in np.linspace(0, n_faces, n_leaves + 1)]
+    # nodes split between leaves along y, the back child of the last node is the solid leaf 0
+    split_heights = [float(corners[leaf_bounds[idx]:leaf_bounds[idx + 1], :, 1].min()) for idx in range(n_leaves)]
+
+    planes = np.zeros(n_faces + n_leaves, dtype=PLANE_DTYPE)
+    planes["normal"][:n_faces] = normals
+    planes["distance"][:n_faces] = np.einsum("ij,ij->i", normals, corners[:, 0])
+    planes["type"][:n_faces] = PLANE_ANYZ
+    planes["normal"][n_faces:] = [0, 1, 0]
+    planes["distance"][n_faces:] = split_heights
+    planes["type"][n_faces:] = PLANE_Y
+
+    tex_infos = np.zeros(n_textures, dtype=TEX_INFO_DTYPE)
+    tex_infos["u_axis"] = [1, 0, 0]
+    tex_infos["v_axis"] = [0, 1, 0]
+    tex_infos["texture_name"] = [f"synthetic/texture{idx}".encode() for idx in range(n_textures)]
+    tex_infos["next_texinfo"] = 0xFFFFFFFF
+
+    # lightmap extents the way the engine calculates them, texture axes are x and y without offsets
+    texture_mins = np.floor(corners[:, :, :2].min(axis=1) / 16)
+    texture_maxs = np.ceil(corners[:, :, :2].max(axis=1) / 16)
+    texels = ((texture_maxs - texture_mins + 1).prod(axis=1)).astype(np.int64)
+    faces = np.zeros(n_faces, dtype=FACE_DTYPE)
+    faces["plane"] = np.arange(n_faces)
+    faces["first_edge"] = np.arange(n_faces) * 3
+    faces["num_edges"] = 3
+    faces["texture_info"] = (np.arange(n_faces) // 2 // max(cells // n_textures, 1)) % n_textures
+    faces["lightmap_styles"] = [0, 255, 255, 255]
+    faces["lightmap_offset"] = (np.cumsum(texels) - texels) * 3
+    # brightness falls off towards the map border, texels within a face get a small gradient
+    brightness = 200 - 150 * np.abs(corners[:, :, :2].mean(axis=1)).max(axis=1) / max(np.abs(grid).max(), 1)
+    gradient = np.arange(texels.sum()) - np.repeat(np.cumsum(texels) - texels, texels)
+    lightmap = np.repeat(brightness, texels) + 40 * gradient / np.repeat(np.maximum(texels - 1, 1), texels) - 20
+    lightmap = np.clip(lightmap[:, None] * [1.0, 0.95, 0.85], 0, 255).astype(np.uint8)
+
+    leaves = np.zeros(n_leaves + 1, dtype=LEAF_DTYPE)
+    leaves["contents"][0] = CONTENTS_SOLID
+    leaves["cluster"][0] = -1
+    leaves["area"][1:] = 1
+    leaves["cluster"][1:] = np.arange(n_leaves) * n_clusters // n_leaves if n_clusters else -1
+    leaves["first_leaf_face"][1:] = leaf_bounds[:-1]
+    leaves["num_leaf_faces"][1:] = np.diff(leaf_bounds)
+    for idx in range(n_leaves):
+        leaf_corners = corners[leaf_bounds[idx]:leaf_bounds[idx + 1]].reshape(-1, 3)
+        leaves["bbox_min"][idx + 1] = np.floor(leaf_corners.min(axis=0))
+        leaves["bbox_max"][idx + 1] = np.ceil(leaf_corners.max(axis=0))
+
+    nodes = np.zeros(n_leaves, dtype=NODE_DTYPE)
+    nodes["plane"] = n_faces + np.arange(n_leaves)
+    nodes["front_child"] = -(np.arange(n_leaves) + 2)
+    nodes["back_child"] = np.append(np.arange(1, n_leaves), -1)
+    nodes["bbox_min"] = np.floor(vertices.min(axis=0))
+    nodes["bbox_max"] = np.ceil(vertices.max(axis=0))
+
+    models = np.zeros(1, dtype=MODEL_DTYPE)
+    models["bbox_min"] = vertices.min(axis=0) - 1
+    models["bbox_max"] = vertices.max(axis=0) + 1
+    models["num_faces"] = n_faces
+
+    entities = ('{\n"classname" "worldspawn"\n"message" "synthetic map"\n}\n'
+                '{\n"classname" "info_player_deathmatch"\n"origin" "0 0 %d"\n}\n\x00' % (int(z.max()) + 64))
+    lumps: List[bytes] = [
+        entities.encode("cp1252"), planes.tobytes(), vertices.tobytes(),
+        get_vis_lump(n_clusters, max(1, n_clusters // 8)), nodes.tobytes(), tex_infos.tobytes(), faces.tobytes(),
+        lightmap.tobytes(), leaves.tobytes(), np.arange(n_faces, dtype="<u2").tobytes(), b"",
+        edges.astype("<u2").tobytes(), face_edges.tobytes(), models.tobytes(), b"", b"", bytes(256),
+        # area 0 is unused, all leaves are in area 1 without any area portals
+        bytes(16), b""]
+
+    offset = 8 + 8 * 19
+    header = b"IBSP" + struct.pack("<I", BSP_VERSION)
+    for lump in lumps:
+        header += struct.pack("<II", offset, len(lump))
+        offset += (len(lump) + 3) & ~3
+    with open(path, "wb") as f:
+        f.write(header)
+        for lump in lumps:
+            f.write(lump + bytes(((len(lump) + 3) & ~3) - len(lump)))
+    return {"faces": n_faces, "vertices": len(vertices), "leaves": n_leaves + 1, "clusters": n_clusters,
+            "lightmap_texels": int(texels.sum())}
@@ -0,0 +1,192 @@
+import json
+import os
+import struct
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from PIL import Image, WalImageFile
+
+# palette used for 8 bit .wal textures
+PALETTE_PATH = "pb2e.pal"
+# mean colors are stored here so that textures only need to be decoded once
+CACHE_PATH = "texture_colors.json"
+# increase whenever the way mean colors are calculated changes, invalidates all cached colors
+COLOR_VERSION = 2
+# 0 uses the full resolution image stored in .wal files, 1-3 the smaller precalculated mip levels
+WAL_MIP_LEVEL = 0
+# > 1 lets the jpeg decoder skip detail (1/2, 1/4 or 1/8 size), mean color then is no longer exact
+DRAFT_SCALE = 1
+
+# palettes and color caches are loaded once per process and shared by all renderers
+_palettes: Dict[str, List[int]] = dict()
+_color_caches: Dict[str, Dict[str, dict]] = dict()
+_changed_caches = set()
+
+
+def load_palette(palette_path: str = PALETTE_PATH) -> List[int]:
+    """
+    Reads a JASC palette file, only done once per process and palette
+    :param palette_path: path to .pal file
+    :return: flat list of r, g, b values as expected by Image.putpalette
+    """
+    if palette_path not in _palettes:
+        with open(palette_path, "r") as pal:
+            conts = (pal.read().split("\n")[3:])
+            conts = [b.split(" ") for b in conts]
+            # skip empty strings caused by a trailing line break instead of dropping the last value
+            conts = [c for b in conts for c in b if c]
+            _palettes[palette_path] = list(map(int, conts))
+    return _palettes[palette_path]
+
+
+def load_wal(texture_path: str, palette_path: str = PALETTE_PATH) -> Image.Image:
+    """
+    Opens an 8 bit .wal texture and applies the palette
+    :param texture_path: full path to .wal file
+    :param palette_path: path to .pal file
+    :return: RGBA Image object
+    """
+    img = WalImageFile.open(texture_path)
+    # newer PIL versions load lazily and set the default quake 2 palette when loading, so load before replacing it
+    img.load()
+    img.putpalette(load_palette(palette_path))
+    return img.convert("RGBA")
+
+
+def get_color_cache(cache_path: str = CACHE_PATH) -> Dict[str, dict]:
+    """
+    Returns the in-memory color cache, reads it from drive on first access
+    :param cache_path: path to json file storing the cache
+    :return: dict of texture path -> cache entry
+    """
+    if cache_path not in _color_caches:
+        cache = dict()
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "r") as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                print(f"Info: could not read texture color cache {cache_path}, rebuilding it")
+                cache = dict()
+        _color_caches[cache_path] = cache
+    return _color_caches[cache_path]
+
+
+def save_color_cache(cache_path: str = CACHE_PATH) -> None:
+    """
+    Writes the color cache back to drive if any new colors were calculated
+    :param cache_path: path to json file storing the cache
+    :return: None
+    """
+    if cache_path not in _changed_caches:
+        return
+    # write to temporary file first so that an interrupted write doesn't corrupt the cache
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(_color_caches[cache_path], f)
+    os.replace(cache_path + ".tmp", cache_path)
+    _changed_caches.discard(cache_path)
+
+
+def _get_stamp(texture_path: str, palette_path: str, stat: Optional[os.stat_result], mip_level: int,
+               draft_scale: int) -> list:
+    # a cached color is only valid as long as texture file, palette (for .wal) and calculation stay the same
+    stat = stat if stat else os.stat(texture_path)
+    stamp = [COLOR_VERSION, stat.st_size, stat.st_mtime_ns]
+    if os.path.splitext(texture_path)[1].lower() == ".wal":
+        pal_stat = os.stat(palette_path)
+        stamp += [os.path.abspath(palette_path), pal_stat.st_size, pal_stat.st_mtime_ns, mip_level]
+    else:
+        stamp += [draft_scale]
+    return stamp
+
+
+def get_wal_mean_color(texture_path: str, palette_path: str = PALETTE_PATH,
+                       mip_level: int = WAL_MIP_LEVEL) -> Tuple[int, ...]:
+    """
+    Calculates mean color of a .wal texture from a histogram of its palette indices, no image is decoded
+    :param texture_path: full path to .wal file
+    :param palette_path: path to .pal file
+    :param mip_level: 0 for full resolution, 1-3 for the mip levels stored in the file (1/2, 1/4, 1/8 size)
+    :return: RGBA color
+    """
+    with open(texture_path, "rb") as f:
+        wal_bytes = f.read()
+    # header: 32 byte name, width, height, 4 mip level offsets (all uint32)
+    width, height = struct.unpack("<II", wal_bytes[32:40])
+    mip_offsets = struct.unpack("<IIII", wal_bytes[40:56])
+    n_pixels = max(1, width >> mip_level) * max(1, height >> mip_level)
+    indices = np.frombuffer(wal_bytes, dtype=np.uint8, count=n_pixels, offset=mip_offsets[mip_level])
+    # number of pixels per palette index, weighted sum of palette colors is the mean color
+    counts = np.bincount(indices, minlength=256)
+    palette = np.array(load_palette(palette_path), dtype=np.float64).reshape(-1, 3)
+    mean_color = counts @ palette[:len(counts)] / n_pixels
+    return tuple(int(round(x)) for x in mean_color) + (255,)
+
+
+def get_image_mean_color(texture_path: str, draft_scale: int = DRAFT_SCALE) -> Tuple[int, ...]:
+    """
+    Calculates mean color of a true color texture as mean over all pixels
+    Transparent pixels contribute less to the color, like when rescaling an RGBA image
+    :param texture_path: full path to image file
+    :param draft_scale: 2, 4 or 8 to decode jpegs at reduced size, 1 for exact mean color
+    :return: RGBA color
+    """
+    img = Image.open(texture_path)
+    if draft_scale > 1:
+        # only supported by jpeg, ignored by other formats
+        img.draft("RGB", (max(1, img.width // draft_scale), max(1, img.height // draft_scale)))
+    pixels = np.asarray(img.convert("RGBA"), dtype=np.float64).reshape(-1, 4)
+    alpha_sum = pixels[:, 3].sum()
+    if alpha_sum == 0:
+        rgb = pixels[:, :3].mean(axis=0)
+    else:
+        rgb = pixels[:, :3].T @ pixels[:, 3] / alpha_sum
+    return tuple(int(round(x)) for x in rgb) + (int(round(pixels[:, 3].mean())),)
+
+
+def calculate_mean_color(texture_path: str, palette_path: str = PALETTE_PATH, mip_level: int = WAL_MIP_LEVEL,
+                         draft_scale: int = DRAFT_SCALE) -> Optional[Tuple[int, ...]]:
+    """
+    Calculates mean color of a texture, result doesn't depend on PIL resampling filters
+    :param texture_path: full path to texture file
+    :param palette_path: path to .pal file, only needed for .wal textures
+    :param mip_level: mip level used for .wal textures
+    :param draft_scale: reduced decoding for jpeg textures
+    :return: RGBA color or None for unsupported formats
+    """
+    extension = os.path.splitext(texture_path)[1].lower()
+    if extension in [".png", ".jpg", ".tga"]:
+        return get_image_mean_color(texture_path, draft_scale)
+    elif extension == ".wal":
+        # wal files are 8 bit and require a palette
+        return get_wal_mean_color(texture_path, palette_path, mip_level)
+    print(f"Error: unsupported format {extension} in {texture_path}"
+          f"\nsupported formats are .png, .jpg, .tga, .wal")
+    return None
+
+
+def get_mean_color(texture_path: str, palette_path: str = PALETTE_PATH, cache_path: str = CACHE_PATH,
+                   stat: Optional[os.stat_result] = None, mip_level: int = WAL_MIP_LEVEL,
+                   draft_scale: int = DRAFT_SCALE) -> Optional[Tuple[int, ...]]:
+    """
+    Returns mean color of a texture, only decodes it if no valid cached color exists
+    Call save_color_cache afterwards to persist newly calculated colors
+    :param texture_path: full path to texture file including extension
+    :param palette_path: path to .pal file, only needed for .wal textures
+    :param cache_path: path to json file storing the cache
+    :param stat: os.stat result of the texture file if already known
+    :param mip_level: mip level used for .wal textures
+    :param draft_scale: reduced decoding for jpeg textures
+    :return: RGBA color or None for unsupported formats
+    """
+    cache = get_color_cache(cache_path)
+    key = os.path.abspath(texture_path)
+    stamp = _get_stamp(texture_path, palette_path, stat, mip_level, draft_scale)
+    if key in cache and cache[key]["stamp"] == stamp:
+        return tuple(cache[key]["color"])
+
+    color = calculate_mean_color(texture_path, palette_path, mip_level, draft_scale)
+    if color is None:
+        return None
+    cache[key] = {"stamp": stamp, "color": list(color)}
+    _changed_caches.add(cache_path)
+    return tuple(color)
@@ -0,0 +1,127 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+# texture names are stored without extension in bsp files, if multiple files match, the first one in this list is used
+EXTENSION_PRIORITY = [".png", ".jpg", ".tga", ".wal"]
+
+# one index per game media directory, shared by everything running in this process
+_texture_indices: Dict[str, "TextureIndex"] = dict()
+
+
+@dataclass
+class TextureFile:
+    # no stat is kept, overwriting a file doesn't change its directory's modification time so it would go stale
+    path: str
+
+
+class TextureIndex:
+    """
+    Maps texture names the way they are stored in bsp files (case insensitive, without extension) to texture files
+    The directory tree is only listed once, refresh() then only lists directories whose modification time changed
+    """
+    def __init__(self, texture_dir: str):
+        self.texture_dir = texture_dir
+        self.__directories: Dict[str, TextureIndex.__Directory] = dict()
+        if os.path.isdir(texture_dir):
+            self.__scan_directory("", True)
+
+    @dataclass
+    class __Directory:
+        path: str  # relative to texture_dir with original upper and lower case
+        mtime_ns: int
+        textures: Dict[str, TextureFile]  # lowercase file name without extension -> file
+        subdirectories: List[str]  # lowercase relative paths
+
+    def __scan_directory(self, path: str, recursive: bool) -> None:
+        full_path = os.path.join(self.texture_dir, path)
+        # stat before listing so that changes during listing are caught by the next refresh
+        mtime_ns = os.stat(full_path).st_mtime_ns
+        textures: Dict[str, TextureFile] = dict()
+        subdirectories = list()
+        with os.scandir(full_path) as entries:
+            for entry in entries:
+                entry_path = path + "/" + entry.name if path else entry.name
+                if entry.is_dir():
+                    subdirectories.append(entry_path)
+                    continue
+                stem, extension = os.path.splitext(entry.name)
+                extension = extension.lower()
+                if extension not in EXTENSION_PRIORITY:
+                    continue
+                existing = textures.get(stem.lower())
+                if existing and EXTENSION_PRIORITY.index(os.path.splitext(existing.path)[1].lower()) <= \
+                        EXTENSION_PRIORITY.index(extension):
+                    continue
+                textures[stem.lower()] = TextureFile(os.path.join(full_path, entry.name))
+
+        key = path.lower()
+        old_subdirectories = self.__directories[key].subdirectories if key in self.__directories else []
+        self.__directories[key] = self.__Directory(path, mtime_ns, textures,
+                                                   [x.lower() for x in subdirectories])
+        # deleted subdirectories are removed, new ones (or all of them for a full scan) are listed
+        for subdirectory in set(old_subdirectories) - set(x.lower() for x in subdirectories):
+            self.__remove_directory(subdirectory)
+        for subdirectory in subdirectories:
+            if recursive or subdirectory.lower() not in self.__directories:
+                self.__scan_directory(subdirectory, True)
+
+    def __remove_directory(self, key: str) -> None:
+        directory = self.__directories.pop(key, None)
+        if directory:
+            for subdirectory in directory.subdirectories:
+                self.__remove_directory(subdirectory)
+
+    def refresh(self) -> None:
+        """
+        Updates the index, only directories with changed modification time are listed again
+        :return: None
+        """
+        if not self.__directories:
+            if os.path.isdir(self.texture_dir):
+                self.__scan_directory("", True)
+            return
+        for key in list(self.__directories.keys()):
+            directory = self.__directories.get(key)
+            if not directory:  # already removed together with its parent directory
+                continue
+            try:
+                mtime_ns = os.stat(os.path.join(self.texture_dir, directory.path)).st_mtime_ns
+            except FileNotFoundError:
+                self.__remove_directory(key)
+                continue
+            if not mtime_ns == directory.mtime_ns:
+                self.__scan_directory(directory.path, False)
+
+    def has_directory(self, path: str) -> bool:
+        """
+        :param path: directory relative to texture directory, case insensitive
+        :return: True if directory exists
+        """
+        return path.lower().strip("/") in self.__directories
+
+    def find(self, texture: str) -> Optional[TextureFile]:
+        """
+        Looks up texture file, if multiple files match, EXTENSION_PRIORITY decides
+        :param texture: texture name the way it is stored in the bsp file (relative to pball/textures, no extension)
+        :return: TextureFile or None if no such texture exists
+        """
+        directory, _, name = texture.lower().rpartition("/")
+        if directory not in self.__directories:
+            return None
+        return self.__directories[directory].textures.get(name)
+
+
+def get_texture_index(pball_path: str, refresh: bool = True) -> TextureIndex:
+    """
+    Returns texture index for game media directory, builds it on first call and refreshes it on later ones
+    :param pball_path: path to pball / game media directory
+    :param refresh: look for changed directories, can be skipped when the index was refreshed for the current map
+    :return: TextureIndex of pball_path/textures
+    """
+    key = os.path.abspath(pball_path)
+    if key not in _texture_indices:
+        _texture_indices[key] = TextureIndex(pball_path + "/textures")
+    elif refresh:
+        _texture_indices[key].refresh()
+    return _texture_indices[key]
@@ -1,7 +1,11 @@
 import os
-from typing import Optional
-from PIL import WalImageFile, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Optional
+from PIL import Image, ImageOps
 from Q2BSP import *
+from texture_colors import load_wal
+from texture_index import get_texture_index
 
 
 def load_texture(pball_path: str, texture: str) -> Optional[Image.Image]:
@@ -11,44 +15,39 @@ def load_texture(pball_path: str, texture: str) -> Optional[Image.Image]:
     :param texture: texture name the way it is stored in the bsp file (relative to pball/textures and without extension)
     :return: RGBA Image object
     """
-    if not os.path.exists(pball_path + "/textures/" + "/".join(texture.lower().split("/")[:-1])):
+    # the index is refreshed once per map in change_texture_paths, not for every single texture
+    texture_index = get_texture_index(pball_path, refresh=False)
+    if not texture_index.has_directory("/".join(texture.lower().split("/")[:-1])):
         print(f"Info: no such path {pball_path + '/textures/' + '/'.join(texture.lower().split('/')[:-1])}")
         return
-    # list of all files in stored subdirectory
-    texture_options = os.listdir(pball_path + "/textures/" + "/".join(texture.lower().split("/")[:-1]))
-    texture_path = ""
-    # iterate through texture options until one name matches stored texture name
-    for idx, tex_option in enumerate(texture_options):
-        if texture.split("/")[-1].lower() == os.path.splitext(tex_option)[0]:
-            texture_path = "/".join(texture.lower().split("/")[:-1]) + "/" + tex_option
-            break
+    texture_file = texture_index.find(texture)
 
     # texture was not found in specified subdirectory
-    if not texture_path:
+    if not texture_file:
         print("Missing texture: ", texture)
         return
+    texture_path = texture_file.path
+    image = load_texture_file(texture_path)
+    if not image:
+        print(f"Error: unsupported format {os.path.splitext(texture_path)[1]} in {texture_path}"
+              f"\nsupported formats are .png, .jpg, .tga, .wal")
+    return image
+
 
-    if os.path.splitext(texture_path)[1] in [".png", ".jpg", ".tga"]:
-        img = Image.open(pball_path + "/textures/" + texture_path)
+def load_texture_file(texture_path: str) -> Optional[Image.Image]:
+    """
+    Loads Image object from a texture file
+    :param texture_path: full path to .png, .jpg, .tga or .wal file
+    :return: RGBA Image object, None for unsupported formats
+    """
+    if os.path.splitext(texture_path)[1].lower() in [".png", ".jpg", ".tga"]:
+        img = Image.open(texture_path)
         img2 = img.convert("RGBA")
         return img2
 
-    elif os.path.splitext(texture_path)[1] == ".wal":
+    elif os.path.splitext(texture_path)[1].lower() == ".wal":
         # wal files are 8 bit and require a palette
-        with open("pb2e.pal", "r") as pal:
-            conts = (pal.read().split("\n")[3:])
-            conts = [b.split(" ") for b in conts]
-            conts = [c for b in conts for c in b]
-            conts.pop(len(conts) - 1)
-            conts = list(map(int, conts))
-            img3 = WalImageFile.open(pball_path + "/textures/" + texture_path)
-            img3.putpalette(conts)
-            img3 = img3.convert("RGBA")
-            return img3
-    else:
-        print(f"Error: unsupported format {os.path.splitext(texture_path)[1]} in {texture_path}"
-              f"\nsupported formats are .png, .jpg, .tga, .wal")
-        return
+        return load_wal(texture_path)
 
 
 def change_texture_paths(map_path: str, tex_dir: str, affix: str) -> List[str]:
@@ -68,70 +67,230 @@ def change_texture_paths(map_path: str, tex_dir: str, affix: str) -> List[str]:
     temp_map.save_map(map_path, "_" + affix)
 
 
-def create_inverted_textures(pball_path: str, map_path: str, new_dir: str, affix: str):
+def invert_texture(image: Image.Image) -> Image.Image:
     """
-    creates color inverted copy of all textures linked in the bsp file and creates map copy with edited texture links
+    Inverts the colors of an RGBA image, the alpha channel stays as it is
+    :param image: RGBA Image object
+    :return: RGBA Image object
+    """
+    # don't invert alpha channel
+    r, g, b, a = image.split()
+    rgb_image = Image.merge('RGB', (r, g, b))
+
+    inverted_image = ImageOps.invert(rgb_image)
+
+    r2, g2, b2 = inverted_image.split()
+
+    return Image.merge('RGBA', (r2, g2, b2, a))
+
+
+def monochrome_texture(image: Image.Image) -> Image.Image:
+    """
+    Scales an image to 1×1 pixel, its mean color
+    :param image: RGBA Image object
+    :return: RGBA Image object
+    """
+    return image.resize((1, 1))
+
+
+def grayscale_texture(image: Image.Image) -> Image.Image:
+    """
+    Converts an image to grayscale, the alpha channel stays as it is
+    :param image: RGBA Image object
+    :return: LA Image object
+    """
+    return image.convert('LA')
+
+
+@dataclass
+class TextureReport:
+    written: List[str] = field(default_factory=list)  # paths of new texture copies
+    skipped: List[str] = field(default_factory=list)  # paths of copies that are newer than their source
+    failed: Dict[str, str] = field(default_factory=dict)  # texture name -> reason
+
+
+def get_texture_copy_path(pball_path: str, new_dir: str, affix: str, texture: str) -> str:
+    """
+    Path of the modified copy of a texture, matching the texture name change_texture_paths stores in the bsp
     :param pball_path: path to game media folder
-    :param map_path: relative to pball path, includes .bsp extension
-    :param new_dir: subdirectory for white texture in /textures/
-    :param affix: name for color inverted texture and for texture stored
-    :return: None
+    :param new_dir: subdirectory of modified texture copies in /textures/
+    :param affix: prefix of the texture copy
+    :param texture: texture name the way it is stored in the bsp file
+    :return: full path of .png file
     """
-    textures = change_texture_paths(pball_path+map_path, new_dir, affix)
-    for texture in textures:
-        image = load_texture(pball_path, texture)
+    return pball_path + "/textures/" + new_dir + affix + "_" + texture.split("/")[-1] + ".png"
+
+
+@dataclass
+class TextureVariant:
+    transform: Callable[[Image.Image], Image.Image]  # must be defined at module level to be sent to worker processes
+    affix: str  # prefix of the texture copies and suffix of the map copy
+
+
+def _transform_texture(texture_path: str, transforms: List[Callable[[Image.Image], Image.Image]],
+                       output_paths: List[str]) -> List[Optional[str]]:
+    # runs in worker processes, the texture is decoded once for all variants
+    # errors are returned instead of raised so that one texture can't stop the others
+    try:
+        image = load_texture_file(texture_path)
         if not image:
+            return [f"unsupported format {os.path.splitext(texture_path)[1]}"] * len(output_paths)
+    except Exception as e:
+        return [f"{type(e).__name__}: {e}"] * len(output_paths)
+    errors = list()
+    for transform, output_path in zip(transforms, output_paths):
+        try:
+            transform(image).save(output_path, "PNG")
+            errors.append(None)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+    return errors
+
+
+def transform_texture_variants(pball_path: str, textures: Iterable[str], new_dir: str,
+                               variants: List[TextureVariant],
+                               workers: Optional[int] = None) -> Dict[str, TextureReport]:
+    """
+    Stores modified copies of each texture, textures are decoded, transformed and encoded in parallel
+    Every texture is decoded once for all variants and only once even if it's listed several times,
+    copies newer than their source are kept
+    :param pball_path: path to game media folder
+    :param textures: texture names the way they are stored in the bsp file
+    :param new_dir: subdirectory of modified texture copies in /textures/
+    :param variants: transform and affix of each kind of copy
+    :param workers: number of processes, None uses all cpu cores, 1 processes textures in this process
+    :return: dict of affix -> TextureReport object
+    """
+    reports = {variant.affix: TextureReport() for variant in variants}
+    # picks up texture files created since the last call
+    texture_index = get_texture_index(pball_path)
+    jobs, seen = list(), set()
+    for texture in textures:
+        # copies are named after the file name only
+        if texture.split("/")[-1] in seen:
+            continue
+        seen.add(texture.split("/")[-1])
+        texture_file = texture_index.find(texture)
+        if not texture_file:
+            for report in reports.values():
+                report.failed[texture] = "missing texture"
             continue
-        # don't invert alpha channel
-        r, g, b, a = image.split()
-        rgb_image = Image.merge('RGB', (r, g, b))
+        # stat at lookup time, the texture index doesn't notice files that were overwritten in place
+        source_mtime_ns = os.stat(texture_file.path).st_mtime_ns
+        outdated = list()
+        for variant in variants:
+            output_path = get_texture_copy_path(pball_path, new_dir, variant.affix, texture)
+            if os.path.exists(output_path) and os.stat(output_path).st_mtime_ns >= source_mtime_ns:
+                reports[variant.affix].skipped.append(output_path)
+            else:
+                outdated.append((variant, output_path))
+        if outdated:
+            jobs.append((texture, texture_file.path, outdated))
+    if not jobs:
+        return reports
+
+    os.makedirs(pball_path + "/textures/" + new_dir, exist_ok=True)
+    arguments = ([x[1] for x in jobs], [[variant.transform for variant, _ in x[2]] for x in jobs],
+                 [[output_path for _, output_path in x[2]] for x in jobs])
+    if workers == 1:
+        errors = list(map(_transform_texture, *arguments))
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            errors = list(executor.map(_transform_texture, *arguments, chunksize=8))
+    for (texture, _, outdated), texture_errors in zip(jobs, errors):
+        for (variant, output_path), error in zip(outdated, texture_errors):
+            if error:
+                reports[variant.affix].failed[texture] = error
+            else:
+                reports[variant.affix].written.append(output_path)
+    return reports
 
-        inverted_image = ImageOps.invert(rgb_image)
 
-        r2, g2, b2 = inverted_image.split()
+def transform_textures(pball_path: str, textures: Iterable[str], new_dir: str, affix: str,
+                       transform: Callable[[Image.Image], Image.Image], workers: Optional[int] = None) -> TextureReport:
+    """
+    Stores a modified copy of each texture, see transform_texture_variants
+    :param pball_path: path to game media folder
+    :param textures: texture names the way they are stored in the bsp file
+    :param new_dir: subdirectory of modified texture copies in /textures/
+    :param affix: prefix of the texture copies
+    :param transform: function of RGBA Image object -> Image object, must be defined at module level so that it can
+    be sent to worker processes
+    :param workers: number of processes, None uses all cpu cores, 1 processes textures in this process
+    :return: TextureReport object
+    """
+    return transform_texture_variants(pball_path, textures, new_dir, [TextureVariant(transform, affix)],
+                                      workers)[affix]
+
+
+def create_texture_variants(pball_path: str, map_path: str, new_dir: str, variants: List[TextureVariant],
+                            workers: Optional[int] = None) -> Dict[str, TextureReport]:
+    """
+    Creates several kinds of modified texture copies and one map copy per kind in one pass, the bsp file is loaded
+    once and every texture is decoded once
+    e.g. create_texture_variants(pball_path, "/maps/wipa.bsp", "twscripts/",
+    [TextureVariant(invert_texture, "inv"), TextureVariant(grayscale_texture, "gs")])
+    :param pball_path: path to game media folder
+    :param map_path: relative to pball path, includes .bsp extension
+    :param new_dir: subdirectory of modified texture copies in /textures/
+    :param variants: transform and affix of each kind of copy, map copies are stored as <map name>_<affix>.bsp
+    :param workers: number of processes, None uses all cpu cores
+    :return: dict of affix -> TextureReport object
+    """
+    temp_map = Q2BSP(pball_path+map_path)
+    textures = [tex_info.get_texture_name() for tex_info in temp_map.tex_infos]
+    for idx, variant in enumerate(variants):
+        for tex_info, tex_name in zip(temp_map.tex_infos, textures):
+            tex_info.set_texture_name(new_dir + variant.affix + "_" + tex_name.split("/")[-1])
+        if idx == 0:
+            temp_map.update_lump_sizes()
+        else:
+            # texture names have a fixed length, so only the texture information lump has to be serialized again
+            temp_map.save_tex_info(temp_map.tex_infos)
+        temp_map.save_map(pball_path+map_path, "_" + variant.affix)
+    return transform_texture_variants(pball_path, textures, new_dir, variants, workers)
 
-        final_transparent_image = Image.merge('RGBA', (r2, g2, b2, a))
 
-        final_transparent_image.save(
-            pball_path +"/textures/"+ new_dir + affix + "_" + texture.split("/")[len(texture.split("/")) - 1] + ".png", "PNG")
+def create_inverted_textures(pball_path: str, map_path: str, new_dir: str, affix: str,
+                             workers: Optional[int] = None) -> TextureReport:
+    """
+    creates color inverted copy of all textures linked in the bsp file and creates map copy with edited texture links
+    :param pball_path: path to game media folder
+    :param map_path: relative to pball path, includes .bsp extension
+    :param new_dir: subdirectory for white texture in /textures/
+    :param affix: name for color inverted texture and for texture stored
+    :param workers: number of processes, None uses all cpu cores
+    :return: TextureReport object
+    """
+    return create_texture_variants(pball_path, map_path, new_dir, [TextureVariant(invert_texture, affix)], workers)[affix]
 
 
-def create_monochrome_textures(pball_path: str, map_path: str, new_dir: str, affix: str) -> None:
+def create_monochrome_textures(pball_path: str, map_path: str, new_dir: str, affix: str,
+                               workers: Optional[int] = None) -> TextureReport:
     """
     creates monochrome 1×1 pixel copy of all textures linked in bsp and creates map copy with edited texture links
     :param pball_path: path to game media folder
     :param map_path: relative to pball path, includes .bsp extension
     :param new_dir: subdirectory for white texture in /textures/
     :param affix: name for monochrome texture and for texture stored
-    :return: None
+    :param workers: number of processes, None uses all cpu cores
+    :return: TextureReport object
     """
-    textures = change_texture_paths(pball_path+map_path, new_dir, affix)
-    for texture in textures:
-        image = load_texture(pball_path, texture)
-        if not image:
-            continue
-        image = image.resize((1, 1))
-        image.save(
-            pball_path +"/textures/"+ new_dir + affix + "_" + texture.split("/")[len(texture.split("/")) - 1] + ".png", "PNG")
+    return create_texture_variants(pball_path, map_path, new_dir, [TextureVariant(monochrome_texture, affix)], workers)[affix]
 
 
-def create_grayscale_textures(pball_path: str, map_path: str, new_dir: str, affix: str) -> None:
+def create_grayscale_textures(pball_path: str, map_path: str, new_dir: str, affix: str,
+                              workers: Optional[int] = None) -> TextureReport:
     """
     creates grayscale versions of all textures linked in the bsp and creates map copy with edited texture links
     :param pball_path: path to game media folder
     :param map_path: relative to pball path, includes .bsp extension
     :param new_dir: subdirectory for white texture in /textures/
     :param affix: prefix for grayscale texture and for texture name stored in the bsp
-    :return: None
+    :param workers: number of processes, None uses all cpu cores
+    :return: TextureReport object
     """
-    textures = change_texture_paths(pball_path+map_path, new_dir, affix)
-    for texture in textures:
-        image = load_texture(pball_path, texture)
-        if not image:
-            continue
-        image = image.convert('LA')
-        image.save(
-            pball_path +"/textures/"+ new_dir + affix + "_" + texture.split("/")[len(texture.split("/")) - 1] + ".png", "PNG")
+    return create_texture_variants(pball_path, map_path, new_dir, [TextureVariant(grayscale_texture, affix)], workers)[affix]
 
 
 def bsp_lightmap_only(pball_path: str, map_path: str, new_dir: str, affix: str) -> None:
@@ -0,0 +1,211 @@
+# Renders rotated views as independent tiles so that memory doesn't grow with the output resolution
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
+from PIL import Image, ImageDraw
+from colored_radar_image import PackedPolygons, ProjectedPolygons, get_pixel_coordinates, project_packed_polygons
+
+BACKGROUND_COLOR = (255, 255, 255, 100)
+
+# geometry shared by all tiles, set once per worker process instead of being sent with every tile
+_tile_geometry: dict = dict()
+
+
+def bin_polygons(pixels: np.ndarray, projected: ProjectedPolygons, tile_size: int,
+                 n_tiles: Tuple[int, int]) -> Dict[Tuple[int, int], np.ndarray]:
+    """
+    Assigns each polygon to all tiles its screen bounding box overlaps
+    :param pixels: (n_corners, 2) pixel positions of all corners
+    :param projected: ProjectedPolygons object
+    :param tile_size: width and height of a tile in pixels
+    :param n_tiles: number of tile columns and rows
+    :return: dict of (column, row) -> face indices in drawing order, tiles without polygons are missing
+    """
+    order = projected.order
+    if not len(order):
+        return dict()
+    # one pixel margin for outlines
+    bbox_min = np.minimum.reduceat(pixels, projected.loop_start, axis=0)[order] - 1
+    bbox_max = np.maximum.reduceat(pixels, projected.loop_start, axis=0)[order] + 1
+    first_tile = np.clip(np.floor(bbox_min / tile_size).astype(np.int64), 0, np.array(n_tiles) - 1)
+    last_tile = np.clip(np.floor(bbox_max / tile_size).astype(np.int64), 0, np.array(n_tiles) - 1)
+    columns = last_tile[:, 0] - first_tile[:, 0] + 1
+    rows = last_tile[:, 1] - first_tile[:, 1] + 1
+
+    # one entry per (polygon, tile) pair, polygons stay in drawing order within each tile thanks to the stable sort
+    counts = columns * rows
+    pair = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile_x = np.repeat(first_tile[:, 0], counts) + pair % np.repeat(columns, counts)
+    tile_y = np.repeat(first_tile[:, 1], counts) + pair // np.repeat(columns, counts)
+    tile_ids = tile_y * n_tiles[0] + tile_x
+    sort = np.argsort(tile_ids, kind="stable")
+    tile_ids, faces = tile_ids[sort], np.repeat(order, counts)[sort]
+    unique_ids, starts = np.unique(tile_ids, return_index=True)
+    return {(int(x % n_tiles[0]), int(x // n_tiles[0])): faces_of_tile
+            for x, faces_of_tile in zip(unique_ids, np.split(faces, starts[1:]))}
+
+
+def _set_tile_geometry(pixels: np.ndarray, loop_start: np.ndarray, loop_total: np.ndarray,
+                       colors: np.ndarray) -> None:
+    _tile_geometry.update(pixels=pixels, loop_start=loop_start, loop_total=loop_total, colors=colors)
+
+
+def _draw_tile(tile: Tuple[np.ndarray, int, int, int, int]) -> Image.Image:
+    faces, x0, y0, width, height = tile
+    img = Image.new("RGBA", (width, height), BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(img, "RGBA")
+    pixels = _tile_geometry["pixels"] - np.array([x0, y0])
+    loop_start, loop_total, colors = _tile_geometry["loop_start"], _tile_geometry["loop_total"], \
+        _tile_geometry["colors"]
+    for idx in faces:
+        start = loop_start[idx]
+        draw.polygon(list(map(tuple, pixels[start:start + loop_total[idx]])),
+                     fill=tuple(int(x) for x in colors[idx]), outline=(0, 0, 0))
+    return img
+
+
+def render_tiles(projected: ProjectedPolygons, max_resolution: int, tile_size: int = 1024, workers: int = 1,
+                 skip_empty: bool = False) -> Iterator[Tuple[int, int, Image.Image]]:
+    """
+    Renders the image create_packed_image would return tile by tile, row by row
+    :param projected: ProjectedPolygons object
+    :param max_resolution: size of the longer side of the whole image in pixels
+    :param tile_size: width and height of a tile in pixels, tiles at the right and bottom border may be smaller
+    :param workers: number of processes rendering tiles in parallel, 1 renders in this process
+    :param skip_empty: leave out tiles without any polygon
+    :return: iterator of column, row, RGBA Image object
+    """
+    pixels, (width, height) = get_pixel_coordinates(projected, max_resolution)
+    n_tiles = (-(-width // tile_size), -(-height // tile_size))
+    tile_faces = bin_polygons(pixels, projected, tile_size, n_tiles)
+    # PIL truncates coordinates, truncating before moving them into tile space rasterizes exactly like drawing the
+    # whole image at once (truncation of shifted coordinates would differ for coordinates left of or above the tile)
+    geometry = (np.trunc(pixels), projected.loop_start, projected.loop_total, projected.colors)
+
+    def get_tiles(row: int) -> List[Tuple[int, Tuple[np.ndarray, int, int, int, int]]]:
+        return [(column, (tile_faces.get((column, row), np.zeros(0, dtype=np.int64)), column * tile_size,
+                          row * tile_size, min(tile_size, width - column * tile_size),
+                          min(tile_size, height - row * tile_size)))
+                for column in range(n_tiles[0]) if not skip_empty or (column, row) in tile_faces]
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_set_tile_geometry, initargs=geometry) as executor:
+            for row in range(n_tiles[1]):
+                # only one row of tiles is in flight at a time to keep memory bounded
+                row_tiles = get_tiles(row)
+                for column, img in zip([x[0] for x in row_tiles], executor.map(_draw_tile, [x[1] for x in row_tiles])):
+                    yield column, row, img
+    else:
+        _set_tile_geometry(*geometry)
+        for row in range(n_tiles[1]):
+            for column, tile in get_tiles(row):
+                yield column, row, _draw_tile(tile)
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def save_tiles_as_png(tiles: Iterator[Tuple[int, int, Image.Image]], size: Tuple[int, int], image_path: str) -> None:
+    """
+    Writes row by row rendered tiles into one png file, only one row of tiles is held in memory
+    :param tiles: iterator of column, row, RGBA image as returned by render_tiles
+    :param size: width and height of the whole image
+    :param image_path: path of .png file
+    :return: None
+    """
+    width, height = size
+    compressor = zlib.compressobj(6)
+    with open(image_path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bit RGBA, no interlacing
+        f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+
+        def write_row(row_tiles: List[Image.Image]) -> None:
+            band = np.concatenate([np.asarray(x) for x in row_tiles], axis=1)
+            for y in range(0, band.shape[0], 64):
+                # every scanline starts with filter type 0 (none)
+                lines = band[y:y + 64].reshape(len(band[y:y + 64]), -1)
+                data = compressor.compress(np.concatenate((np.zeros((len(lines), 1), dtype=np.uint8), lines),
+                                                          axis=1).tobytes())
+                if data:
+                    f.write(_png_chunk(b"IDAT", data))
+
+        row_tiles, current_row = list(), 0
+        for column, row, img in tiles:
+            if not row == current_row:
+                write_row(row_tiles)
+                row_tiles, current_row = list(), row
+            row_tiles.append(img)
+        if row_tiles:
+            write_row(row_tiles)
+        f.write(_png_chunk(b"IDAT", compressor.flush()))
+        f.write(_png_chunk(b"IEND", b""))
+
+
+def create_tiled_image(packed: PackedPolygons, x_angle: float, y_angle: float, z_angle: float, perspective: bool,
+                       output_path: str, max_resolution: int = 16384, fov: int = 50, tile_size: int = 1024,
+                       workers: int = 1) -> Tuple[int, int]:
+    """
+    Renders a rotated view of any size, memory depends on tile size and geometry, not on max_resolution
+    :param packed: PackedPolygons object
+    :param x_angle: rotation angle in degrees
+    :param y_angle: rotation angle in degrees
+    :param z_angle: rotation angle in degrees
+    :param perspective: perspective projection if True, orthographic otherwise
+    :param output_path: path containing format fields {x} and {y} like "tiles/{y}_{x}.png" to store each tile as
+    separate file (only one tile per worker in memory), otherwise path of a .png file (one row of tiles in memory)
+    :param max_resolution: size of the longer image side in pixels
+    :param fov: field of view for perspective projection
+    :param tile_size: width and height of a tile in pixels
+    :param workers: number of processes rendering tiles in parallel
+    :return: width and height of the whole image
+    """
+    projected = project_packed_polygons(packed, x_angle, y_angle, z_angle, perspective, fov)
+    _, size = get_pixel_coordinates(projected, max_resolution)
+    tiles = render_tiles(projected, max_resolution, tile_size, workers)
+    if "{" in output_path:
+        for column, row, img in tiles:
+            tile_path = output_path.format(x=column, y=row)
+            if os.path.dirname(tile_path):
+                os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            img.save(tile_path)
+    else:
+        save_tiles_as_png(tiles, size, output_path)
+    return size
+
+
+def create_tile_pyramid(packed: PackedPolygons, x_angle: float, y_angle: float, z_angle: float, perspective: bool,
+                        output_dir: str, max_zoom: int = 4, fov: int = 50, tile_size: int = 256,
+                        workers: int = 1) -> int:
+    """
+    Renders a z/x/y tile pyramid for zoomable web viewers, zoom level 0 is one tile showing the whole map
+    The view is projected once, every zoom level is then rasterized at its own resolution instead of downscaled
+    :param packed: PackedPolygons object
+    :param x_angle: rotation angle in degrees
+    :param y_angle: rotation angle in degrees
+    :param z_angle: rotation angle in degrees
+    :param perspective: perspective projection if True, orthographic otherwise
+    :param output_dir: tiles are stored as output_dir/zoom/x/y.png
+    :param max_zoom: highest zoom level, its longer image side is tile_size * 2 ** max_zoom pixels
+    :param fov: field of view for perspective projection
+    :param tile_size: width and height of a tile in pixels
+    :param workers: number of processes rendering tiles in parallel
+    :return: number of stored tiles, tiles without polygons are skipped
+    """
+    projected = project_packed_polygons(packed, x_angle, y_angle, z_angle, perspective, fov)
+    n_tiles = 0
+    for zoom in range(max_zoom + 1):
+        for column, row, img in render_tiles(projected, tile_size * 2 ** zoom, tile_size, workers, skip_empty=True):
+            if not img.size == (tile_size, tile_size):
+                # tiles at the right and bottom border are padded with transparency
+                tile = Image.new("RGBA", (tile_size, tile_size), (0, 0, 0, 0))
+                tile.paste(img, (0, 0))
+                img = tile
+            os.makedirs(os.path.join(output_dir, str(zoom), str(column)), exist_ok=True)
+            img.save(os.path.join(output_dir, str(zoom), str(column), f"{row}.png"))
+            n_tiles += 1
+    return n_tiles
@@ -1,12 +1,13 @@
 import struct
-import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
 import math
 from statistics import mean
 import copy
-import os
-from PIL import Image
-from PIL import WalImageFile
+import numpy as np
+from Q2BSP import Q2BSP
+from bsp_arrays import get_face_arrays, get_texture_flags, get_vertex_array, SURF_HINT, SURF_NODRAW, SURF_SKY, \
+    SURF_SKIP
+from rasterization import get_line_quads, paint_polygons
 
 
 def sort_by_z(faces):
@@ -65,12 +66,9 @@ def get_line_coords(path):
             vert_2 = int.from_bytes(bytes1[offset_edges + 4 * i + 2:offset_edges + 4 * i + 4], byteorder='little', signed=False)
             edges.append([vertices[vert_1], vertices[vert_2]])
         min_x = min([p for i in [[vertex[0] for vertex in edge] for edge in edges] for p in i])
-        print(min_x)
-        print(max([p for i in [[vertex[0] for vertex in edge] for edge in edges] for p in i]))
         min_y = min([p for i in [[vertex[1] for vertex in edge] for edge in edges] for p in i])
         min_z = min([p for i in [[vertex[2] for vertex in edge] for edge in edges] for p in i])
 
-        print(edges[:10])
         return [[[round(vertex[0]-min_x), round(vertex[1]-min_y), round(vertex[2]-min_z)] for vertex in edge] for edge in edges]
 
 
@@ -86,7 +84,6 @@ def create_line_image(edges, ax, x=0, y=1, title="", thickness=14):
     :return:
     """
     z=3-(x+y)
-    print(max([p for i in [[vertex[0] for vertex in edge] for edge in edges] for p in i]))
     max_y = round(max([p for i in [[vertex[y] for vertex in edge] for edge in edges] for p in i]))
     img = Image.new("RGB",
                     (round(max([p for i in [[vertex[x] for vertex in edge] for edge in edges] for p in i])),
@@ -104,3 +101,77 @@ def create_line_image(edges, ax, x=0, y=1, title="", thickness=14):
         ax.axis("off")
         ax.imshow(img)
         ax.set_title(title)
+
+
+def get_edge_array(path):
+    """
+    Loads every edge of drawn faces once, edges shared by two faces and unused edges aren't duplicated / drawn
+    :param path: full path to map
+    :return: (n_edges, 2, 3) positions of both ends of each edge
+    """
+    temp_map = Q2BSP(path)
+    face_arrays = get_face_arrays(temp_map)
+    skip_flags = SURF_HINT | SURF_NODRAW | SURF_SKY | SURF_SKIP
+    drawn = (get_texture_flags(temp_map)[face_arrays.texture_info] & skip_flags) == 0
+    # each corner and the following corner of the same face form an edge
+    following = np.arange(len(face_arrays.loop_vertices)) + 1
+    following[face_arrays.loop_start + face_arrays.loop_total - 1] = face_arrays.loop_start
+    corners = np.repeat(drawn, face_arrays.loop_total)
+    pairs = np.stack((face_arrays.loop_vertices[corners], face_arrays.loop_vertices[following][corners]), axis=1)
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+    return get_vertex_array(temp_map).astype(np.float64)[pairs]
+
+
+def get_rotation_matrix(x_angle, y_angle, z_angle):
+    """
+    Rotation by y, z, x axis in this order, like get_rot_polys
+    :return: 3×3 matrix that is multiplied with column vectors
+    """
+    x, y, z = [math.radians(a) for a in (x_angle, y_angle, z_angle)]
+    rot_x = np.array([[1, 0, 0], [0, math.cos(x), -math.sin(x)], [0, math.sin(x), math.cos(x)]])
+    rot_y = np.array([[math.cos(y), 0, math.sin(y)], [0, 1, 0], [-math.sin(y), 0, math.cos(y)]])
+    rot_z = np.array([[math.cos(z), -math.sin(z), 0], [math.sin(z), math.cos(z), 0], [0, 0, 1]])
+    return rot_x @ rot_z @ rot_y
+
+
+def create_edge_image(edges, ax, x=0, y=1, title="", thickness=14, max_resolution=2048, angles=None):
+    """
+    Vectorized alternative to create_line_image, all lines are rasterized at once into a NumPy buffer
+    Lines are colored by depth like in create_line_image, higher lines cover lower ones
+    :param edges: (n_edges, 2, 3) array as returned by get_edge_array
+    :param ax: axes to draw to
+    :param x: coordinate that will be drawn as x value
+    :param y: coordinate that will be drawn as y value
+    :param title: only relevant when image is drawn on axes
+    :param thickness: line width in map units
+    :param max_resolution: size of the longer image side in pixels
+    :param angles: x, y, z rotation angles in degrees applied before drawing, like get_rot_polys
+    :return: RGB Image object if ax is None
+    """
+    z = 3 - (x + y)
+    edges = edges.reshape(-1, 3)
+    if angles:
+        edges = edges @ get_rotation_matrix(*angles).T
+    edges = (edges - edges.min(axis=0)).reshape(-1, 2, 3)
+    max_x, max_y, max_z = edges[:, :, x].max(), edges[:, :, y].max(), max(edges[:, :, z].max(), 1)
+    scale = max_resolution / max(max_x, max_y, 1)
+    size = (max(1, int(max_x * scale)), max(1, int(max_y * scale)))
+
+    # lines are drawn from the lowest to the highest one, so the highest one is visible where lines overlap
+    mean_z = edges[:, :, z].mean(axis=1)
+    order = np.argsort(mean_z, kind="stable")
+    points = np.stack((edges[order, :, x] * scale, (max_y - edges[order, :, y]) * scale), axis=2)
+    corners, loop_start, loop_total = get_line_quads(points[:, 0], points[:, 1], max(1.0, thickness * scale))
+    top_line = paint_polygons(corners, loop_start, loop_total, size)
+
+    col = (510 * mean_z[order] / max_z).astype(np.int64)
+    colors = np.stack((np.maximum(0, col - 255), np.zeros_like(col), np.maximum(0, 255 - col)), axis=1)
+    # one extra white entry for pixels without lines
+    colors = np.concatenate((colors, [[255, 255, 255]])).astype(np.uint8)
+    img = Image.fromarray(colors[top_line], "RGB")
+    if not ax:
+        return img
+    else:
+        ax.axis("off")
+        ax.imshow(img)
+        ax.set_title(title)